@@ -2,16 +2,31 @@
 Wrapper for the data preparation phase.
 
 Goes through the following steps:
-- call generate_linking_table.r to generate a linking table
-- call download_deepblue_data.r to download the data
-- create a list of all files that need to be validated and then call
-  convert_files.sh to validate and convert them
+- call generate_linking_table.r (or scripts/linking_table.py) to generate a
+  linking table
+- call download_deepblue_data.r (or scripts/deepblue.py) to download the data
+- query the catalog for all files that need to be validated and then call
+  convert_files.py to validate and convert them
 - call merge_reads.py to merge forward reverse reads
 - call sort_files.sh to sort files into the final folderstructure
 - call generate_pickle.py to generate picklefiles
-- create a list of files that need to be normalized and then call
+- query the catalog for the files that need to be normalized and then call
   normalize_signal_values.py to normalize the data
 
+The linking tables of every step are kept in an indexed SQLite catalog
+(./data/catalog.sqlite, see scripts/catalog.py). The semicolon separated
+linking tables are still written for the R and shell scripts.
+
+Every step after the linking table is a stage of scripts/pipeline.py and is
+only run for the files whose inputs changed since the last run.
+
+If a cache directory is given, downloaded and converted files are taken from
+and added to the global artifact cache (see scripts/artifact_cache.py), which
+can be shared by several output paths.
+
+The modules of the single steps are only imported when their step runs, so
+pyBigWig is not loaded if every stage is skipped.
+
 Use as follows:
 
 import generate_data
@@ -23,12 +38,14 @@ by Jonathan Schaefer(JonnyCodewalker)
 """
 
 import subprocess
+import shutil
 import os
+import re
 import logging
-from csv import reader, writer
-from scripts.merge_reads import merge_all
-from scripts.generate_pickle import parse
-from scripts.normalize_signal_values import normalize_all
+from scripts.artifact_cache import ArtifactCache
+from scripts.catalog import Catalog
+from scripts.pipeline import Executor, Stage
+from scripts.compression import strip_suffix
 from scripts.setup_logging import setup
 import pandas as pd
 
@@ -46,10 +63,20 @@ class DataConfig:
     - redoverification: boolean to check if force verification is done
     - offline: boolean to check if offline mode is used
     - logilfe: path to the logfile used in the run
+    - threads: maximum number of concurrent jobs, defaults to the cpu count
+    - cache_dir: path to the global artifact cache, not used if None
+    - cache_size: maximum size of the artifact cache in bytes
+    - downloader: "r" to generate the linking table and download with the R
+      scripts or "python" to use scripts/linking_table.py and
+      scripts/deepblue.py
+    - dry_run: boolean, if True nothing is written to the output path or the
+      artifact cache (used by --plan)
       """
 
     def __init__(self, genome, chromosome, biosource, epigenetic_mark,
-                 output_path, csv_name, datatype, localfiles, redoverification, offline, logfile):
+                 output_path, csv_name, datatype, localfiles, redoverification, offline, logfile,
+                 threads=None, cache_dir=None, cache_size=50 * 1024 ** 3,
+                 downloader="r", compression=None, dry_run=False):
         """
         Inizialize the datastructure and log the parameters used.
         :param genome: list of genomes
@@ -63,6 +90,16 @@ class DataConfig:
         :param redoverification: boolean to check if force verification is done
         :param offline: boolean to check if offline mode is used
         :param logilfe: path to the logfile used in the run
+        :param threads: maximum number of concurrent jobs
+        :param cache_dir: path to the global artifact cache, not used if None
+        :param cache_size: maximum size of the artifact cache in bytes
+        :param downloader: "r" or "python"
+        :param compression: "gzip" or "zstd" to store the files downloaded
+                            by the python downloader compressed, None to
+                            store them as plain text
+        :param dry_run: boolean, if True the catalog is a copy in memory and
+                        the artifact cache is only opened if it exists, so
+                        planning the run writes nothing
         """
         self.genome = genome
         self.chromosome = chromosome
@@ -76,6 +113,15 @@ class DataConfig:
         self.redoverification = redoverification
         self.offline = offline
         self.logfile = logfile
+        self.threads = threads
+        self.downloader = downloader
+        self.compression = compression
+        self.dry_run = dry_run
+        self.catalog = self.open_catalog()
+        self.cache = None
+        if cache_dir is not None and (not dry_run or
+                                      os.path.isdir(cache_dir)):
+            self.cache = ArtifactCache(cache_dir, cache_size)
 
         logging.info("Genomes: " + '; '.join(self.genome))
         logging.info("Biosources: " + '; '.join(self.biosource))
@@ -85,30 +131,152 @@ class DataConfig:
     def pull_data(self):
         """
         Recommended way to use this wrapper. Calls all needed functions.
-        Depending on offlinemode, redoverification or if need data is used.
+
+        The stages after the linking table are run by scripts.pipeline,
+        which only passes the files whose inputs changed since the last run
+        on to a stage and skips stages without changed files. Depending on
+        offlinemode no linking table is generated and nothing is downloaded,
+        with redoverification all files are validated, sorted and
+        normalized again.
         """
-        newdata = False
+        executor = Executor(self.catalog)
         if not self.offline:
+            # the linking table depends on the data available on DeepBlue,
+            # so it is generated on every run
             self.generate_csv()
-            newdata = self.download_data()
-        if newdata or self.redoverification:
-            self.validate_convert_files()
-            self.merge_forward_reverse()
-            self.sort_files()
-            self.generate_dictionaries()
-
-            # This code should not be needed, but somehow somewhere duplicate
-            # entries can be added to the linking table...somehow
-            csv = pd.read_csv(os.path.join(
-                self.outpath, "data", self.csvname), sep=';')
-            csv.drop_duplicates(inplace=True)
-            csv.to_csv(os.path.join(
-                self.outpath, "data", self.csvname), sep=';', index=False)
 
-        else:
-            print(
-                "No new data was downloaded, skipping validation, merging and sorting.")
-        self.normalize()
+        for stage, force in self.stages():
+            executor.run(stage, force=force)
+
+    def stages(self):
+        """
+        The stages after the linking table in the order they are run, also
+        used by scripts.planner to plan a run.
+        :return: list of (scripts.pipeline.Stage, force) tuples
+        """
+        stages = []
+        if not self.offline:
+            stages.append((Stage("download", self.download_items,
+                                 self.download_changed,
+                                 self.download_outputs), False))
+
+        stages.append((Stage("convert", self.convert_items,
+                             self.validate_convert_files),
+                       self.redoverification))
+        # merging and sorting work on the files converted in this run
+        stages.append((Stage("merge", lambda: self.temp_items(
+            ["%forward%", "%reverse%"]),
+            lambda items: self.merge_forward_reverse()), True))
+        stages.append((Stage("sort", self.temp_items,
+                             lambda items: self.sort_files()), True))
+        stages.append((Stage("pickle", self.pickle_items,
+                             self.generate_dictionaries),
+                       self.redoverification))
+        stages.append((Stage("normalize", self.normalize_items,
+                             lambda items: self.normalize()),
+                       self.redoverification))
+        return stages
+
+    def download_items(self):
+        """
+        Items of the download stage: every selected file of the linking table
+        generated by generate_linking_table.r, with the row as input.
+        :return: dictionary {filename: [row]}
+        """
+        return {row.filename: [";".join(str(value) for value in row)]
+                for row in self.select_files("download").itertuples(
+                    index=False)}
+
+    def download_outputs(self, filename):
+        """
+        A download is complete once its .meta.txt file exists.
+        :param filename: filename of the linking table
+        :return: list of output paths
+        """
+        return [os.path.join(self.outpath, "data", "download",
+                             filename + ".meta.txt")]
+
+    def download_changed(self, filenames):
+        """
+        Link the changed files from the artifact cache and download the
+        remaining ones.
+        :param filenames: list of filenames of the linking table
+        :return: list of the downloaded filenames
+        """
+        rows = self.select_files("download")
+        rows = rows[rows.filename.isin(filenames)]
+        self.fetch_cached("download", rows)
+        done = [filename for filename in filenames
+                if os.path.exists(self.download_outputs(filename)[0])]
+        if len(done) < len(filenames):
+            self.download_data()
+            done = [filename for filename in filenames
+                    if os.path.exists(self.download_outputs(filename)[0])]
+        self.store_cached("download")
+        return done
+
+    def convert_items(self):
+        """
+        Items of the validate/convert stage: every selected downloaded file,
+        with its downloaded files and the filetype to convert to as inputs.
+        :return: dictionary {filename: [paths, filetype]}
+        """
+        download = os.path.join(self.outpath, "data", "download")
+        names = os.listdir(download) if os.path.isdir(download) else []
+        items = {}
+        for row in self.select_files("download").itertuples(index=False):
+            files = self.download_files(row.filename, names)
+            if row.filename + ".meta.txt" in files:
+                items[row.filename] = [os.path.join(download, file) for file
+                                       in sorted(files)] + [self.type]
+        return items
+
+    def temp_items(self, filename_like=None):
+        """
+        Items of the merge and sort stages: the files in ./data/temp/.
+        :param filename_like: list of SQL LIKE patterns for the filenames
+        :return: dictionary {file_path: [file_path]}
+        """
+        rows = self.catalog.select("temp", filename_like=filename_like)
+        return {path: [path] for path in rows.file_path}
+
+    def pickle_items(self):
+        """
+        Items of the pickle stage: the sorted .bed files.
+        :return: dictionary {file_path: [file_path]}
+        """
+        rows = self.catalog.select("sorted", filename_like=[
+            "%.bed", "%.bed.gz", "%.bed.zst"])
+        return {path: [path] for path in rows.file_path}
+
+    def normalize_items(self):
+        """
+        The normalization scales all selected files with the global min/max
+        of their log-scaled values, so they are a single item. Its inputs are
+        the log-scaled files (or the files which are not log-scaled yet).
+        :return: dictionary {"normalization": paths}
+        """
+        paths = self.select_files("sorted", ["%.bw"]).file_path
+        return {"normalization": [path + ".ln" if os.path.exists(
+            path + ".ln") else path for path in paths]}
+
+    def open_catalog(self):
+        """
+        Open the catalog of the output path. Linking tables of earlier runs
+        are imported if the catalog does not know their files yet. In a dry
+        run the catalog and the imports are kept in memory.
+        :return: scripts.catalog.Catalog
+        """
+        data = os.path.join(self.outpath, "data")
+        catalog = Catalog(os.path.join(data, "catalog.sqlite"),
+                          read_only=self.dry_run)
+        for stage, csv in [("download", os.path.join(data, "download",
+                                                     self.csvname)),
+                           ("sorted", os.path.join(data, self.csvname))]:
+            if catalog.count(stage) == 0 and os.path.isfile(csv):
+                logging.info(f"importing {csv} into the catalog")
+                catalog.import_csv(csv, stage)
+        return catalog
 
     def generate_csv(self):
         """
@@ -120,8 +288,14 @@ class DataConfig:
 
         This function also downloads the needed chrom.sizes files.
 
+        With the python downloader scripts.linking_table builds the csv with
+        concurrent requests and a local cache of the DeepBlue answers.
         """
         logging.info("starting csv creation")
+        if self.downloader == "python":
+            self.generate_csv_python()
+            return
+
         tool = os.path.join(self.binpath, "scripts",
                             "generate_linking_table.r")
         path = os.path.join(self.outpath, "data", "download")
@@ -140,6 +314,34 @@ class DataConfig:
         if rc != 0 or not os.path.isfile(os.path.join(path, self.csvname)):
             logging.error("error generating .csv")
             raise Exception("csv.r could not create CSV")
+        self.catalog.import_csv(os.path.join(path, self.csvname), "download")
+        logging.info("finished csv creation")
+
+    def generate_csv_python(self):
+        """
+        Generate the .csv with scripts.linking_table. Experiment metadata and
+        region counts are cached in ./data/deepblue_cache.sqlite.
+        """
+        from scripts.deepblue import DeepBlueClient, DeepBlueError
+        from scripts.linking_table import build_linking_table
+        from scripts.ttl_cache import TTLCache
+
+        path = os.path.join(self.outpath, "data", "download")
+        client = DeepBlueClient(max_in_flight=self.threads or 4)
+        cache = TTLCache(os.path.join(self.outpath, "data",
+                                      "deepblue_cache.sqlite"))
+        # the biosources are escaped for the R scripts
+        biosources = [x.replace("\\'", "'") for x in self.biosource]
+        try:
+            for genome in self.genome:
+                build_linking_table(client, genome, self.chromosome,
+                                    biosources, self.epigenetic_mark,
+                                    os.path.join(path, self.csvname), cache,
+                                    chrom_sizes_dir=path)
+        except (DeepBlueError, OSError) as err:
+            logging.error(f"error generating .csv: {err}")
+            raise Exception("scripts.linking_table could not create CSV")
+        self.catalog.import_csv(os.path.join(path, self.csvname), "download")
         logging.info("finished csv creation")
 
     def download_data(self):
@@ -151,8 +353,14 @@ class DataConfig:
         listed files into a given directory.
 
         If the returnvalue is 2 no new data was downloaded.
+
+        With the python downloader the selected files are downloaded by
+        scripts.deepblue with up to threads concurrent requests instead.
         """
         logging.info("starting data download")
+        if self.downloader == "python":
+            return self.download_data_python()
+
         tool = os.path.join(self.binpath, "scripts",
                             "download_deepblue_data.r")
         csv = os.path.join(self.outpath, "data", "download", self.csvname)
@@ -182,76 +390,71 @@ class DataConfig:
         logging.info("finished data download")
         return True
 
-    def validate_convert_files(self):
+    def download_data_python(self):
+        """
+        Download the selected files of the generated csv with scripts.deepblue.
+        Chunks finished by an interrupted run are not downloaded again.
+        :return: True if new data was downloaded
+        """
+        from scripts.deepblue import DeepBlueClient, DeepBlueError, download_all
+
+        outdir = os.path.join(self.outpath, "data", "download")
+        client = DeepBlueClient(max_in_flight=self.threads or 4)
+        rows = self.select_files("download").to_dict("records")
+        try:
+            count = download_all(client, rows, outdir,
+                                 local_dir=self.localfiles,
+                                 compression=self.compression)
+        except DeepBlueError as err:
+            logging.error(f"scripts.deepblue could not download data: {err}")
+            raise Exception("scripts.deepblue could not download data")
+        if count == 0:
+            logging.info("new new data was downloaded")
+        logging.info("finished data download")
+        return count > 0
+
+    def validate_convert_files(self, filenames=None):
         """
         Validates filetypes and converts them to requested filetype if needed.
 
-        Before doing this the function goes through the linking table generated
-        by generate_linking_table.r to create a list of all files needed to be
+        Before doing this the function queries the catalog for all files of the
+        linking table generated by generate_linking_table.r that need to be
         validated for the given parameters
 
-        Calls convert_files.sh and handles return value.
-        convert_files.sh takes :
+        Calls scripts.convert_files, which validates and converts the files
+        in a pool of worker processes. convert_all takes :
         -filetype: filetype to convert to
         -source_path: path to the downloaded data (./data/downlaod/)
-        -out_path:path to put the  validated files (./data/temp/)
-        -chrom_path: path to the chrom.sizes files
+        -out_path: path to the data folder, the validated files are put
+         into ./data/temp/ and the chrom.sizes files into ./data/chromsizes/
         -csv_name: name of the linking table file
-        -logfile: path to the logfile
+        -max_workers: maximum number of files converted at the same time
+
+        :param filenames: list of filenames of the linking table to validate,
+                          all selected files if None
+        :return: list of the validated filenames
         """
+        from scripts.convert_files import convert_all
+
         logging.info("starting file validation")
-        tool = os.path.join(self.binpath, "scripts", "convert_files.sh")
         indir = os.path.join(self.outpath, "data", "download")
         outdir = os.path.join(self.outpath, "data")
 
-        # create validation.csv
+        # create validation.csv with every chipseq that fits the params
+        # followed by the atac/dnase files fitting them
         validation_csv = os.path.join(indir, "validation.csv")
-        with open(validation_csv, 'w', newline='') as csvfile:
-            outcsv = writer(csvfile, delimiter=';')
-            found_biosources = []
-            found_genomes = []
-            found_chromosomes = []
-            with open(os.path.join(indir, self.csvname), 'r') as csv:
-                csv_reader = reader(csv, delimiter=';')
-                header = next(csv_reader)
-                outcsv.writerow(header)
-                genome = header.index("genome")
-                biosource = header.index("biosource")
-                chromosome = header.index("chromosome")
-                tf = header.index("epigenetic_mark")
-                technique = header.index("technique")
-                # find every chipseq that ifts the params and note
-                # which combinations have been found.
-                for row in csv_reader:
-                    if (row[genome] in self.genome and
-                            row[biosource] in self.biosource and
-                            row[tf] in self.epigenetic_mark and
-                            row[chromosome] in self.chromosome):
-
-                        if row[genome] not in found_genomes:
-                            found_genomes.append(row[genome])
-                        if row[biosource] not in found_biosources:
-                            found_biosources.append(row[biosource])
-                        if row[chromosome] not in found_chromosomes:
-                            found_chromosomes.append(row[chromosome])
-                        outcsv.writerow(row)
-                # go through the file again and check if atac/dnase
-                # files fitting the parameters are found
-                # reset the csv reader before doing so
-                csv.seek(0)
-                for row in csv_reader:
-                    if row[technique] in ["atac-seq", "dnase-seq"]:
-                        if (row[genome] in self.genome and
-                                row[biosource] in self.biosource and
-                                row[chromosome] in self.chromosome):
-                            outcsv.writerow(row)
-
-        # call convert_files.sh to actually validate and convert the files
-        rc = subprocess.call(
-            ["bash", tool, self.type, indir, outdir, self.csvname, self.logfile])
-        if rc != 0:
-            logging.error("convert_files.sh could not convert files")
-            raise Exception("convert_files.sh could not convert files")
+        rows = self.select_files("download")
+        if filenames is not None:
+            rows = rows[rows.filename.isin(filenames)]
+        self.catalog.export_csv("download", validation_csv, rows)
+
+        # link converted files from the artifact cache into the temp
+        # folder, convert_all only converts files without a .bw there
+        self.fetch_cached("converted", rows)
+
+        # validate and convert the files
+        convert_all(self.type, indir, outdir, self.csvname,
+                    max_workers=self.threads)
 
         # Keep backup of the last validation file for debugging purposes
         # os.rename does not overwrite on Windows meaning a check is needed.
@@ -262,10 +465,20 @@ class DataConfig:
             os.remove(old_val)
             os.rename(validation_csv, old_val)
 
+        self.catalog.remove_rows("temp")
+        self.catalog.import_csv(os.path.join(outdir, "temp", self.csvname),
+                                "temp")
+        self.store_cached("converted")
         logging.info("finished file validation")
         logging.info(
             f"finished validation, the run can be found at {old_val}")
 
+        validated = set(self.catalog.select("temp")[
+            ["experiment_id", "chromosome"]].itertuples(index=False,
+                                                         name=None))
+        return [row.filename for row in rows.itertuples(index=False)
+                if (row.experiment_id, row.chromosome) in validated]
+
     def merge_forward_reverse(self):
         """
         merge forward/reverse read files into a single .bw
@@ -273,24 +486,30 @@ class DataConfig:
         Calls scripts.merge_files and handles return value
 
         """
+        from scripts.merge_reads import merge_all
+
         logging.info("starting forward reverse merging")
-        bigwigMerge = subprocess.check_output(["which", "bigWigMerge"])
-        bedgraphtobigwig = subprocess.check_output(
-            ["which", "bedGraphToBigWig"])
+        # the ucsc tools are only needed as a fallback for the native merge
+        bigwigMerge = shutil.which("bigWigMerge") or "bigWigMerge"
+        bedgraphtobigwig = shutil.which(
+            "bedGraphToBigWig") or "bedGraphToBigWig"
         csvpath = os.path.join(self.outpath, "data", "temp", self.csvname)
         chromsizes = []
         for genome in self.genome:
             chromsizes.append(os.path.join(self.outpath, "data",
                                            "chromsizes", genome + ".chrom.sizes"))
         merge_all(csvpath, chromsizes, ["bigwig"],
-                  bedgraphtobigwig, bigwigMerge)
+                  bedgraphtobigwig, bigwigMerge, max_workers=self.threads,
+                  catalog=self.catalog)
         logging.info("finished forward reverse merging")
 
     def sort_files(self):
         """
-        merge forward/reverse read files into a single .bw
+        sort the validated files into the final folderstructure
 
-        Calls scripts.merge_files and handles return value
+        Calls scripts/sort_files.sh and handles return value. The sorted
+        files are added to the catalog, which drops duplicate entries, and
+        the linking table is exported from it again.
 
         """
         logging.info("starting Filesorting")
@@ -304,70 +523,32 @@ class DataConfig:
         if rc != 0:
             logging.error("sort_files.sh could not sort files")
             raise Exception("sort_files.sh could not sort files")
+        linking_table = os.path.join(outdir, self.csvname)
+        self.catalog.import_csv(linking_table, "sorted")
+        self.catalog.export_csv("sorted", linking_table)
+        self.catalog.remove_rows("temp")
         logging.info("finished Filesorting")
 
     def normalize(self):
         """
         Normalize files to allow proper analysis
-        Creates a normalize.csv and then calls scripts.normalize and handles
-        the return value
+        Queries the catalog for the files to normalize, keeps them as
+        normalization.csv and then calls scripts.normalize and handles the
+        return value
         """
+        from scripts.normalize_signal_values import normalize_all
+
         logging.info("Creating normalization.csv")
 
         # create normalization.csv
         data = os.path.join(self.outpath, "data")
         norm_csv = os.path.join(data, "temp", "normalization.csv")
-        set_header = False
-        with open(norm_csv, 'w', newline='') as csvfile:
-            outcsv = writer(csvfile, delimiter=';')
-            found_biosources = []
-            found_genomes = []
-            found_chromosomes = []
-            # first run goes through all files and appends ever chipseq it find
-            for file in os.listdir(data):
-                if file.endswith(".csv"):
-                    with open(os.path.join(data, file), 'r') as csv:
-                        csv_reader = reader(csv, delimiter=';')
-                        header = next(csv_reader)
-                        if not set_header:
-                            outcsv.writerow(header)
-                            set_header = True
-                        genome = header.index("genome")
-                        biosource = header.index("biosource")
-                        chromosome = header.index("chromosome")
-                        filename = header.index("filename")
-                        tf = header.index("epigenetic_mark")
-                        technique = header.index("technique")
-                        # find every chipseq that ifts the params and note
-                        # which combinations have been found.
-                        for row in csv_reader:
-                            if (row[genome] in self.genome and
-                                    row[biosource] in self.biosource and
-                                    row[tf] in self.epigenetic_mark and
-                                    row[chromosome] in self.chromosome and
-                                    row[filename].endswith(".bw")):
-
-                                if row[genome] not in found_genomes:
-                                    found_genomes.append(row[genome])
-                                if row[biosource] not in found_biosources:
-                                    found_biosources.append(row[biosource])
-                                if row[chromosome] not in found_chromosomes:
-                                    found_chromosomes.append(row[chromosome])
-                                outcsv.writerow(row)
-                        # go through the file again and check if atac/dnase
-                        # files fitting are found
-                        # reset the csv reader before doing so
-                        csv.seek(0)
-                        for row in csv_reader:
-                            if row[technique] in ["atac-seq", "dnase-seq"]:
-                                if (row[genome] in self.genome and
-                                        row[biosource] in self.biosource and
-                                        row[chromosome] in self.chromosome and
-                                        row[filename].endswith(".bw")):
-                                    outcsv.writerow(row)
+        os.makedirs(os.path.dirname(norm_csv), exist_ok=True)
+        norm_files = self.select_files("sorted", ["%.bw"])
+        self.catalog.export_csv("sorted", norm_csv, norm_files)
 
         logging.info("starting Normalization")
-        normalize_all(norm_csv)
+        normalize_all(norm_csv, norm_files)
         logging.info("finished Normalization")
         old_norm = os.path.join(data, "temp", "normalization.csv.old")
 
@@ -382,10 +563,124 @@ class DataConfig:
         logging.info(
             f"cleaned up normalization, the run can be found at {old_norm}")
 
-    def generate_dictionaries(self):
+    def generate_dictionaries(self, changed=None):
         """
         Generate pickle files for the downloaded data.
         Calls generate_pickle.py with the path the data is stored in.
+        :param changed: list of paths to .bed files that changed since the
+                        pickle files were generated
         """
+        from scripts.generate_pickle import parse
+
         path = os.path.join(self.outpath, "data")
-        parse(path)
+        parse(path, self.catalog, refresh=[
+            os.path.splitext(strip_suffix(bed))[0] + ".bw"
+            for bed in changed or []])
+
+    def cache_key(self, stage, row):
+        """
+        Key of the artifact of a linking table row in the artifact cache.
+        :param stage: "download" or "converted"
+        :param row: row of the linking table
+        :return: key of scripts.artifact_cache.ArtifactCache
+        """
+        params = {"genome": row.genome, "format": row.format}
+        if stage == "converted":
+            params["filetype"] = self.type
+        return self.cache.key(row.experiment_id, row.chromosome, stage,
+                              params)
+
+    def fetch_cached(self, stage, rows):
+        """
+        Link the cached files of every given file that is not present yet
+        into the project tree.
+        :param stage: "download" (into ./data/download/) or "converted"
+                      (into ./data/temp/)
+        :param rows: DataFrame with the rows of the linking table
+        :return: number of cache hits
+        """
+        if self.cache is None:
+            return 0
+        hits = 0
+        download = os.path.join(self.outpath, "data", "download")
+        temp = os.path.join(self.outpath, "data", "temp")
+        for row in rows.itertuples(index=False):
+            if stage == "download":
+                if os.path.exists(os.path.join(download,
+                                               row.filename + ".meta.txt")):
+                    continue
+                destination = download
+            else:
+                destination = temp
+            if self.cache.fetch(self.cache_key(stage, row), destination):
+                hits += 1
+        if hits:
+            print(f"linked {hits} {stage} files from the artifact cache")
+        return hits
+
+    def store_cached(self, stage):
+        """
+        Add the selected files of a stage to the artifact cache.
+        :param stage: "download" (complete downloads in ./data/download/) or
+                      "converted" (.bw and .bed files in ./data/temp/)
+        """
+        if self.cache is None:
+            return
+        if stage == "download":
+            download = os.path.join(self.outpath, "data", "download")
+            names = os.listdir(download)
+            for row in self.select_files("download").itertuples(index=False):
+                # a download is complete once its .meta.txt file exists
+                if row.filename + ".meta.txt" not in names:
+                    continue
+                files = [os.path.join(download, name) for name in
+                         self.download_files(row.filename, names)]
+                self.cache.store(self.cache_key(stage, row), files)
+        else:
+            temp = os.path.join(self.outpath, "data", "temp")
+            rows = self.catalog.select("temp")
+            for _, group in rows.groupby(["experiment_id", "chromosome"]):
+                files = set(group.file_path)
+                files.update(os.path.join(temp, name) for name in
+                             group.filename
+                             if strip_suffix(name).endswith(".bed"))
+                files = [file for file in files if os.path.exists(file)]
+                if files:
+                    self.cache.store(self.cache_key(
+                        stage, next(group.itertuples(index=False))), files)
+
+    @staticmethod
+    def download_files(filename, names):
+        """
+        Find the downloaded files (the file or its chunks, with or without
+        .txt ending and compressed or not, and the .meta.txt file) of a file
+        of the linking table.
+        :param filename: filename of the linking table
+        :param names: list of the file names in ./data/download/
+        :return: list of file names
+        """
+        pattern = re.compile(re.escape(filename) +
+                             r"(\.txt|\.meta\.txt|_chunk_?\d+(\.txt)?)?"
+                             r"(\.gz|\.zst)?$")
+        return [name for name in names if pattern.match(name)]
+
+    def select_files(self, stage, filename_like=None):
+        """
+        Query the catalog for every chipseq file that fits the params,
+        followed by the atac/dnase files fitting genome, biosource and
+        chromosome.
+        :param stage: stage of the files in the catalog
+        :param filename_like: list of SQL LIKE patterns for the filenames
+        :return: pandas DataFrame with the linking table columns
+        """
+        chip = self.catalog.select(stage, genome=self.genome,
+                                   biosource=self.biosource,
+                                   epigenetic_mark=self.epigenetic_mark,
+                                   chromosome=self.chromosome,
+                                   filename_like=filename_like)
+        atac = self.catalog.select(stage, genome=self.genome,
+                                   biosource=self.biosource,
+                                   chromosome=self.chromosome,
+                                   technique=["atac-seq", "dnase-seq"],
+                                   filename_like=filename_like)
+        return pd.concat([chip, atac], ignore_index=True).drop_duplicates()
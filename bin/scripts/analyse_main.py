@@ -7,13 +7,40 @@ Created on Thu Jan 28 17:40:57 2021
 """
 from scripts.repository import Repository
 from scripts.components_fit import GmFit
+from scripts.fitted_model import FittedModel
+from scripts.fit_cache import FitCache, fit as fitModel
 from scripts.visualize_data import VisualizeData as VD
 from scripts.ema import EMA
 from scripts.modify_csv import modifyCSV 
+from scripts.fast_kde import density
+from scripts.plot_service import PlotService, plot_job
 import pandas as pd
 import numpy as np
 import os
 import time
+from concurrent.futures import ProcessPoolExecutor
+
+def limitThreads(n_threads):
+    """
+    Initializer of the worker processes of TF_analyser.mainloop. Caps the
+    threads of BLAS/OpenMP so the workers do not oversubscribe the cpus.
+    Also used for a serial analysis in the main process, the limits are
+    restored by _thread_limits.restore_original_limits().
+
+    Parameters
+    ----------
+    n_threads: TYPE: int
+        threads per worker
+
+    Returns
+    -------
+    None.
+
+    """
+    from threadpoolctl import threadpool_limits
+    global _thread_limits
+    _thread_limits = threadpool_limits(limits=n_threads)
+
 
 class TF_analyser:
     """
@@ -21,10 +48,35 @@ class TF_analyser:
     part.
     """
     
-    def __init__(self, n_comps, genome, width, path, chromosome):
+    def __init__(self, n_comps, genome, width, path, chromosome, seed=None, criterion="knee", n_jobs=None,
+                 sample_size=None, incremental=False, fit_cache=True):
         """
         Initiation of Variables
 
+        Parameters
+        ----------
+        seed: TYPE: int
+            seed of all fits and generated distributions, the results are
+            not reproducible if None
+        criterion: TYPE: str
+            criterion of the evaluation of the number of components, "knee"
+            of the differences to generated distributions, "bic" or "aic"
+        n_jobs: TYPE: int
+            number of Transcription Factors analysed in parallel processes,
+            number of cpus if None
+        sample_size: TYPE: int
+            Transcription Factors with more points are fitted on a stratified
+            subsample of sample_size points and refined on all points, all
+            points are used if None
+        incremental: TYPE: bool
+            if True, Transcription Factors analysed before keep their number
+            of components and the fit starts from the stored model of the
+            last analysis (Model_[tf].npz next to the plots) if it was of
+            the same width and chromosomes
+        fit_cache: TYPE: bool
+            if True, fits are taken from and stored in the cache of fits in
+            results/fit_cache (see fit_cache.py)
+
         Returns
         -------
         None.
@@ -37,6 +89,14 @@ class TF_analyser:
         self.width = width
         self.evaluate_n = True
         self.eval_size = 7
+        self.seed = seed
+        self.criterion = criterion
+        self.n_jobs = n_jobs or os.cpu_count() or 1
+        self.sample_size = sample_size
+        self.incremental = incremental
+        #threads of a single analysis, None to use all cpus
+        self.n_threads = None
+        self.n_components = None
         
         if n_comps:
             
@@ -47,6 +107,7 @@ class TF_analyser:
         path_bin = os.path.split(path_scripts)
         path_main = os.path.split(path_bin[0])
         self.path_result_csv = os.path.join(path_main[0], 'results', 'result.csv')
+        self.fit_cache = FitCache(os.path.join(path_main[0], 'results', 'fit_cache')) if fit_cache else None
         
         if path:
             
@@ -61,6 +122,10 @@ class TF_analyser:
         Main method of the analyse part. Here the Transcription Factors 
         are analysed and a dataframe of the results is created. Also the distributions of the 
         ATAC and CHIP data is plotted and safed as png.
+        The Transcription Factors are analysed in parallel by a pool of
+        n_jobs processes (see analyseTF), the results are gathered in the
+        order of data and result.csv is written once at the end. The plots
+        are rendered by a PlotService while the analysis goes on.
 
         Parameters
         ----------
@@ -76,9 +141,10 @@ class TF_analyser:
 
         # total = Input().number_of_chr(data)
         
-        resultframe =pd.DataFrame(columns=['genome','width','mode','chr','biosource','tf','means','covariances', 'weights']) 
+        resultframe =pd.DataFrame(columns=['genome','width','mode','chr','biosource','tf','means','covariances', 'weights',
+                                           'path','time','vis_filename','n_components','n_fits','criterion','warm_start']) 
         
-        # i = 0
+        tasks = []
         # loop all biosources
         print("analyse_main.py: unpacking")
         for biosource, b_value in data.items():
@@ -86,8 +152,6 @@ class TF_analyser:
             #loop all transcription factors
             for tf, tf_value in b_value.items():
                 
-                print('analysing: '+ tf)
-                
                 scoresarray = []
                 #combine all scores of the chromosomes into vector-format list
                 for chromosome in tf_value.values():
@@ -96,59 +160,179 @@ class TF_analyser:
     
                             scoresarray.append([array[-1], array[-2]])                
                 
-               # scaled_scores = TF_analyser.scale(self, scoresarray)
-                distribution = np.array(scoresarray)
-                
-                mode = 'manual'
-                
-                if self.evaluate_n == True:
-                    
-                    mode = 'auto'
-                    print("mode auto: number of components is evaluated (components_fit.py)")
-                    #automated number of components evaluation  
-                    all_diffs = GmFit.getDifference(self, distribution, self.eval_size)
-                    self.n_components = GmFit.evaluate(self, all_diffs)
-                    #plt.plot(all_diffs)
-                
-                single_result = EMA().emAnalyse(distribution, self.n_components)
-               
-                single_result.insert(0,'tf',tf)
-                single_result.insert(0,'chr', ", ".join(self.chr))
-                single_result.insert(0,'biosource',biosource)
-                single_result.insert(0, 'mode', mode)
-                single_result.insert(0,'width', self.width)
-                single_result.insert(0,'genome', self.genome)
-                
-                #visualization and saving plots 
-                v= VD(self.path_results, tf, self.genome, biosource, self.chr)
-                path = v.displayDensityScatter(distribution, tf)
-                
-                v.altitudePlot(distribution, self.n_components, tf)
-                z,filename = v.contourPlot(distribution, self.n_components, tf)
-            
-                #Add z axis to scoresarray:
-                for i in range(0,len(z)):
-                    scoresarray[i].append(z[i])
-                    
-                #save data
-                np.savetxt(path + '/' + tf + '.csv', scoresarray, delimiter=',')
-                
-                single_result.insert(9, 'path', path)
-                single_result.insert(10, 'time', time.time())
-                single_result.insert(11, 'vis_filename', filename)
-                
-                resultframe = pd.concat([resultframe, single_result])
-
-                parameters = [self.genome, self.width, mode, ", ".join(self.chr), biosource, tf]
-                modifyCSV(self.path_result_csv).compare(parameters)
-                print (tf + "    Done")
-                
-
-        #Save resultframe
+                tasks.append((biosource, tf, scoresarray))
+        
+        #the single threaded plot workers get a third of the cpus, the
+        #analysis workers share the rest equally for BLAS and the
+        #concurrent fits of the component search
+        n_cpus = os.cpu_count() or 1
+        n_workers = max(1, min(self.n_jobs, len(tasks)))
+        n_plot_workers = max(1, min(n_workers, n_cpus) // 3)
+        n_workers = max(1, min(n_workers, n_cpus - n_plot_workers))
+        self.n_threads = max(1, (n_cpus - n_plot_workers) // n_workers)
+        results = []
+        #plots are rendered in their own processes while the analysis goes on
+        with PlotService(workers=n_plot_workers) as plots:
+            if n_workers == 1:
+                limitThreads(self.n_threads)
+                analysed = (TF_analyser.analyseTF(self, *task) for task in tasks)
+                pool = None
+            else:
+                print("analysing {0} transcription factors in {1} processes".format(len(tasks), n_workers))
+                pool = ProcessPoolExecutor(max_workers=n_workers, initializer=limitThreads,
+                                           initargs=(self.n_threads,))
+                #map keeps the order of the tasks
+                analysed = pool.map(self.analyseTF, *zip(*tasks))
+            try:
+                for single_result, job in analysed:
+                    plots.submit(job)
+                    results.append(single_result)
+            finally:
+                if pool is not None:
+                    pool.shutdown()
+                else:
+                    _thread_limits.restore_original_limits()
+            
+            print("waiting for the plots")
+        
+        resultframe = pd.concat([resultframe] + results)
+        
+        #remove old results of the same arguments and save resultframe
+        modifyCSV(self.path_result_csv).compareAll(
+            [[self.genome, self.width, single_result['mode'].iloc[0], ", ".join(self.chr), biosource, tf]
+             for (biosource, tf, _), single_result in zip(tasks, results)])
         Repository().save_csv(resultframe)
             
         return resultframe
     
+    def analyseTF(self, biosource, tf, scoresarray):
+        """
+        Analyses the distribution of one Transcription Factor: evaluation of
+        the number of components, fit, plots and the csv of the scores.
+
+        Parameters
+        ----------
+        biosource: TYPE: str
+            biosource of the Transcription Factor
+        tf: TYPE: str
+            Transcription Factor
+        scoresarray: TYPE: list of float64 vectors
+            ATAC and CHIP scores
+
+        Returns
+        -------
+        single_result: TYPE: pandas Dataframe
+            one row per component
+        job: TYPE: dict
+            plots of the Transcription Factor for the PlotService
+
+        """
+        print('analysing: '+ tf)
+        
+       # scaled_scores = TF_analyser.scale(self, scoresarray)
+        distribution = np.array(scoresarray)
+        
+        mode = 'manual'
+        criterion = None
+        models = {}
+        n_fits = 1
+        n_components = self.n_components
+        if self.fit_cache:
+            hits = self.fit_cache.hits
+        
+        #stored model of the last analysis of the Transcription Factor
+        model_path = os.path.join(self.path_results, 'plots', self.genome, biosource, tf, 'Model_' + tf + '.npz')
+        previous = None
+        if self.incremental and os.path.isfile(model_path):
+            previous = FittedModel.load(model_path)
+            #the model only fits data of the same width and chromosomes
+            if (previous.info.get('width') != self.width or
+                    previous.info.get('chromosomes') != ", ".join(self.chr)):
+                print("{0}: stored model is of another width or chromosomes, not warm-started".format(tf))
+                previous = None
+            #a fit can only be started from a model with at most as many components
+            elif n_components and previous.n_components > n_components:
+                previous = None
+        
+        if self.evaluate_n == True:
+            
+            mode = 'auto'
+        
+        if previous is not None:
+            #incremental mode: the number of components of the last analysis
+            #is kept and the fit starts from its solution
+            n_components = n_components or previous.n_components
+        
+        elif self.evaluate_n == True:
+            
+            print("mode auto: number of components is evaluated (components_fit.py)")
+            #automated number of components evaluation  
+            criterion = self.criterion
+            n_components, models, scores = GmFit.searchComponents(self, distribution, self.eval_size, criterion=criterion,
+                                                                  seed=self.seed, n_threads=self.n_threads,
+                                                                  sample_size=self.sample_size, cache=self.fit_cache)
+            n_fits = len(scores)
+            print("{0}: {1} components chosen by {2} after {3} fits".format(tf, n_components, criterion, n_fits))
+            #plt.plot(scores)
+        
+        #fit of the chosen number of components, reused from the
+        #evaluation if possible and shared by the results and plots
+        model = models.get(n_components)
+        if model is None:
+            model = fitModel(self.fit_cache, distribution, n_components, seed=self.seed, init=previous,
+                             sample_size=self.sample_size)
+        if model.diagnostics:
+            print("{0}: {1}".format(tf, model.describe()))
+        if self.fit_cache and self.fit_cache.hits > hits:
+            print("{0}: {1} fits taken from {2}".format(tf, self.fit_cache.hits - hits, self.fit_cache.directory))
+        
+        warm_start = None
+        if previous is not None:
+            warm_start = previous.info.get('time')
+            print("{0}: warm-started from the analysis of {1}, {2} EM steps".format(
+                tf, time.asctime(time.localtime(warm_start)) if warm_start else model_path, model.n_iter))
+        
+        single_result = EMA().emAnalyse(distribution, n_components, model=model)
+       
+        single_result.insert(0,'tf',tf)
+        single_result.insert(0,'chr', ", ".join(self.chr))
+        single_result.insert(0,'biosource',biosource)
+        single_result.insert(0, 'mode', mode)
+        single_result.insert(0,'width', self.width)
+        single_result.insert(0,'genome', self.genome)
+        
+        #density of every point, shared by the plots and the csv
+        z = density(distribution)
+        
+        #the plots are rendered by the PlotService of mainloop
+        v= VD(self.path_results, tf, self.genome, biosource, self.chr)
+        path = v.path_plots
+        filename = v.visFilename(tf)
+        job = plot_job(self.path_results, tf, self.genome, biosource, self.chr, distribution, z, model, filename)
+    
+        #Add z axis to scoresarray:
+        for i in range(0,len(z)):
+            scoresarray[i].append(z[i])
+            
+        #save data
+        np.savetxt(path + '/' + tf + '.csv', scoresarray, delimiter=',')
+        
+        single_result.insert(9, 'path', path)
+        analysed = time.time()
+        single_result.insert(10, 'time', analysed)
+        single_result.insert(11, 'vis_filename', filename)
+        single_result.insert(12, 'n_components', n_components)
+        single_result.insert(13, 'n_fits', n_fits)
+        single_result.insert(14, 'criterion', criterion)
+        single_result.insert(15, 'warm_start', warm_start)
+        
+        #store the model for incremental runs of the same data
+        model.save(model_path, time=analysed, width=self.width, chromosomes=", ".join(self.chr))
+        
+        print (tf + "    Done")
+        
+        return single_result, job
+    
     def scale(self, scoresarray):
         """
         NOT USED IN THE FINAL VERSION
@@ -0,0 +1,241 @@
+"""
+Global artifact cache shared by several output paths on the same host.
+
+Downloaded and converted files of an experiment are stored once in the cache
+directory and linked into the project trees of every output path that needs
+them (see staging.py), so identical DeepBlue experiments are neither
+downloaded nor converted twice.
+
+An artifact is the set of files of one experiment and chromosome after one
+processing stage with the parameters used. It is stored under the sha256 hash
+of these values:
+
+    <cache_dir>/objects/<hash[:2]>/<hash>/<files>
+
+The index (<cache_dir>/index.sqlite) keeps the size and last access time of
+every artifact. If the cache grows bigger than its size cap, the least
+recently used artifacts are evicted. All changes of the index are done while
+holding an exclusive lock on <cache_dir>/lock, artifacts are written into a
+temporary folder and renamed into place, so several runs can use the cache at
+the same time. Files already linked into a project tree stay valid after
+their artifact is evicted.
+
+
+Use as follows:
+
+    from scripts.artifact_cache import ArtifactCache
+
+    cache = ArtifactCache("/data/tf_cache", max_size=50 * 1024 ** 3)
+    key = cache.key("exp1234", "chr1", "download", {"genome": "hg19"})
+    if not cache.fetch(key, "data/download"):
+        ...
+        cache.store(key, ["data/download/exp1234.chr1"])
+"""
+
+import os
+import json
+import time
+import uuid
+import shutil
+import sqlite3
+import hashlib
+import logging
+from contextlib import contextmanager
+from scripts.staging import stage_file
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, the cache is not locked
+    fcntl = None
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS artifacts (
+    key TEXT PRIMARY KEY,
+    experiment_id TEXT,
+    chromosome TEXT,
+    stage TEXT,
+    params TEXT,
+    size INTEGER,
+    last_access REAL
+);
+CREATE INDEX IF NOT EXISTS artifacts_lru ON artifacts (last_access);
+"""
+
+
+class ArtifactCache:
+    """Content addressed cache of processed files with LRU eviction."""
+
+    def __init__(self, path, max_size=50 * 1024 ** 3):
+        """
+        Opens the cache and creates it if it does not exist yet.
+
+        :param path: path to the cache directory
+        :param max_size: maximum size of the cache in bytes
+        """
+        self.path = os.path.abspath(path)
+        self.max_size = max_size
+        os.makedirs(os.path.join(self.path, "objects"), exist_ok=True)
+        self.lock_path = os.path.join(self.path, "lock")
+        self.index_path = os.path.join(self.path, "index.sqlite")
+        with self.locked() as connection:
+            connection.executescript(SCHEMA)
+
+    @contextmanager
+    def locked(self):
+        """
+        Context manager holding the exclusive lock of the cache and a
+        connection to its index.
+        """
+        with open(self.lock_path, "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            connection = sqlite3.connect(self.index_path, timeout=60)
+            try:
+                with connection:
+                    yield connection
+            finally:
+                connection.close()
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    @staticmethod
+    def key(experiment_id, chromosome, stage, params=None):
+        """
+        Computes the key of an artifact.
+
+        :param experiment_id: DeepBlue experiment id
+        :param chromosome: chromosome of the files
+        :param stage: processing stage, e.g. "download" or "converted"
+        :param params: dictionary with the parameters of the stage
+        :return: dictionary with the hash and the values it is computed of
+        """
+        values = {"experiment_id": experiment_id, "chromosome": chromosome,
+                  "stage": stage, "params": params or {}}
+        digest = hashlib.sha256(json.dumps(
+            values, sort_keys=True).encode("utf-8")).hexdigest()
+        return dict(values, hash=digest)
+
+    def object_path(self, key):
+        """
+        :param key: key of the artifact
+        :return: path to the folder of the artifact
+        """
+        return os.path.join(self.path, "objects", key["hash"][:2],
+                            key["hash"])
+
+    def size_of(self, key):
+        """
+        Looks up an artifact without touching its last access time.
+
+        :param key: key of the artifact
+        :return: size of the artifact in bytes or None if it is not cached
+        """
+        with self.locked() as connection:
+            found = connection.execute(
+                "SELECT size FROM artifacts WHERE key = ?",
+                [key["hash"]]).fetchone()
+        if found is None or not os.path.isdir(self.object_path(key)):
+            return None
+        return found[0]
+
+    def fetch(self, key, destination):
+        """
+        Links the files of an artifact into a folder.
+
+        :param key: key of the artifact
+        :param destination: path to the folder
+        :return: list of the linked files, empty if the artifact is not cached
+        """
+        with self.locked() as connection:
+            found = connection.execute(
+                "SELECT key FROM artifacts WHERE key = ?",
+                [key["hash"]]).fetchone()
+            object_path = self.object_path(key)
+            if found is None or not os.path.isdir(object_path):
+                return []
+
+            os.makedirs(destination, exist_ok=True)
+            files = []
+            for file in sorted(os.listdir(object_path)):
+                files.append(os.path.join(destination, file))
+                stage_file(os.path.join(object_path, file), files[-1])
+
+            connection.execute(
+                "UPDATE artifacts SET last_access = ? WHERE key = ?",
+                [time.time(), key["hash"]])
+
+        logging.info("cache hit: {0} {1} {2}".format(
+            key["experiment_id"], key["chromosome"], key["stage"]))
+        return files
+
+    def store(self, key, files):
+        """
+        Stores files as an artifact. Nothing is done if the artifact is
+        already cached.
+
+        :param key: key of the artifact
+        :param files: list of paths to the files, the file names are kept
+        :return: Boolean, True if the artifact was stored
+        """
+        object_path = self.object_path(key)
+        if os.path.isdir(object_path):
+            return False
+
+        # link the files into a temporary folder outside the lock, a
+        # concurrent run storing the same artifact loses the rename below
+        tmp_path = os.path.join(self.path, "objects",
+                                "tmp-" + uuid.uuid4().hex)
+        os.makedirs(tmp_path)
+        size = 0
+        for file in files:
+            target = os.path.join(tmp_path, os.path.basename(file))
+            stage_file(file, target)
+            size += os.path.getsize(target)
+
+        with self.locked() as connection:
+            try:
+                os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                os.rename(tmp_path, object_path)
+            except OSError:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                return False
+
+            connection.execute(
+                "INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [key["hash"], key["experiment_id"], key["chromosome"],
+                 key["stage"], json.dumps(key["params"], sort_keys=True),
+                 size, time.time()])
+            self.evict(connection, keep=key["hash"])
+
+        return True
+
+    def evict(self, connection, keep=None):
+        """
+        Removes the least recently used artifacts until the cache is smaller
+        than its size cap. Needs to be called while holding the lock.
+
+        :param connection: connection to the index
+        :param keep: hash of an artifact that must not be evicted
+        """
+        total = connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM artifacts").fetchone()[0]
+        if total <= self.max_size:
+            return
+
+        evicted = 0
+        for digest, size in connection.execute(
+                "SELECT key, size FROM artifacts ORDER BY last_access"
+        ).fetchall():
+            if total <= self.max_size:
+                break
+            if digest == keep:
+                continue
+            shutil.rmtree(os.path.join(self.path, "objects", digest[:2],
+                                       digest), ignore_errors=True)
+            connection.execute("DELETE FROM artifacts WHERE key = ?",
+                               [digest])
+            total -= size
+            evicted += 1
+
+        logging.info("evicted {0} artifacts from the cache".format(evicted))
@@ -0,0 +1,314 @@
+"""
+Indexed local catalog of the linked experiments and their files.
+
+The catalog is a SQLite database (./data/catalog.sqlite) with one table for
+the experiments and one for the files. A file is stored once per stage of the
+data preparation phase:
+- download: files listed in the linking table of generate_linking_table.r
+- temp: validated and converted files in ./data/temp/
+- sorted: files sorted into the final folder structure
+
+The catalog also keeps the fingerprints of the inputs of every stage of the
+pipeline (see pipeline.py).
+
+Unique constraints keep duplicated rows out of the catalog, and the lookups
+of the pipeline (by genome, biosource, chromosome, epigenetic mark and
+technique) are indexed queries instead of rescans of the linking tables. The
+semicolon separated linking tables can still be imported and exported for
+compatibility with the R and shell scripts.
+
+Use as follows:
+
+    from scripts.catalog import Catalog
+
+    catalog = Catalog(os.path.join(outpath, "data", "catalog.sqlite"))
+    catalog.import_csv("linking_table.csv", "download")
+    rows = catalog.select("download", genome=["hg19"], chromosome=["chr1"])
+    catalog.export_csv("download", "validation.csv", rows)
+
+A catalog opened with read_only=True works on a copy in memory, changes are
+not written to the database file (used by the --plan dry run).
+"""
+
+import os
+import csv
+import pathlib
+import sqlite3
+import pandas as pd
+
+# column order of the linking tables
+COLUMNS = ["experiment_id", "genome", "biosource", "technique",
+           "epigenetic_mark", "chromosome", "filename", "data_type",
+           "file_path", "format", "sample_id", "project", "regions"]
+EXPERIMENT_COLUMNS = ["experiment_id", "genome", "technique",
+                      "epigenetic_mark", "data_type", "format", "sample_id",
+                      "project"]
+FILE_COLUMNS = ["experiment_id", "biosource", "chromosome", "filename",
+                "file_path", "regions"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS experiments (
+    experiment_id TEXT PRIMARY KEY,
+    genome TEXT,
+    technique TEXT,
+    epigenetic_mark TEXT,
+    data_type TEXT,
+    format TEXT,
+    sample_id TEXT,
+    project TEXT
+);
+CREATE TABLE IF NOT EXISTS files (
+    stage TEXT NOT NULL,
+    experiment_id TEXT NOT NULL REFERENCES experiments(experiment_id),
+    biosource TEXT,
+    chromosome TEXT,
+    filename TEXT NOT NULL,
+    file_path TEXT NOT NULL DEFAULT '',
+    regions INTEGER,
+    UNIQUE (stage, filename, file_path)
+);
+CREATE TABLE IF NOT EXISTS fingerprints (
+    stage TEXT NOT NULL,
+    item TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    PRIMARY KEY (stage, item)
+);
+CREATE INDEX IF NOT EXISTS experiments_lookup
+    ON experiments (genome, technique, epigenetic_mark);
+CREATE INDEX IF NOT EXISTS files_lookup
+    ON files (stage, biosource, chromosome);
+CREATE INDEX IF NOT EXISTS files_experiment
+    ON files (experiment_id, chromosome);
+"""
+
+
+def copy_to_memory(path, **kwargs):
+    """
+    Copies a SQLite database into memory without writing to its file.
+
+    :param path: path to the SQLite database file, an empty database is
+           returned if it does not exist
+    :param kwargs: further arguments of sqlite3.connect
+    :return: sqlite3.Connection to the copy
+    """
+    connection = sqlite3.connect(":memory:", **kwargs)
+    if os.path.isfile(path):
+        source = sqlite3.connect("{0}?mode=ro".format(
+            pathlib.Path(path).resolve().as_uri()), uri=True, timeout=60)
+        try:
+            source.backup(connection)
+        finally:
+            source.close()
+    return connection
+
+
+class Catalog:
+    """Local SQLite catalog of experiments and files."""
+
+    def __init__(self, path, read_only=False):
+        """
+        Opens the catalog and creates the tables if they do not exist yet.
+
+        :param path: path to the SQLite database file
+        :param read_only: Boolean, if True the catalog is copied into memory
+               and nothing is written to path
+        """
+        self.path = path
+        if read_only:
+            self.connection = copy_to_memory(path)
+        else:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        """Closes the connection to the catalog."""
+        self.connection.close()
+
+    def add_rows(self, rows, stage):
+        """
+        Adds rows of a linking table to the catalog. Rows that already exist
+        for the stage are updated instead of added twice.
+
+        :param rows: iterable of dictionaries with the linking table columns
+        :param stage: stage the files belong to
+        :return: number of rows added or updated
+        """
+        count = 0
+        with self.connection:
+            for row in rows:
+                self.connection.execute(
+                    "INSERT OR IGNORE INTO experiments ({0}) VALUES ({1})"
+                    .format(", ".join(EXPERIMENT_COLUMNS),
+                            ", ".join("?" * len(EXPERIMENT_COLUMNS))),
+                    [none_if_missing(row.get(col)) for col in
+                     EXPERIMENT_COLUMNS])
+                values = [none_if_missing(row.get(col)) for col in
+                          FILE_COLUMNS]
+                values[FILE_COLUMNS.index("file_path")] = \
+                    row.get("file_path") or ""
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO files (stage, {0}) VALUES (?, {1})"
+                    .format(", ".join(FILE_COLUMNS),
+                            ", ".join("?" * len(FILE_COLUMNS))),
+                    [stage] + values)
+                count += 1
+        return count
+
+    def import_csv(self, csv_path, stage):
+        """
+        Imports a semicolon separated linking table into the catalog.
+
+        :param csv_path: path to the linking table
+        :param stage: stage the files belong to
+        :return: number of rows imported
+        """
+        if not os.path.exists(csv_path):
+            return 0
+        with open(csv_path, "r", newline="") as csvfile:
+            return self.add_rows(csv.DictReader(csvfile, delimiter=";"), stage)
+
+    def remove_rows(self, stage, file_paths=None):
+        """
+        Removes the files of a stage from the catalog.
+
+        :param stage: stage the files belong to
+        :param file_paths: list of file paths to remove, all files of the stage
+               are removed if None
+        """
+        with self.connection:
+            if file_paths is None:
+                self.connection.execute("DELETE FROM files WHERE stage = ?",
+                                        [stage])
+            else:
+                self.connection.executemany(
+                    "DELETE FROM files WHERE stage = ? AND file_path = ?",
+                    [[stage, file_path] for file_path in file_paths])
+
+    def count(self, stage):
+        """
+        Counts the files of a stage.
+
+        :param stage: stage the files belong to
+        :return: number of files
+        """
+        cursor = self.connection.execute(
+            "SELECT COUNT(*) FROM files WHERE stage = ?", [stage])
+        return cursor.fetchone()[0]
+
+    def select(self, stage, genome=None, biosource=None, epigenetic_mark=None,
+               chromosome=None, technique=None, filename_like=None):
+        """
+        Selects the files of a stage matching the given filters. A filter set
+        to None is not applied.
+
+        :param stage: stage the files belong to
+        :param genome: list of genomes
+        :param biosource: list of biosources
+        :param epigenetic_mark: list of epigenetic marks
+        :param chromosome: list of chromosomes
+        :param technique: list of techniques
+        :param filename_like: list of SQL LIKE patterns of which the filename
+               has to match at least one
+        :return: pandas DataFrame with the linking table columns
+        """
+        conditions = ["f.stage = ?"]
+        params = [stage]
+
+        for column, values in [("e.genome", genome),
+                               ("f.biosource", biosource),
+                               ("e.epigenetic_mark", epigenetic_mark),
+                               ("f.chromosome", chromosome),
+                               ("e.technique", technique)]:
+            if values is not None:
+                values = list(values)
+                conditions.append("{0} IN ({1})".format(
+                    column, ", ".join("?" * len(values))))
+                params.extend(values)
+
+        if filename_like is not None:
+            conditions.append("(" + " OR ".join(
+                "f.filename LIKE ?" for _ in filename_like) + ")")
+            params.extend(filename_like)
+
+        query = ("SELECT {0} FROM files f JOIN experiments e "
+                 "ON f.experiment_id = e.experiment_id WHERE {1} "
+                 "ORDER BY f.rowid").format(
+            ", ".join(("f." if col in FILE_COLUMNS else "e.") + col for col in
+                      COLUMNS), " AND ".join(conditions))
+
+        return pd.read_sql_query(query, self.connection, params=params)
+
+    def distinct(self, stage, column):
+        """
+        Lists all distinct values of a column for the files of a stage.
+
+        :param stage: stage the files belong to
+        :param column: name of a linking table column
+        :return: set of values
+        """
+        if column not in COLUMNS:
+            raise ValueError("unknown column " + column)
+        table = "f." if column in FILE_COLUMNS else "e."
+        cursor = self.connection.execute(
+            "SELECT DISTINCT {0}{1} FROM files f JOIN experiments e "
+            "ON f.experiment_id = e.experiment_id WHERE f.stage = ?".format(
+                table, column), [stage])
+        return set(row[0] for row in cursor)
+
+    def fingerprints(self, stage):
+        """
+        Lists the recorded fingerprints of a pipeline stage.
+
+        :param stage: name of the pipeline stage
+        :return: dictionary {item: fingerprint}
+        """
+        cursor = self.connection.execute(
+            "SELECT item, fingerprint FROM fingerprints WHERE stage = ?",
+            [stage])
+        return dict(cursor.fetchall())
+
+    def set_fingerprints(self, stage, fingerprints):
+        """
+        Records fingerprints of a pipeline stage.
+
+        :param stage: name of the pipeline stage
+        :param fingerprints: dictionary {item: fingerprint}
+        """
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?)",
+                [[stage, item, value] for item, value in
+                 fingerprints.items()])
+
+    def export_csv(self, stage, csv_path, rows=None):
+        """
+        Exports the files of a stage as semicolon separated linking table.
+        The file_path column is left out for the download stage, like in the
+        linking table of generate_linking_table.r.
+
+        :param stage: stage the files belong to
+        :param csv_path: path to the linking table
+        :param rows: DataFrame returned by select, all files of the stage are
+               exported if None
+        """
+        if rows is None:
+            rows = self.select(stage)
+        if stage == "download":
+            rows = rows.drop(columns="file_path")
+        rows.to_csv(csv_path, sep=";", index=False)
+
+
+def none_if_missing(value):
+    """
+    Converts empty csv values to None.
+
+    :param value: value of a csv cell
+    :return: value or None if it is empty
+    """
+    if value is None or value == "" or (isinstance(value, float) and
+                                        value != value):
+        return None
+    return value
@@ -0,0 +1,184 @@
+"""
+Checks the DeepBlue clients of linking_table.py and deepblue.py against the
+local stand-in server of deepblue_standin.py, without contacting DeepBlue:
+
+- build_linking_table retries a failed request, links the ATAC-seq and
+  ChIP-seq experiments of a biosource into the rows of download_all and
+  leaves out ChIP-seq rows of chromosomes without regions
+- a second build_linking_table takes everything from its cache
+- a chunk whose first request fails is downloaded by the retry
+- a download interrupted by a chunk that keeps failing raises an error and
+  keeps the finished chunks in its manifest, the next run resumes with the
+  failed chunk only and completes the download
+
+Every check prints OK or FAILED, the exit code is 1 if a check failed, so
+the script can be used to catch regressions.
+
+    python bin/scripts/check_deepblue.py
+"""
+
+import os
+import csv
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+from scripts.deepblue import DeepBlueClient, DeepBlueError, download_all  # noqa: E402,E501
+from scripts.deepblue_standin import StandInServer  # noqa: E402
+from scripts.linking_table import build_linking_table  # noqa: E402
+from scripts.ttl_cache import TTLCache  # noqa: E402
+
+GENOMES = {"hg19": {"chr1": 300, "chr2": 100}}
+FORMAT = "CHROMOSOME,START,END,VALUE"
+CHUNK_SIZE = 100
+
+EXPERIMENTS = [
+    {"_id": "e1", "name": "atac_k562.bed", "genome": "hg19",
+     "technique": "ATAC-seq", "epigenetic_mark": "DNA Accessibility",
+     "data_type": "signal", "format": FORMAT, "sample_id": "s1",
+     "project": "ENCODE", "sample_info": {"biosource_name": "K562"},
+     # chunks 1-100 and 101-200 have data, 201-300 only zeros
+     "regions": [("chr1", 10, 20, 1.5), ("chr1", 30, 40, 0),
+                 ("chr1", 150, 160, 2.0), ("chr1", 170, 180, 3.0),
+                 ("chr1", 250, 260, 0), ("chr2", 5, 15, 4.0)]},
+    {"_id": "e2", "name": "ctcf_k562.bed", "genome": "hg19",
+     "technique": "ChIP-seq", "epigenetic_mark": "CTCF",
+     "data_type": "peaks", "format": FORMAT, "sample_id": "s1",
+     "project": "ENCODE", "sample_info": {"biosource_name": "K562"},
+     "regions": [("chr1", 12, 18, 8.0), ("chr1", 155, 165, 9.0)]}]
+
+# rows of the linking table of the experiments and chr1
+ROWS = [
+    {"experiment_id": "e1", "genome": "hg19", "biosource": "k562",
+     "technique": "atac-seq", "epigenetic_mark": "dna accessibility",
+     "chromosome": "chr1", "filename": "atac_k562.chr1.bed",
+     "format": FORMAT, "regions": 1},
+    {"experiment_id": "e2", "genome": "hg19", "biosource": "k562",
+     "technique": "chip-seq", "epigenetic_mark": "ctcf",
+     "chromosome": "chr1", "filename": "ctcf_k562.chr1.bed",
+     "format": FORMAT, "regions": 2}]
+
+
+def check(name, passed):
+    """
+    Prints the result of a check.
+
+    :return: passed
+    """
+    print("{0} {1}".format("OK    " if passed else "FAILED", name))
+    return passed
+
+
+def client_of(server):
+    """
+    :return: DeepBlueClient of the stand-in server with short backoffs
+    """
+    return DeepBlueClient(url=server.url, max_in_flight=2, retries=2,
+                          backoff=0.01, poll_interval=0)
+
+
+def chunk_starting(start):
+    """
+    :return: function of the arguments of select_experiments, True for the
+             chunk starting at start
+    """
+    return lambda experiment, chrom, chunk_start, end: chunk_start == start
+
+
+def check_linking_table(directory):
+    """
+    :return: True if all checks of build_linking_table passed
+    """
+    passed = True
+    output_file = os.path.join(directory, "linking_table.csv")
+    cache = TTLCache(os.path.join(directory, "deepblue_cache.sqlite"))
+    with StandInServer(GENOMES, EXPERIMENTS) as server:
+        client = client_of(server)
+
+        server.fail("list_experiments", 1)
+        added = build_linking_table(client, "hg19", ["chr1", "chr2"],
+                                    ["k562"], ["ctcf"], output_file, cache,
+                                    chrom_sizes_dir=directory)
+        passed &= check("failed request is retried",
+                        server.count("list_experiments") == 3)
+        with open(output_file, newline="") as csvfile:
+            rows = list(csv.DictReader(csvfile, delimiter=";"))
+        chr1_rows = [{key: row[key] for key in ROWS[0]} for row in rows
+                     if row["chromosome"] == "chr1"]
+        passed &= check("experiments are linked", added == 3 and sorted(
+            chr1_rows, key=lambda row: row["experiment_id"]) == [
+            {key: str(value) for key, value in row.items()} for row in ROWS])
+        passed &= check("chromosome without ChIP-seq regions is left out",
+                        [row["experiment_id"] for row in rows
+                         if row["chromosome"] == "chr2"] == ["e1"])
+        passed &= check("chrom.sizes is written", os.path.exists(
+            os.path.join(directory, "hg19.chrom.sizes")))
+
+        calls = len(server.calls)
+        build_linking_table(client, "hg19", ["chr1", "chr2"], ["k562"],
+                            ["ctcf"], output_file, cache, append=False)
+        passed &= check("second run is answered by the cache",
+                        len(server.calls) == calls)
+    return passed
+
+
+def check_download(out_dir):
+    """
+    :return: True if all checks of download_all passed
+    """
+    passed = True
+    with StandInServer(GENOMES, EXPERIMENTS) as server:
+        client = client_of(server)
+
+        # the first chunk fails once and is retried, the second one fails on
+        # every attempt and interrupts the download of the ATAC-seq file
+        server.fail("select_experiments", 1, when=chunk_starting(1))
+        server.fail("select_experiments", client.retries,
+                    when=chunk_starting(101))
+        try:
+            download_all(client, ROWS, out_dir, chunk_size=CHUNK_SIZE)
+            interrupted = False
+        except DeepBlueError as err:
+            interrupted = "atac_k562.chr1.bed" in str(err)
+        passed &= check("interrupted download raises an error", interrupted)
+        passed &= check("failed request is retried", server.count(
+            "select_experiments", chunk_starting(1)) == 2)
+        passed &= check("unaffected file is complete", os.path.exists(
+            os.path.join(out_dir, "ctcf_k562.chr1.bed.meta.txt")))
+        passed &= check("interrupted file keeps its manifest", os.path.exists(
+            os.path.join(out_dir, "atac_k562.chr1.bed.manifest.json")))
+
+        # the next run only requests the failed chunk
+        calls = len(server.calls)
+        downloaded = download_all(client, ROWS, out_dir,
+                                  chunk_size=CHUNK_SIZE)
+        resumed = server.calls[calls:]
+        starts = [args[2] for name, args in resumed
+                  if name == "select_experiments"]
+        passed &= check("resumed download requests the missing chunk only",
+                        downloaded == 1 and starts == [101])
+
+    with open(os.path.join(out_dir, "atac_k562.chr1.bed_chunk_101.txt")) as \
+            file:
+        lines = file.read().splitlines()
+    passed &= check("resumed chunk has its regions", lines[1:] == [
+        "chr1\t151\t160\t10\t*\t2.0", "chr1\t171\t180\t10\t*\t3.0"])
+    passed &= check("empty chunk is not written", not os.path.exists(
+        os.path.join(out_dir, "atac_k562.chr1.bed_chunk_201.txt")))
+    passed &= check("resumed download is complete", os.path.exists(
+        os.path.join(out_dir, "atac_k562.chr1.bed.meta.txt")) and
+        not os.path.exists(os.path.join(
+            out_dir, "atac_k562.chr1.bed.manifest.json")))
+    return passed
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        passed = check_linking_table(directory)
+        passed &= check_download(os.path.join(directory, "download"))
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Compares fast_kde.density with the exact scipy.stats.gaussian_kde on
+synthetic score distributions: a gaussian cloud, two correlated clusters,
+heavy-tailed lognormal scores and a cloud with a single far outlier. The
+median, 99th percentile and maximum of the relative error is reported per
+distribution. The exit code is 1 if an error is above --max_error (the
+maximum) or --max_median, so the script can be used to catch regressions.
+
+    python bin/scripts/check_fast_kde.py --points 20000
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from scipy.stats import gaussian_kde
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+from scripts.fast_kde import density  # noqa: E402
+
+
+def distributions(n, seed):
+    """
+    :return: dictionary of the names and Arrays of n synthetic (x, y) scores
+    """
+    rng = np.random.default_rng(seed)
+    clusters = np.concatenate([
+        rng.multivariate_normal([2, 3], [[1, 0.8], [0.8, 1]], n // 2),
+        rng.multivariate_normal([6, 1], [[0.5, -0.2], [-0.2, 0.3]],
+                                n - n // 2)])
+    outlier = np.concatenate([rng.normal(5, 1, (n - 1, 2)), [[1000, 1000]]])
+    return {"gaussian": rng.normal(0, 1, (n, 2)),
+            "clusters": clusters,
+            "lognormal": rng.lognormal(0, 1, (n, 2)),
+            "outlier": outlier}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares fast_kde.density "
+                                                 "with gaussian_kde")
+    parser.add_argument("--points", type=int, default=20000,
+                        help="number of points per distribution")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max_median", type=float, default=0.01,
+                        help="largest allowed median relative error")
+    parser.add_argument("--max_error", type=float, default=0.05,
+                        help="largest allowed relative error")
+    args = parser.parse_args()
+
+    failed = False
+    print("{0:<10} {1:>8} {2:>8} {3:>8} {4:>8} {5:>8}".format(
+        "data", "median", "p99", "max", "fast s", "exact s"))
+    for name, points in distributions(args.points, args.seed).items():
+        start = time.perf_counter()
+        # exact_limit=0, the grid is used for every size
+        z = density(points, exact_limit=0)
+        fast = time.perf_counter() - start
+        start = time.perf_counter()
+        exact = gaussian_kde(points.T)(points.T)
+        slow = time.perf_counter() - start
+
+        error = np.abs(z - exact) / exact
+        median, p99, maximum = np.median(error), np.quantile(error, 0.99), \
+            error.max()
+        print("{0:<10} {1:>8.4%} {2:>8.4%} {3:>8.4%} {4:>8.2f} {5:>8.2f}"
+              .format(name, median, p99, maximum, fast, slow))
+        failed |= median > args.max_median or maximum > args.max_error
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
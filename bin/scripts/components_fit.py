@@ -5,26 +5,38 @@ Created on Wed Jan 13 22:08:54 2021
 
 @author: jan
 """
+import os
 import numpy as np
-from sklearn.mixture import GaussianMixture
 import matplotlib as plt
+from concurrent.futures import ThreadPoolExecutor
 from kneed import KneeLocator
+from scripts import fit_cache
+
+#criteria of searchComponents
+CRITERIA = ["knee", "bic", "aic"]
+#number of candidates fitted concurrently by searchComponents, small enough
+#that the search can stop after the first half of the 7 evaluated sizes
+BATCH_SIZE = 2
+#relative improvement of a batch below which searchComponents stops
+TOLERANCE = 0.01
 
 class GmFit:
     
     #Generate gaussian distribution
-    def normaldist(self, loc, stdw, size):
+    def normaldist(self, loc, stdw, size, rng=None):
         """
         generate normal distribution by numy.random.normal
         
         Parameters
         ----------
-        loc: TYPE: int
+        loc: TYPE: int or Array of int
             location of the normal distribution (X/Y)
-        stdw: TYPE: float64
+        stdw: TYPE: float64 or Array of float64
             standard deviation
         size: TYPE: int
             size
+        rng: TYPE: numpy Generator
+            random number generator, numpy.random is used if None
 
         Returns
         -------
@@ -32,7 +44,9 @@ class GmFit:
             normal distribution 
         """
         #generate normal distribution
-        ndist = np.random.normal(loc, stdw, size)
+        if rng is None:
+            rng = np.random
+        ndist = rng.normal(loc, stdw, size)
         
         return (ndist)
     
@@ -53,8 +67,10 @@ class GmFit:
 
         Returns
         -------
-        intervalls: TYPE: list of int
-            
+        intervalls: TYPE: Array of int
+            number of points in each intervall, x-component outer and
+            y-component inner order. Points on the border of an intervall
+            are not counted.
 
         """
         #check if column size useable 
@@ -65,40 +81,23 @@ class GmFit:
         else:
             raise Exception("intervall_size should be dividable by 2!")
         
-        #initialysing variables
-        intervalls = []
-        lowX = 0
-        lowY = 0
-        
-        #loop trough all intervalls by x and y component in calculated stepsize
-        #By defining lowest and highest score of an intervall
-        for x in range(0,n_label):
-            #define new highscore of the intervall component
-            highX = lowX + size
-            for y in range(0,n_label):
-                #define new highscore of the intervall component
-                highY = lowY + size 
-                count = 0
-                
-                #loop trough all data points and count how many in the current intervall component
-                for i in ndist:
-                    #print(i)
-                    if (i[0] < highX and i[0] > lowX) and (i[1] < highY and i[1] > lowY):
-                        count += 1
-            
-                #append counted number
-                intervalls.append(count)
-                #define new lowest score 
-                lowY = lowY + size
-            #reset lowest score of x-component
-            lowY = 0
-            #define new lowest score
-            lowX = lowX + size
+        ndist = np.asarray(ndist, dtype=float).reshape(-1, 2)
+        
+        #index of the intervall of every point by x and y component
+        index = np.floor(ndist / size)
+        #count only points inside of the grid and not on a border
+        inside = np.all((index >= 0) & (index < n_label) &
+                        (ndist != index * size), axis=1)
+        index = index[inside].astype(int)
+        
+        #count points per intervall in one pass
+        intervalls = np.bincount(index[:, 0] * n_label + index[:, 1],
+                                 minlength=n_label * n_label)
         
         return (intervalls)
     
     #EM algorythmus fit gaussian distributions in given distribution
-    def emAnalyse(self, distribution, n_cgauss):
+    def emAnalyse(self, distribution, n_cgauss, seed=None, model=None, sample_size=None, cache=None):
         """
         Method to analyse a distribution via EM-algorythm. Therefore Gaussian 
         Mixture Models from sklearn is used.
@@ -110,6 +109,15 @@ class GmFit:
             Distribution to be analyzed
         n_cgauss: Type: int 
             number of gaussian distributions to be fitted (number of components)
+        seed: Type: int
+            random state of the fit, not reproducible if None
+        model: Type: FittedModel
+            already fitted model of the distribution, fitted if None
+        sample_size: Type: int
+            number of points the model is fitted on before it is refined on
+            all points, all points are used if None (see FittedModel)
+        cache: Type: FitCache
+            cache of fits consulted before fitting, not used if None
         Returns
         -------
         loc: TYPE: Array of float64 
@@ -123,42 +131,25 @@ class GmFit:
 
         """
         
-        n_stdwX = []
-        n_stdwY = []
+        if model is None:
+            model = fit_cache.fit(cache, distribution, n_cgauss, seed=seed, sample_size=sample_size)
         
-        gmm = GaussianMixture(n_components=n_cgauss)
-        gmm.fit(distribution)
-        
-        loc = gmm.means_
-        covariances = gmm.covariances_
-        weight = gmm.weights_
-
-        #get variables of each components
-        for i in range(0, len(covariances)):
-            
-            dist_matrix = covariances[i]
-            #calculate standard deviations from dispersion matrices
-            stdwX = ((dist_matrix[0])[0]) ** (1/2)
-            stdwY = ((dist_matrix[1])[1]) ** (1/2)
-            
-            n_stdwX.append(stdwX)
-            n_stdwY.append(stdwY)
-            
+        loc = model.means
+        weight = model.weights
+        #standard deviations from the dispersion matrices
+        n_stdwX, n_stdwY = model.stds()
         
         return (loc, n_stdwX, n_stdwY, weight)
     
     #Get differences between distributions generated by parameters from Gaussian
     #Mixture Model and original distribution by fitting n components from
     #1 - n_components.
-    def getDifference(self, distribution, n_components):
+    def getDifference(self, distribution, n_components, seed=None):
         """
         Method to calculate the space between a input distribution and generated 
-        distributiuons. Therefore gaussian distibutions called components, are fit in the original distribution. 
-        The parameters of the components is then used to generate a new distribution.
-        Afterwards the new distribution is compared with the new distribution. To do that 
-        the space between the original and new distribution is calculated.
-        To evaluate the best fit (number of componets) the latter is repeated for 
-        n = 0 to n = n_components.
+        distributiuons for every number of components from 1 to n_components
+        (see referenceDifference). Same as searchComponents with the
+        criterion "knee" without stopping early.
         
         Parameters
         ----------
@@ -167,58 +158,162 @@ class GmFit:
         n_components: TYPE: int
             Max number of components to be fit into the original 
             distribution
+        seed: TYPE: int
+            seed of the fits and the generated distributions, not
+            reproducible if None
 
         Returns
         -------
         all_diffs: TYPE: list of float
             List of all calculated differences
+        models: TYPE: dict of FittedModel
+            fitted model of every number of components, reused for the
+            results and plots of the chosen number
 
         """
+        n, models, all_diffs = GmFit.searchComponents(self, distribution, n_components, seed=seed, tolerance=None)
         
-        all_diffs =[]
+        return (all_diffs, models)
+    
+    def referenceDifference(self, distribution, model, ori_intervalls, seed=None):
+        """
+        Method to calculate the space between the original distribution and a
+        distribution generated from the components of a fitted model.
+
+        Parameters
+        ----------
+        distribution: TYPE: Array of float64
+            Original distribution
+        model: TYPE: FittedModel
+            model fitted into the original distribution
+        ori_intervalls: TYPE: Array of int
+            intervalls of the original distribution (getIntervalls)
+        seed: TYPE: int
+            seed of the generated distribution, combined with the number of
+            components so every model gets its own stream
+
+        Returns
+        -------
+        diff: TYPE: int
+            number of points that differ between the intervalls
+
+        """
         size = len(distribution)
+        rng = np.random.default_rng(None if seed is None else [seed, model.n_components])
         
-        #create distributions from 1 component to n_components
-        for z in range(1, n_components+1):
-            #calculate parameters to generate the distributions
-            n_loc, n_stdwX, n_stdwY, n_weights = GmFit.emAnalyse(self, distribution, n_cgauss=z)
-            reference_distX = []
-            reference_distY = []
+        #calculate parameters to generate the distributions
+        n_loc, n_stdwX, n_stdwY, n_weights = GmFit.emAnalyse(self, distribution, model.n_components, model=model)
         
-            #generate reference distribution from parameter lists 1D
-            for k in range(0, len(n_loc)):
+        #generate reference distribution from the parameters of all
+        #components at once, every component gets int(size * weight)
+        #points around its location cut to int
+        component_sizes = (size * np.asarray(n_weights)).astype(int)
+        locs = np.repeat(np.asarray(n_loc).astype(int), component_sizes, axis=0)
+        stdws = np.repeat(np.column_stack([n_stdwX, n_stdwY]), component_sizes, axis=0)
+        reference_distribution = GmFit.normaldist(self, locs, stdws, locs.shape, rng=rng)
+        
+        #get intervalls of reference distribution
+        new_intervalls = GmFit.getIntervalls(self, reference_distribution, 100)
+        
+        #calculate differences
+        diff = int(np.abs(ori_intervalls - new_intervalls).sum())
+        
+        return diff
+    
+    #Search the number of components in batches of concurrent fits, stop
+    #when the fits do not improve anymore
+    def searchComponents(self, distribution, max_components, criterion="knee", seed=None,
+                         batch_size=BATCH_SIZE, tolerance=TOLERANCE, n_threads=None, sample_size=None,
+                         cache=None):
+        """
+        Method to evaluate the number of components with as few fits as
+        possible. The candidates are fitted in batches of batch_size numbers
+        of components, the fits of a batch run concurrently and are
+        warm-started from the largest model of the previous batch.
+        Every fit gets a score, lower is better: the difference to the
+        generated distribution (criterion "knee", see referenceDifference) or the
+        BIC or AIC of the model. The search stops after a batch that improves
+        the best score by less than tolerance times the improvement reached
+        from 1 component to the previous batch. The first batch has no
+        improvement to compare with, so with 7 candidates and batches of 2
+        (1-2, 3-4, 5-6, 7) the search stops after 4 fits at the earliest.
+        The number of components is then the knee of the differences
+        (evaluate) or the model with the lowest BIC/AIC.
 
-                component_size = int(size * (n_weights[k]))
-                component_locX = int((n_loc[k])[0])
-                component_locY = int((n_loc[k])[1])
-                component_stdwX = n_stdwX[k]
-                component_stdwY = n_stdwY[k]
-                component_distX = GmFit.normaldist(self, component_locX, component_stdwX, component_size)
-                component_distY = GmFit.normaldist(self, component_locY, component_stdwY, component_size)
-                
-                reference_distX.extend(component_distX)
-                reference_distY.extend(component_distY)
+        Parameters
+        ----------
+        distribution: TYPE: Array of float64
+            Original distribution from ATAC and CHIP data
+        max_components: TYPE: int
+            Max number of components to be fit into the distribution
+        criterion: TYPE: str
+            "knee", "bic" or "aic"
+        seed: TYPE: int
+            seed of the fits and the generated distributions, not
+            reproducible if None
+        batch_size: TYPE: int
+            number of candidates fitted concurrently, the results do not
+            depend on the number of cpus
+        tolerance: TYPE: float
+            relative improvement below which the search stops, all
+            max_components candidates are fitted if None
+        n_threads: TYPE: int
+            maximum number of concurrent fits, batch_size or the number of
+            cpus if None
+        sample_size: TYPE: int
+            number of points the candidates are fitted on before they are
+            refined on all points, all points are used if None (see
+            FittedModel)
+        cache: TYPE: FitCache
+            cache of fits consulted before fitting, not used if None
+
+        Returns
+        -------
+        n: TYPE: int
+            number of components
+        models: TYPE: dict of FittedModel
+            fitted model of every tried number of components
+        scores: TYPE: list of float
+            score of every tried number of components, the length is the
+            number of fits performed
+
+        """
+        if criterion not in CRITERIA:
+            raise ValueError("unknown criterion: {0}".format(criterion))
+        distribution = np.asarray(distribution, dtype=float)
+        ori_intervalls = GmFit.getIntervalls(self, distribution, 100)
         
-            #combine X and Y values
-            reference_distribution= []
-            for i in range(0, len(reference_distX)):
-                reference_distribution.append([reference_distX[i],reference_distY[i]])
-            
-            #get intervalls of ori distribution and reference distribution
-            diff = 0
-            ori_intervalls = GmFit.getIntervalls(self, distribution, 100)
-            new_intervalls = GmFit.getIntervalls(self, reference_distribution, 100)
-            
-            #calculate differences
-            for j in range(len(ori_intervalls)):
-                raw_diff = (ori_intervalls[j])-(new_intervalls[j])
-                single_diff = (raw_diff**2)**(1/2)
-                diff = diff + single_diff
+        def fit(z, init):
+            model = fit_cache.fit(cache, distribution, z, seed=seed, init=init, sample_size=sample_size)
+            if criterion == "knee":
+                score = GmFit.referenceDifference(self, distribution, model, ori_intervalls, seed)
+            else:
+                score = getattr(model, criterion)
+            return model, score
         
+        models = {}
+        scores = []
+        init = None
+        n_threads = min(batch_size, n_threads or os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            for start in range(1, max_components + 1, batch_size):
+                batch = range(start, min(start + batch_size, max_components + 1))
+                best = min(scores) if scores else None
+                for z, (model, score) in zip(batch, pool.map(lambda z: fit(z, init), batch)):
+                    models[z] = model
+                    scores.append(score)
+                init = models[batch[-1]]
+                
+                #stop if the batch did not improve the fit noticeably
+                if tolerance is not None and best is not None and best - min(scores) <= tolerance * (scores[0] - best):
+                    break
         
-            all_diffs.append(diff)
+        if criterion == "knee":
+            n = GmFit.evaluate(self, scores)
+        else:
+            n = int(np.argmin(scores)) + 1
         
-        return (all_diffs)
+        return (n, models, scores)
         
     #Evaluate number of components
     def evaluate_by_cutoff(self, all_diffs):
@@ -269,7 +364,7 @@ class GmFit:
         
     # def evaluate_componets(scores_array, max_components):
         
-    #     all_diffs = GmFit().getDifference(scores_array, max_components)
+    #     all_diffs, models = GmFit().getDifference(scores_array, max_components)
         
     #     x, count = GmFit().evaluate(all_diffs)
         
@@ -313,7 +408,7 @@ class GmFit:
     
 #     distribution = 
 
-#     all_diffs = GmFit().getDifference(distribution, n_components)
+#     all_diffs, models = GmFit().getDifference(distribution, n_components)
 #     x = GmFit().evaluate(all_diffs)
 #     # k = GmFit().getknee(all_diffs)
 #     # print("knee: ")
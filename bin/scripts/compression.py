@@ -0,0 +1,105 @@
+"""
+Transparent compression of the text files (DeepBlue exports, bed and
+bedGraph files) in ./data/download/ and ./data/temp/.
+
+A compressed file keeps its name with the ending of the compression added
+(.gz for gzip, .zst for zstd), e.g. [filename]_chunk_1.gz or [name].bed.gz.
+open_text opens plain and compressed files alike as text streams, so the
+files are compressed and decompressed on the fly while they are read or
+written and never expanded on disk. zstd needs the zstandard package, which
+is only imported if a .zst file is opened.
+
+
+Use as follows:
+
+    from scripts.compression import open_text, find_file
+
+    with open_text(find_file("data/download/file.bed")) as file:
+        header = file.readline()
+"""
+
+import io
+import os
+import gzip
+
+SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def compression_of(path):
+    """
+    :param path: path to a file
+    :return: "gzip", "zstd" or None, depending on the ending of the path
+    """
+    for compression, suffix in SUFFIXES.items():
+        if path.endswith(suffix):
+            return compression
+    return None
+
+
+def add_suffix(path, compression):
+    """
+    :param path: path to an uncompressed file
+    :param compression: "gzip", "zstd" or None
+    :return: the path with the ending of the compression
+    """
+    return path + SUFFIXES[compression] if compression else path
+
+
+def strip_suffix(path):
+    """
+    :param path: path to a file
+    :return: the path without the ending of its compression
+    """
+    compression = compression_of(path)
+    return path[:-len(SUFFIXES[compression])] if compression else path
+
+
+def find_file(path):
+    """
+    Finds a file that may be stored compressed.
+
+    :param path: path to the uncompressed file
+    :return: path to the uncompressed or compressed file, or None if neither
+             exists
+    """
+    for candidate in [path] + [path + suffix for suffix in
+                               SUFFIXES.values()]:
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
+def open_text(path, mode="r", compression="auto"):
+    """
+    Opens a plain or compressed text file.
+
+    :param path: path to the file
+    :param mode: "r", "w" or "a"
+    :param compression: "gzip", "zstd", None for an uncompressed file or
+           "auto" to choose by the ending of the path
+    :return: text file object
+    """
+    if compression == "auto":
+        compression = compression_of(path)
+
+    if compression is None:
+        return open(path, mode)
+    if compression == "gzip":
+        return gzip.open(path, mode + "t", compresslevel=GZIP_LEVEL)
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("the zstandard package is needed to read and "
+                              "write .zst files")
+        file = open(path, mode + "b")
+        if mode == "r":
+            stream = zstandard.ZstdDecompressor().stream_reader(file,
+                                                                closefd=True)
+        else:
+            stream = zstandard.ZstdCompressor(
+                level=ZSTD_LEVEL).stream_writer(file, closefd=True)
+        return io.TextIOWrapper(stream)
+    raise ValueError("unknown compression: {0}".format(compression))
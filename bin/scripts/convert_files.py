@@ -0,0 +1,473 @@
+"""
+Validates downloaded files and converts them into the requested filetype.
+
+Goes through the following steps:
+- move the chrom.sizes files into their own folder and strip the .txt ending
+  of the downloaded files
+- find the chunks of large downloads. The chunks are not merged into one file
+  beforehand, but streamed in order with duplicated border lines dropped
+  directly into the conversion of the file.
+- validate the format of every file listed in validation.csv by its header
+- convert .bed/.bedgraph files into .bw in a pool of worker processes. The
+  files are streamed into the bigWig writer and overlapping regions are
+  trimmed on the fly: the start of a region is moved to the largest end of
+  the regions before it, so the earlier region wins (unlike bedRemoveOverlap,
+  which drops the smaller of two overlapping regions). Single-file .bed
+  downloads are hardlinked (or reflinked) into the temp folder instead of
+  copied, see staging.py.
+- write the linking table of the validated files into the temp folder
+
+Downloaded files and chunks may be stored compressed (see compression.py).
+They are decompressed while they are streamed, a .bed file assembled from
+compressed chunks is written with the compression of the chunks and a linked
+.bed file keeps its compression, e.g. [name].bed.gz.
+
+Use as follows:
+
+    from scripts.convert_files import convert_all
+
+    convert_all(filetype, source_path, out_path, csv_name, max_workers)
+"""
+
+import os
+import io
+import re
+import csv
+import logging
+import numpy as np
+import pandas as pd
+import pyBigWig
+from scripts.job_scheduler import run_jobs
+from scripts.staging import stage_file
+from scripts.compression import (open_text, find_file, compression_of,
+                                 add_suffix, strip_suffix)
+
+BEDGRAPH_FORMATS = ["CHROMOSOME,START,END,VALUE"]
+BED_FORMATS = [
+    "CHROMOSOME,START,END,NAME,SCORE,STRAND,SIGNAL_VALUE,P_VALUE,Q_VALUE,PEAK",
+    "CHROMOSOME,START,END,NAME,SCORE,STRAND,SIGNAL_VALUE,P_VALUE,Q_VALUE",
+    "CHROMOSOME,START,END,NAME,SCORE,STRAND,THICK_START,THICK_END,ITEM_RGB",
+    "CHROMOSOME,START,END,NAME,SCORE",
+    "CHROMOSOME,START,END,NAME"]
+
+# number of lines that are parsed and written to the bigWig at once
+BATCH_SIZE = 500000
+
+
+class UnsortedError(Exception):
+    """Raised if the regions of a file are not sorted and can not be
+    streamed into a bigWig file."""
+    pass
+
+
+def convert_all(filetype, source_path, out_path, csv_name, max_workers=None):
+    """
+    Validates and converts all files listed in validation.csv and writes the
+    linking table of the validated files.
+
+    :param filetype: filetype to convert to, only bigwig is supported
+    :param source_path: path to the downloaded data (./data/download/)
+    :param out_path: path to the data folder (./data/), the validated files
+           are put into ./data/temp/
+    :param csv_name: name of the linking table
+    :param max_workers: maximum number of files converted at the same time
+    :return: number of validated files
+    """
+    print("---- File validation ----")
+    print("Some files can take a long time to validate")
+    temp_path = os.path.join(out_path, "temp")
+    chrom_path = os.path.join(out_path, "chromsizes")
+
+    os.makedirs(temp_path, exist_ok=True)
+    prepare_download_folder(source_path, chrom_path)
+    chunks = find_chunks(source_path)
+
+    print("validating files")
+    with open(os.path.join(source_path, "validation.csv"), "r") as csvfile:
+        csv_reader = csv.reader(csvfile, delimiter=";")
+        header = next(csv_reader)
+        rows = list(csv_reader)
+
+    genome = header.index("genome")
+    filename = header.index("filename")
+    file_format = header.index("format")
+
+    jobs = []
+    job_rows = []
+    for row in rows:
+        source_file = find_file(os.path.join(source_path, row[filename]))
+        if source_file is not None:
+            source_files = [source_file]
+        elif row[filename] in chunks:
+            logging.info("assembling {0} from {1} chunks".format(
+                row[filename], len(chunks[row[filename]])))
+            source_files = chunks[row[filename]]
+        else:
+            continue
+        chrom_sizes = os.path.join(chrom_path, row[genome] + ".chrom.sizes")
+        jobs.append([row[filename], validate_convert_file,
+                     [row[filename], source_files, row[file_format], filetype,
+                      chrom_sizes, temp_path]])
+        job_rows.append(row)
+
+    # add the file_path column after data_type to the new linking table
+    new_header = list(header)
+    new_header.insert(header.index("data_type") + 1, "file_path")
+    count = 0
+
+    with open(os.path.join(temp_path, csv_name), "w", newline="") as new_link:
+        csv_writer = csv.writer(new_link, delimiter=";")
+        csv_writer.writerow(new_header)
+
+        for row, result in zip(job_rows, run_jobs(jobs, max_workers,
+                                                  use_processes=True)):
+            if result.returncode != 0:
+                logging.error("{0} could not be converted: {1}".format(
+                    result.name, result.stderr))
+                continue
+            if result.value is None:
+                continue
+
+            bw_file = result.value
+            bed_file = os.path.splitext(bw_file)[0] + ".bed"
+            bed_file = find_file(bed_file) or bed_file
+            # add .bw file and .bed file, both point to the .bw file
+            for new_filename in [os.path.basename(bw_file),
+                                 os.path.basename(bed_file)]:
+                new_row = list(row)
+                new_row[filename] = new_filename
+                new_row.insert(header.index("data_type") + 1, bw_file)
+                csv_writer.writerow(new_row)
+
+            count += 1
+            if not count % 5:
+                print("validated {} files".format(count))
+
+    return count
+
+
+def prepare_download_folder(source_path, chrom_path):
+    """
+    Moves the chrom.sizes files into their own folder and strips the .txt
+    ending of the downloaded files (but not of the .meta.txt files). The
+    ending of a compression is kept, [filename].txt.gz becomes
+    [filename].gz.
+
+    :param source_path: path to the downloaded data
+    :param chrom_path: path to the chrom.sizes folder
+    """
+    os.makedirs(chrom_path, exist_ok=True)
+
+    for file in os.listdir(source_path):
+        file_path = os.path.join(source_path, file)
+        if file.endswith(".chrom.sizes"):
+            os.replace(file_path, os.path.join(chrom_path, file))
+        else:
+            name = strip_suffix(file)
+            if name.endswith(".txt") and not name.endswith(".meta.txt"):
+                os.replace(file_path, os.path.join(
+                    source_path, name[:-len(".txt")] + file[len(name):]))
+
+
+def find_chunks(folder):
+    """
+    Finds the file chunks in a folder. Large files downloaded from Deepblue
+    are split into chunks named [filename]_chunk_[start], which may be
+    compressed.
+
+    :param folder: path to the folder containing the chunks
+    :return: dictionary with the filename as key and the list of paths to its
+             chunks, ordered by chunk start, as value
+    """
+    chunks = {}
+    for file in os.listdir(folder):
+        match = re.match(r"^(.*)_chunk_?(\d+)(\.gz|\.zst)?$", file)
+        if match:
+            chunks.setdefault(match.group(1), []).append(
+                (int(match.group(2)), os.path.join(folder, file)))
+
+    return {filename: [path for _, path in sorted(parts)] for filename, parts
+            in chunks.items()}
+
+
+def iter_lines(source_files):
+    """
+    Streams the lines of a file or of all chunks of a file in order. The
+    header is only kept from the first chunk and lines that are equal to the
+    line before them, like the duplicated regions at the chunk borders, are
+    dropped. Compressed files are decompressed while they are read.
+
+    :param source_files: list of paths to the file or its chunks
+    :return: generator of lines
+    """
+    last_line = None
+    for idx, source_file in enumerate(source_files):
+        with open_text(source_file) as file:
+            header = file.readline()
+            if idx == 0:
+                last_line = header
+                yield header
+            for line in file:
+                if line != last_line:
+                    yield line
+                last_line = line
+
+
+def assemble_chunks(source_files, out_file):
+    """
+    Writes the lines of all chunks of a file into one file, which is
+    compressed if its path ends with .gz or .zst.
+
+    :param source_files: list of paths to the chunks of a file
+    :param out_file: path to the assembled file
+    """
+    tmp_file = out_file + ".tmp"
+    with open_text(tmp_file, "w", compression_of(out_file)) as out:
+        out.writelines(iter_lines(source_files))
+    os.replace(tmp_file, out_file)
+
+
+def validate_filetype(filename, header, file_format):
+    """
+    Validates that the content of a file fits a usable format by comparing
+    the format provided in the linking table. If the file is a bed file the
+    header of the file is looked at to find the column of the signal value,
+    since many files do not actually have the stated format internally.
+
+    :param filename: name of the file to check
+    :param header: first line of the file
+    :param file_format: format of the file content
+    :return: filetype ("bed" or "bedgraph") and index of the value column or
+             None, None if the format is unusable or not recognized
+    """
+    header = header.rstrip("\n").split("\t")
+
+    if file_format in BEDGRAPH_FORMATS:
+        # fix for some bedgraphs not having proper format
+        return "bedgraph", 5 if len(header) == 6 else 3
+
+    if file_format in BED_FORMATS:
+        if "SIGNAL_VALUE" not in header:
+            logging.info("no SIGNAL_VALUE, {} can not be used".format(
+                filename))
+            return None, None
+        return "bed", header.index("SIGNAL_VALUE")
+
+    logging.info("unrecognized file format, {} can not be used".format(
+        filename))
+    return None, None
+
+
+def validate_convert_file(filename, source_files, file_format, filetype,
+                          chrom_sizes, out_path):
+    """
+    Validates a file and converts it into the requested filetype. The file
+    gets a new ending if its content does not fit its filename.
+
+    :param filename: name of the downloaded file
+    :param source_files: list of paths to the downloaded file or its chunks
+    :param file_format: format of the file content from the linking table
+    :param filetype: filetype to convert to
+    :param chrom_sizes: path to the chrom.sizes file of the genome
+    :param out_path: folder to put the validated files into
+    :return: path to the converted file or None if the file can not be used
+    """
+    with open_text(source_files[0]) as file:
+        header = file.readline()
+
+    valid_type, value_index = validate_filetype(filename, header, file_format)
+    if valid_type is None:
+        return None
+
+    new_filename = filename
+    if os.path.splitext(new_filename)[1][1:] != valid_type:
+        new_filename = new_filename + "." + valid_type
+    file_name = os.path.splitext(new_filename)[0]
+
+    if valid_type == "bed":
+        # the bed file itself is needed later on to read the peaks, it is
+        # stored with the compression of the downloaded file
+        bed_file = add_suffix(os.path.join(out_path, new_filename),
+                              compression_of(source_files[0]))
+        if len(source_files) == 1:
+            # the downloaded file is not rewritten, so it is linked
+            # instead of copied
+            stage_file(source_files[0], bed_file)
+        else:
+            assemble_chunks(source_files, bed_file)
+
+    if filetype.lower() not in ["bigwig", "bw"]:
+        logging.error("unexpected filetype: {0} {1}".format(new_filename,
+                                                            filetype))
+        return None
+
+    bw_file = os.path.join(out_path, file_name + ".bw")
+    if not os.path.exists(bw_file):
+        convert_to_bigwig(source_files, value_index, chrom_sizes, bw_file)
+
+    return bw_file
+
+
+def convert_to_bigwig(source_files, value_index, chrom_sizes, bw_file):
+    """
+    Converts a bed or bedgraph file into a bigWig file. The regions are
+    streamed into the bigWig file batch by batch. Only if the regions turn out
+    to be unsorted, the whole file is read and sorted before writing.
+
+    :param source_files: list of paths to the bed/bedgraph file or its chunks
+    :param value_index: index of the column containing the value
+    :param chrom_sizes: path to the chrom.sizes file
+    :param bw_file: path to the bigWig file
+    """
+    sizes = read_chrom_sizes(chrom_sizes)
+
+    try:
+        write_bigwig(iter_regions(iter_lines(source_files), value_index,
+                                  sizes), sizes, bw_file)
+    except UnsortedError:
+        logging.info("unsorted regions found in {}, sorting".format(
+            os.path.basename(bw_file)))
+        regions = pd.concat(list(iter_regions(iter_lines(source_files),
+                                              value_index, sizes)))
+        chrom_rank = {chrom: idx for idx, (chrom, _) in enumerate(sizes)}
+        regions["rank"] = regions["chrom"].map(chrom_rank)
+        regions.sort_values(["rank", "start"], kind="mergesort",
+                            inplace=True)
+        write_bigwig([regions.drop(columns="rank")], sizes, bw_file)
+
+
+def read_chrom_sizes(chrom_sizes):
+    """
+    Reads a chrom.sizes file.
+
+    :param chrom_sizes: path to the chrom.sizes file
+    :return: list of (chromosome, size) tuples
+    """
+    sizes = []
+    with open(chrom_sizes, "r") as file:
+        for line in file:
+            fields = line.split()
+            if len(fields) >= 2:
+                sizes.append((fields[0], int(fields[1])))
+    return sizes
+
+
+def iter_regions(lines, value_index, sizes, batch_size=BATCH_SIZE):
+    """
+    Parses the lines of a bed/bedgraph file batch by batch. The first line is
+    treated as header and skipped, regions of chromosomes that are not part of
+    the genome and regions without value are dropped.
+
+    :param lines: iterable of lines of the file
+    :param value_index: index of the column containing the value
+    :param sizes: list of (chromosome, size) tuples
+    :param batch_size: number of lines parsed at once
+    :return: generator of data frames with the columns chrom, start, end and
+             value
+    """
+    known = set(chrom for chrom, _ in sizes)
+    lines = iter(lines)
+    next(lines, None)
+
+    while True:
+        batch = [line for _, line in zip(range(batch_size), lines)]
+        if not batch:
+            break
+        regions = pd.read_csv(io.StringIO("".join(batch)), sep="\t",
+                              header=None, usecols=[0, 1, 2, value_index],
+                              dtype={0: str})
+        regions.columns = ["chrom", "start", "end", "value"]
+        regions = regions[regions["chrom"].isin(known) &
+                          regions["value"].notna()]
+        if len(regions) > 0:
+            yield regions
+
+
+def write_bigwig(region_batches, sizes, bw_file):
+    """
+    Writes batches of regions into a bigWig file. Overlapping regions are
+    resolved on the fly by trimming the start of a region to the end of the
+    regions before it, regions that are completely covered are dropped.
+
+    :param region_batches: iterable of data frames with the columns chrom,
+           start, end and value
+    :param sizes: list of (chromosome, size) tuples used as header
+    :param bw_file: path to the bigWig file
+    :raises UnsortedError: if the regions are not sorted
+    """
+    chrom_rank = {chrom: idx for idx, (chrom, _) in enumerate(sizes)}
+    tmp_file = bw_file + ".tmp"
+    bw = pyBigWig.open(tmp_file, "w")
+    bw.addHeader(sizes)
+
+    current_rank = -1
+    last_start = 0
+    last_end = 0
+    overlaps = 0
+
+    try:
+        for regions in region_batches:
+            chroms = regions["chrom"].values
+            run_starts = np.flatnonzero(np.append(True, chroms[1:] !=
+                                                  chroms[:-1]))
+            run_ends = np.append(run_starts[1:], len(chroms))
+
+            for run_start, run_end in zip(run_starts, run_ends):
+                chrom = chroms[run_start]
+                starts = regions["start"].values[run_start:run_end].astype(
+                    np.int64)
+                ends = regions["end"].values[run_start:run_end].astype(
+                    np.int64)
+                values = regions["value"].values[run_start:run_end].astype(
+                    np.float64)
+
+                if chrom_rank[chrom] != current_rank:
+                    if chrom_rank[chrom] < current_rank:
+                        raise UnsortedError(chrom)
+                    current_rank = chrom_rank[chrom]
+                    last_start = 0
+                    last_end = 0
+
+                if starts[0] < last_start or np.any(np.diff(starts) < 0):
+                    raise UnsortedError(chrom)
+                last_start = starts[-1]
+
+                starts, ends, values, last_end, removed = remove_overlaps(
+                    starts, ends, values, last_end)
+                overlaps += removed
+
+                if len(starts) > 0:
+                    bw.addEntries([chrom] * len(starts), starts.tolist(),
+                                  ends=ends.tolist(), values=values.tolist())
+    except BaseException:
+        bw.close()
+        os.remove(tmp_file)
+        raise
+
+    bw.close()
+    os.replace(tmp_file, bw_file)
+
+    if overlaps > 0:
+        logging.info("overlap found in {0}, {1} regions trimmed".format(
+            os.path.basename(bw_file), overlaps))
+
+
+def remove_overlaps(starts, ends, values, last_end=0):
+    """
+    Removes overlaps of sorted regions by trimming the start of each region to
+    the largest end of all regions before it.
+
+    :param starts: numpy array of region starts
+    :param ends: numpy array of region ends
+    :param values: numpy array of region values
+    :param last_end: largest end of the regions of the previous batch
+    :return: starts, ends, values without overlaps, the new largest end and
+             the number of regions that had to be trimmed or dropped
+    """
+    previous_ends = np.maximum.accumulate(np.append(last_end, ends))[:-1]
+    trimmed = starts < previous_ends
+    starts = np.maximum(starts, previous_ends)
+    keep = starts < ends
+
+    return (starts[keep], ends[keep], values[keep],
+            max(last_end, int(ends.max())), int(trimmed.sum()))
@@ -0,0 +1,448 @@
+"""
+Python client and downloader for the DeepBlue XML-RPC API.
+
+DeepBlueClient keeps a pool of XML-RPC connections, so several threads can
+send requests at the same time while the number of requests in flight stays
+bounded by the size of the pool. Failed calls are retried with exponential
+backoff.
+
+download_all downloads the files of a linking table like
+download_deepblue_data.r does:
+- ChIP-seq files are downloaded in one request per file
+- ATAC/DNase-seq files are split into chunks of chunk_size bases, regions
+  with the value 0 are filtered out. Every chunk is written into its own file
+  ([filename]_chunk_[start].txt), which convert_files.py streams into the
+  conversion.
+- the number of downloaded regions is compared with the number of regions
+  counted by DeepBlue
+- a [filename].meta.txt file with the metadata of the experiment marks a
+  complete download
+
+With a compression ("gzip" or "zstd") the files and chunks are written
+compressed (e.g. [filename]_chunk_[start].txt.gz), see compression.py.
+
+The chunks are downloaded concurrently. Every finished chunk is recorded in
+a checkpoint manifest ([filename].manifest.json), so an interrupted run
+resumes with the missing chunks only. The manifest is removed once the
+download is complete.
+
+The url of the server can be changed, e.g. to the local stand-in server of
+deepblue_standin.py, which check_deepblue.py uses to check retries and
+resumed downloads.
+
+
+Use as follows:
+
+    from scripts.deepblue import DeepBlueClient, download_all
+
+    client = DeepBlueClient(max_in_flight=4)
+    download_all(client, rows, "data/download")
+"""
+
+import os
+import json
+import time
+import queue
+import logging
+import threading
+import xmlrpc.client as xc
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from scripts.staging import stage_file
+from scripts.compression import (open_text, find_file, add_suffix,
+                                 compression_of)
+
+URL = "https://deepblue.mpi-inf.mpg.de/xmlrpc"
+USER_KEY = "anonymous_key"
+CHUNK_SIZE = 10000000
+
+
+class DeepBlueError(Exception):
+    """Error returned by the DeepBlue server."""
+
+
+class DeepBlueClient:
+    """Pool of XML-RPC connections to the DeepBlue server."""
+
+    def __init__(self, url=URL, user_key=USER_KEY, max_in_flight=4,
+                 retries=5, backoff=1.0, poll_interval=1.0):
+        """
+        :param url: url of the XML-RPC server
+        :param user_key: user key sent with every request
+        :param max_in_flight: maximum number of requests sent at the same time
+        :param retries: number of attempts of a call before it fails
+        :param backoff: seconds to wait after the first failed attempt, the
+               time is doubled after every further attempt
+        :param poll_interval: seconds between two status requests while
+               waiting for a request
+        """
+        self.url = url
+        self.user_key = user_key
+        self.retries = retries
+        self.backoff = backoff
+        self.poll_interval = poll_interval
+        self.connections = queue.Queue()
+        for _ in range(max(1, max_in_flight)):
+            self.connections.put(xc.ServerProxy(url, encoding="UTF-8",
+                                                allow_none=True))
+
+    @contextmanager
+    def connection(self):
+        """Context manager borrowing a connection of the pool."""
+        server = self.connections.get()
+        try:
+            yield server
+        finally:
+            self.connections.put(server)
+
+    def call(self, function, *args):
+        """
+        Calls a function of the API. The user key is added to the arguments.
+
+        :param function: name of the function
+        :param args: arguments of the function
+        :return: result of the function
+        :raises DeepBlueError: if the server returned an error
+        """
+        with self.connection() as server:
+            status, result = getattr(server, function)(*args, self.user_key)
+        if status != "okay":
+            raise DeepBlueError("{0}: {1}".format(function, result))
+        return result
+
+    def call_with_retries(self, function, *args):
+        """
+        Calls a function of the API and retries it with exponential backoff
+        if it fails.
+
+        :param function: name of the function
+        :param args: arguments of the function
+        :return: result of the function
+        """
+        return retry(lambda: self.call(function, *args), self.retries,
+                     self.backoff)
+
+    def request_data(self, request_id):
+        """
+        Waits until a request is processed and returns its data.
+
+        :param request_id: id of the request
+        :return: data of the request
+        :raises DeepBlueError: if the request failed or was removed
+        """
+        while True:
+            state = self.call("info", request_id)[0]["state"]
+            if state == "done":
+                break
+            if state in ["failed", "removed", "canceled"]:
+                raise DeepBlueError("request {0} is {1}".format(request_id,
+                                                                state))
+            time.sleep(self.poll_interval)
+        return self.call("get_request_data", request_id)
+
+    def count_regions(self, query_id):
+        """
+        Counts the regions of a query.
+
+        :param query_id: id of the query
+        :return: number of regions
+        """
+        count = self.request_data(self.call("count_regions", query_id))
+        if isinstance(count, dict):
+            count = count["count"]
+        return int(count)
+
+
+def retry(function, attempts, backoff):
+    """
+    Calls a function until it succeeds, waiting twice as long after every
+    failed attempt.
+
+    :param function: function without arguments
+    :param attempts: maximum number of attempts
+    :param backoff: seconds to wait after the first failed attempt
+    :return: result of the function
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return function()
+        except (DeepBlueError, OSError, xc.Error) as err:
+            if attempt == attempts:
+                raise
+            logging.warning("attempt {0} of {1} failed: {2}".format(
+                attempt, attempts, err))
+            time.sleep(backoff * 2 ** (attempt - 1))
+
+
+def download_all(client, rows, out_dir, chunk_size=CHUNK_SIZE,
+                 local_dir=None, compression=None):
+    """
+    Downloads all files of the linking table that have not been downloaded
+    yet.
+
+    :param client: DeepBlueClient
+    :param rows: list of dictionaries with the rows of the linking table
+    :param out_dir: path to the download folder
+    :param chunk_size: size of the chunks of ATAC/DNase-seq files in bases
+    :param local_dir: path to a folder with already downloaded files, which
+           are linked into the download folder instead of downloaded
+    :param compression: "gzip" or "zstd" to write the files compressed,
+           None to write plain text
+    :return: number of files that were downloaded (or linked)
+    :raises DeepBlueError: if some files could not be downloaded
+    """
+    os.makedirs(out_dir, exist_ok=True)
+
+    # an existing [filename].meta.txt file flags a downloaded file
+    queued = [row for row in rows if not os.path.exists(
+        os.path.join(out_dir, row["filename"] + ".meta.txt"))]
+    print("{0} of {1} files need to be downloaded".format(len(queued),
+                                                          len(rows)))
+
+    copied = 0
+    if local_dir is not None and len(queued) > 0:
+        local = link_local_files(queued, local_dir, out_dir)
+        queued = [row for row in queued if row["filename"] not in local]
+        copied = len(local)
+
+    if len(queued) == 0:
+        return copied
+
+    chrom_sizes = {}
+    for genome in set(row["genome"] for row in queued):
+        chrom_sizes[genome] = dict(
+            (chrom, int(size)) for chrom, size in
+            client.call_with_retries("chromosomes", genome))
+
+    downloads = [Download(client, row, out_dir, chunk_size,
+                          chrom_sizes[row["genome"]].get(row["chromosome"]),
+                          compression)
+                 for row in queued]
+
+    # all chunks of all files share the pool of the client, which bounds the
+    # number of requests in flight
+    chunks = [(download, start) for download in downloads
+              for start in download.missing_chunks()]
+    print("downloading {0} chunks of {1} files".format(len(chunks),
+                                                       len(downloads)))
+
+    with ThreadPoolExecutor(
+            max_workers=max(1, client.connections.qsize())) as executor:
+        futures = [executor.submit(download.download_chunk, start) for
+                   download, start in chunks]
+        for count, future in enumerate(futures, 1):
+            try:
+                future.result()
+            except Exception as err:
+                download, start = chunks[count - 1]
+                download.failed = True
+                logging.error("{0}: chunk {1} could not be downloaded: "
+                              "{2}".format(download.filename, start, err))
+            if not count % 10:
+                print("downloaded {0} of {1} chunks".format(count,
+                                                            len(chunks)))
+
+    failed = []
+    for download in downloads:
+        if download.failed:
+            failed.append(download.filename)
+        else:
+            download.finish()
+
+    if failed:
+        raise DeepBlueError("Download of {0} file(s) could not be completed: "
+                            "{1}".format(len(failed), ", ".join(failed)))
+
+    return copied + len(downloads)
+
+
+def link_local_files(rows, local_dir, out_dir):
+    """
+    Links the files of experiments that were already downloaded into an
+    external folder into the download folder.
+
+    :param rows: list of dictionaries with the rows of the linking table
+    :param local_dir: path to the external folder
+    :param out_dir: path to the download folder
+    :return: set of the filenames that were found
+    """
+    if not os.path.isdir(local_dir):
+        logging.warning("{0}: directory not found".format(local_dir))
+        return set()
+
+    names = os.listdir(local_dir)
+    found = set()
+    for row in rows:
+        if row["filename"] + ".meta.txt" not in names:
+            continue
+        for name in names:
+            if name.startswith(row["filename"]) and not os.path.exists(
+                    os.path.join(out_dir, name)):
+                stage_file(os.path.join(local_dir, name),
+                           os.path.join(out_dir, name))
+        found.add(row["filename"])
+
+    print("found {0} experiment(s) in {1}".format(len(found), local_dir))
+    return found
+
+
+class Download:
+    """Download of one file of the linking table."""
+
+    def __init__(self, client, row, out_dir, chunk_size, chrom_size,
+                 compression=None):
+        """
+        :param client: DeepBlueClient
+        :param row: dictionary with the row of the linking table
+        :param out_dir: path to the download folder
+        :param chunk_size: size of the chunks in bases
+        :param chrom_size: size of the chromosome, needed for the chunks
+        :param compression: "gzip", "zstd" or None
+        """
+        self.client = client
+        self.row = row
+        self.filename = row["filename"]
+        self.out_dir = out_dir
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.failed = False
+        self.lock = threading.Lock()
+        self.manifest_path = os.path.join(out_dir, self.filename +
+                                          ".manifest.json")
+
+        # chunk 0 is the whole chromosome without filtering, like ChIP-seq
+        # files are downloaded
+        if row["technique"].lower() == "chip-seq" or chrom_size is None:
+            self.chunks = [0]
+        else:
+            self.chunks = list(range(1, chrom_size + 1, chunk_size))
+
+        self.manifest = {"chunks": {}}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r") as file:
+                self.manifest = json.load(file)
+
+    def chunk_name(self, start):
+        """
+        :param start: start of the chunk
+        :return: name of the uncompressed file of the chunk
+        """
+        if len(self.chunks) > 1:
+            return "{0}_chunk_{1}.txt".format(self.filename, start)
+        return self.filename + ".txt"
+
+    def chunk_file(self, start):
+        """
+        :param start: start of the chunk
+        :return: path to the file of the chunk
+        """
+        return add_suffix(os.path.join(self.out_dir, self.chunk_name(start)),
+                          self.compression)
+
+    def missing_chunks(self):
+        """
+        :return: list of the starts of the chunks that were not downloaded
+                 in a previous run
+        """
+        missing = []
+        for start in self.chunks:
+            regions = self.manifest["chunks"].get(str(start))
+            # chunks of an earlier run may be stored with another
+            # compression
+            if regions is None or (regions > 0 and find_file(os.path.join(
+                    self.out_dir, self.chunk_name(start))) is None):
+                missing.append(start)
+        return missing
+
+    def download_chunk(self, start):
+        """
+        Downloads a chunk with retries and records it in the manifest.
+
+        :param start: start of the chunk, 0 for the whole chromosome
+        """
+        regions = retry(lambda: self.request_chunk(start),
+                        self.client.retries, self.client.backoff)
+
+        with self.lock:
+            self.manifest["chunks"][str(start)] = regions
+            tmp_file = self.manifest_path + ".tmp"
+            with open(tmp_file, "w") as file:
+                json.dump(self.manifest, file)
+            os.replace(tmp_file, self.manifest_path)
+
+    def request_chunk(self, start):
+        """
+        Requests the regions of a chunk and writes them into the chunk file.
+
+        :param start: start of the chunk, 0 for the whole chromosome
+        :return: number of regions
+        :raises DeepBlueError: if the number of regions does not match
+        """
+        client = self.client
+        row = self.row
+        if start > 0:
+            query_id = client.call("select_experiments",
+                                   row["experiment_id"], row["chromosome"],
+                                   start, start + self.chunk_size)
+            query_id = client.call("filter_regions", query_id, "VALUE", "!=",
+                                   "0", "number")
+            expected = client.count_regions(query_id)
+            if expected == 0:
+                # no data for the chunk
+                return 0
+        else:
+            query_id = client.call("select_experiments",
+                                   row["experiment_id"], row["chromosome"],
+                                   None, None)
+            expected = int(row["regions"])
+
+        data = client.request_data(client.call("get_regions", query_id,
+                                               row["format"]))
+        lines = [line for line in data.split("\n") if line]
+        if len(lines) != expected:
+            raise DeepBlueError("regions mismatch: {0} regions expected, {1} "
+                                "downloaded".format(expected, len(lines)))
+
+        write_regions(lines, row["format"], self.chunk_file(start))
+        return len(lines)
+
+    def finish(self):
+        """
+        Writes the .meta.txt file, which marks the download as complete, and
+        removes the manifest.
+        """
+        metadata = self.client.call_with_retries("info",
+                                                 self.row["experiment_id"])[0]
+        with open(os.path.join(self.out_dir, self.filename + ".meta.txt"),
+                  "w") as file:
+            for key, value in sorted(metadata.items()):
+                file.write("{0}\t{1}\n".format(key, json.dumps(value)))
+        if os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
+
+
+def write_regions(lines, file_format, out_file):
+    """
+    Writes regions returned by DeepBlue into a tab separated file with the
+    layout of deepblue_export_tab: seqnames, 1-based start, end, width,
+    strand and the remaining columns of the format.
+
+    :param lines: list of tab separated lines with the columns of the format
+    :param file_format: String with the comma separated columns
+    :param out_file: path to the file, it is compressed if the path ends
+           with .gz or .zst
+    """
+    columns = file_format.split(",")
+    header = ["seqnames", "start", "end", "width", "strand"] + columns[3:]
+
+    tmp_file = out_file + ".tmp"
+    with open_text(tmp_file, "w", compression_of(out_file)) as file:
+        file.write("\t".join(header) + "\n")
+        for line in lines:
+            values = line.split("\t")
+            start = int(values[1]) + 1
+            end = int(values[2])
+            file.write("\t".join([values[0], str(start), str(end),
+                                  str(end - start + 1), "*"] +
+                                 values[3:]) + "\n")
+    os.replace(tmp_file, out_file)
@@ -0,0 +1,234 @@
+"""
+Local stand-in for the DeepBlue XML-RPC server.
+
+StandInServer serves the functions of the DeepBlue API that deepblue.py,
+linking_table.py and vocabulary.py use on a local port, answering from a
+small set of experiments held in memory. Requests are processed right away,
+every request is "done" when its state is asked for. Every call is recorded
+in calls, and fail makes the next calls of a function fail, so retries and
+interrupted downloads can be checked without the real server (see
+check_deepblue.py).
+
+An experiment is a dictionary with the metadata DeepBlue returns by info
+(_id, name, genome, technique, epigenetic_mark, sample_info, format, ...)
+and "regions", a list of (chromosome, start, end, value) tuples with 0-based
+starts.
+
+
+Use as follows:
+
+    from scripts.deepblue import DeepBlueClient
+    from scripts.deepblue_standin import StandInServer
+
+    with StandInServer({"hg19": {"chr1": 1000}}, experiments) as server:
+        server.fail("get_regions", 1)
+        client = DeepBlueClient(url=server.url, backoff=0)
+"""
+
+import threading
+import socketserver
+from xmlrpc.server import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+
+
+class ThreadingXMLRPCServer(socketserver.ThreadingMixIn, SimpleXMLRPCServer):
+    """XML-RPC server handling every request in its own thread."""
+    daemon_threads = True
+
+
+class StandInServer:
+    """DeepBlue API on a local port, served from memory."""
+
+    def __init__(self, genomes, experiments):
+        """
+        :param genomes: dictionary {genome: {chromosome: size}}
+        :param experiments: list of experiment dictionaries (see above)
+        """
+        self.genomes = genomes
+        self.experiments = experiments
+        self.calls = []
+        self.failures = []
+        self.queries = {}
+        self.requests = {}
+        self.lock = threading.Lock()
+
+        class Handler(SimpleXMLRPCRequestHandler):
+            rpc_paths = ("/xmlrpc",)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingXMLRPCServer(("127.0.0.1", 0), Handler,
+                                            allow_none=True,
+                                            logRequests=False)
+        self.server.register_instance(self)
+        self.url = "http://127.0.0.1:{0}/xmlrpc".format(
+            self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.server.shutdown()
+        self.server.server_close()
+        return False
+
+    def fail(self, function, times=1, when=None):
+        """
+        Makes the next calls of a function fail with an error status.
+
+        :param function: name of the function
+        :param times: number of calls that fail
+        :param when: function of the arguments of a call (without the user
+               key), only calls for which it returns True fail; all calls if
+               None
+        """
+        with self.lock:
+            self.failures.append([function, times, when])
+
+    def count(self, function, when=None):
+        """
+        :param function: name of the function
+        :param when: function of the arguments, only matching calls are
+               counted if given
+        :return: number of calls of the function
+        """
+        return sum(1 for name, args in self.calls if name == function and
+                   (when is None or when(*args)))
+
+    def _dispatch(self, method, params):
+        """Called by SimpleXMLRPCServer for every request."""
+        # the last argument is the user key
+        args = list(params[:-1])
+        with self.lock:
+            self.calls.append((method, args))
+            for failure in self.failures:
+                name, times, when = failure
+                if name == method and times > 0 and (when is None or
+                                                     when(*args)):
+                    failure[1] -= 1
+                    return ["error", "stand-in failure of " + method]
+        if method.startswith("_") or not hasattr(self, "api_" + method):
+            return ["error", "unknown function " + method]
+        try:
+            return ["okay", getattr(self, "api_" + method)(*args)]
+        except (KeyError, ValueError) as err:
+            return ["error", "{0}: {1}".format(method, err)]
+
+    def experiment(self, name_or_id):
+        """
+        :return: experiment with the given _id or name
+        """
+        for experiment in self.experiments:
+            if name_or_id in (experiment["_id"], experiment["name"]):
+                return experiment
+        raise KeyError(name_or_id)
+
+    def new_id(self, table, prefix, value):
+        """
+        Stores a query or request.
+
+        :return: its new id
+        """
+        with self.lock:
+            key = "{0}{1}".format(prefix, len(table) + 1)
+            table[key] = value
+        return key
+
+    def regions(self, query_id):
+        """
+        :return: regions of a query, sorted
+        """
+        query = self.queries[query_id]
+        experiment = self.experiment(query["experiment"])
+        regions = [region for region in experiment["regions"]
+                   if region[0] == query["chromosome"] and
+                   (query["start"] is None or
+                    query["start"] <= region[1] < query["end"])]
+        if query["nonzero"]:
+            regions = [region for region in regions if region[3] != 0]
+        return sorted(regions)
+
+    # functions of the API, called with the arguments of the request
+
+    def api_chromosomes(self, genome):
+        return [[chrom, size] for chrom, size in
+                self.genomes[genome.lower()].items()]
+
+    def api_list_genomes(self):
+        return [["g{0}".format(i), genome] for i, genome in
+                enumerate(self.genomes, 1)]
+
+    def api_list_biosources(self, *args):
+        names = sorted(set(experiment["sample_info"]["biosource_name"]
+                           for experiment in self.experiments))
+        return [["bs{0}".format(i), name] for i, name in
+                enumerate(names, 1)]
+
+    def api_list_epigenetic_marks(self, *args):
+        names = sorted(set(experiment["epigenetic_mark"]
+                           for experiment in self.experiments))
+        return [["em{0}".format(i), name] for i, name in
+                enumerate(names, 1)]
+
+    def api_list_experiments(self, genome, experiment_type, marks,
+                             biosources, sample, technique, project):
+        def matches(value, allowed):
+            if allowed is None:
+                return True
+            if not isinstance(allowed, list):
+                allowed = [allowed]
+            return value.lower() in [x.lower() for x in allowed]
+
+        found = [[experiment["_id"], experiment["name"]]
+                 for experiment in self.experiments
+                 if experiment["genome"].lower() == genome.lower() and
+                 matches(experiment.get("data_type"), experiment_type) and
+                 matches(experiment["epigenetic_mark"], marks) and
+                 matches(experiment["sample_info"]["biosource_name"],
+                         biosources) and
+                 matches(experiment["technique"], technique)]
+        # like DeepBlue, a message instead of an empty list
+        return found or "no experiments found"
+
+    def api_info(self, ids):
+        if isinstance(ids, list):
+            return [self.info(x) for x in ids]
+        return [self.info(ids)]
+
+    def info(self, key):
+        if key in self.requests:
+            return {"_id": key, "state": "done"}
+        experiment = dict(self.experiment(key))
+        del experiment["regions"]
+        return experiment
+
+    def api_select_experiments(self, name_or_id, chromosome, start, end):
+        self.experiment(name_or_id)
+        return self.new_id(self.queries, "q", {
+            "experiment": name_or_id, "chromosome": chromosome,
+            "start": start, "end": end, "nonzero": False})
+
+    def api_filter_regions(self, query_id, field, operation, value,
+                           value_type):
+        if (field, operation, value) != ("VALUE", "!=", "0"):
+            raise ValueError("only VALUE != 0 is supported")
+        return self.new_id(self.queries, "q", dict(self.queries[query_id],
+                                                   nonzero=True))
+
+    def api_count_regions(self, query_id):
+        return self.new_id(self.requests, "r", {
+            "count": len(self.regions(query_id))})
+
+    def api_get_regions(self, query_id, file_format):
+        columns = file_format.split(",")
+        if columns[:3] != ["CHROMOSOME", "START", "END"]:
+            raise ValueError("unsupported format " + file_format)
+        lines = ["\t".join(str(x) for x in region[:len(columns)])
+                 for region in self.regions(query_id)]
+        return self.new_id(self.requests, "r", "\n".join(lines))
+
+    def api_get_request_data(self, request_id):
+        return self.requests[request_id]
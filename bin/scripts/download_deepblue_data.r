@@ -230,8 +230,8 @@ export_from_csv <- function(csv_file,out_dir,genom,bios,chroms,marks,chunk_size,
   # --check_local_files <directory>
   # Meant to reduce download queue if files already exist inside an external
   # directory. Checks for *.meta.txt files corresponding to the filenames in
-  # queue and copies them to the (-o)uput directory together with the actual
-  # files if they exist.
+  # queue and links (or copies) them to the (-o)uput directory together with
+  # the actual files if they exist.
   
   if(nrow(queued_files) > 0 && !is.null(local_dir)) {
     if(dir.exists(local_dir)) {
@@ -245,8 +245,19 @@ export_from_csv <- function(csv_file,out_dir,genom,bios,chroms,marks,chunk_size,
           allfiles <- dir(path=local_dir,pattern=paste("^",experiment,sep=""))
           for(single_file in allfiles) {
             output_file <- file.path(local_dir,single_file)
-            message(paste("copying",output_file))
-            file.copy(output_file,out_dir)
+            target_file <- file.path(out_dir,single_file)
+            if(file.exists(target_file)) next
+            # hardlink the file if the local directory is on the same
+            # filesystem, otherwise try a copy-on-write clone (reflink) and
+            # only copy the bytes if neither is supported
+            if(suppressWarnings(file.link(output_file,target_file))) {
+              message(paste("linking",output_file))
+            } else if(system2("cp",c("--reflink=auto",shQuote(output_file),shQuote(target_file)),stderr=FALSE) == 0) {
+              message(paste("cloning",output_file))
+            } else {
+              message(paste("copying",output_file))
+              file.copy(output_file,out_dir)
+            }
           }
           files_copied <- TRUE
         }
@@ -6,11 +6,9 @@ Created on Mon Dec 14 22:51:02 2020
 @author: jan
 """
 import numpy as np
-from sklearn.mixture import GaussianMixture
 import pandas as pd
 import pickle
-import matplotlib.pyplot as plt
-from scipy.stats import gaussian_kde
+from scripts import fit_cache
 
 class EMA:
     
@@ -53,7 +51,7 @@ class EMA:
     #         return (scoresarray)
     
     #Perform Gaussian Mixture Model //NOT THE FINAL VERSION SOME PLUGINS MISSING
-    def emAnalyse(self, X_train, n_cgauss):
+    def emAnalyse(self, X_train, n_cgauss, seed=None, model=None, sample_size=None, init=None, cache=None):
         """
         This Method is used for the final analysing step, using the evaluated 
         number of components. Therefore Gaussian Mixture Models from sklearn is
@@ -66,6 +64,19 @@ class EMA:
             Distribution to be analysed 
         n_cgauss : TYPE: Integer
             Number of components for the fit
+        seed : TYPE: Integer
+            Random state of the fit, not reproducible if None
+        model : TYPE: FittedModel
+            Already fitted model of X_train with n_cgauss components, fitted
+            if None
+        sample_size : TYPE: Integer
+            Number of points the model is fitted on before it is refined on
+            all points, all points are used if None (see FittedModel)
+        init : TYPE: FittedModel
+            Previous solution, e.g. loaded by FittedModel.load, the fit is
+            warm-started from (incremental mode), started from k-means if None
+        cache : TYPE: FitCache
+            Cache of fits consulted before fitting, not used if None
 
         Returns
         -------
@@ -74,12 +85,12 @@ class EMA:
             fitted component.
 
         """
-        gmm = GaussianMixture(n_components=n_cgauss)
-        gmm.fit(X_train)
+        if model is None:
+            model = fit_cache.fit(cache, X_train, n_cgauss, seed=seed, init=init, sample_size=sample_size)
         
-        means = gmm.means_
-        covariances = gmm.covariances_
-        weights = gmm.weights_
+        means = model.means
+        covariances = model.covariances
+        weights = model.weights
         
         data_array = []
         
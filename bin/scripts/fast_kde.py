@@ -0,0 +1,221 @@
+"""
+Fast 2D kernel density estimate of the ATAC/ChIP scores.
+
+scipy.stats.gaussian_kde evaluated at every point takes O(n^2), hours for a
+few hundred thousand points. density computes the same estimate (gaussian
+kernel with the covariance of the points scaled by Scott's factor) on a
+grid: the points are linearly binned onto the grid nodes, the bins are
+convolved with the kernel by FFT and the density is interpolated back to the
+points bilinearly. This takes O(n + g^2 log g). Up to EXACT_LIMIT points
+gaussian_kde is used as before, since it is fast enough and exact.
+
+Binning and interpolation are only accurate if the grid is much finer than
+the kernel, so the distance of the nodes is at most 1/STEPS_PER_BANDWIDTH of
+the bandwidth. The grid covers the bulk of the points, between the TAIL and
+1 - TAIL quantiles of every axis plus the reach of the kernel. Outliers
+beyond it would stretch the grid over mostly empty space, their
+contributions are summed exactly instead. If the bulk still needs more than
+MAX_GRID nodes per axis, the density is evaluated exactly (slow).
+
+The density is computed once per transcription factor and shared by the
+density scatter, the contour plot and the csv of the scores. density_grid
+gives the density on a regular grid, for surface plots of many points.
+check_fast_kde.py compares the estimate with gaussian_kde.
+
+
+Use as follows:
+
+    from scripts.fast_kde import density
+
+    z = density(distribution)
+"""
+
+import logging
+import numpy as np
+from scipy.signal import fftconvolve
+from scipy.spatial import cKDTree
+from scipy.stats import gaussian_kde
+
+EXACT_LIMIT = 5000
+# least number of grid nodes per axis
+GRID_SIZE = 512
+# most number of grid nodes per axis before the exact evaluation is used
+MAX_GRID = 2048
+# grid nodes per bandwidth (standard deviation of the kernel)
+STEPS_PER_BANDWIDTH = 4
+# share of the points on either side of an axis that may lie beyond the grid
+TAIL = 0.001
+# the kernel is cut off at this many standard deviations
+TRUNCATE = 4
+# kernel_sum leaves out the pairs further apart than this many standard
+# deviations, their kernels are below 1e-8 of the peak
+CUTOFF = 6
+
+
+def density(points, grid_size=GRID_SIZE, exact_limit=EXACT_LIMIT):
+    """
+    Density of the kernel density estimate of the points at the points.
+
+    :param points: Array of n float64 vectors (x, y)
+    :param grid_size: least number of grid nodes per axis
+    :param exact_limit: largest number of points gaussian_kde is evaluated
+           at exactly
+    :return: Array of n float64 densities
+    """
+    points = np.asarray(points, dtype=float)
+    if len(points) <= exact_limit:
+        xy = points.T
+        return gaussian_kde(xy)(xy)
+    return evaluate(points, points, grid_size)
+
+
+def density_grid(points, grid_size):
+    """
+    Density of the kernel density estimate of the points on a regular grid
+    over their range, e.g. for a surface plot of fixed resolution.
+
+    :param points: Array of n float64 vectors (x, y)
+    :param grid_size: number of grid nodes per axis
+    :return: tuple of the Arrays of the x and y coordinates of the nodes and
+             the grid_size x grid_size Array of the densities, indexed [x, y]
+    """
+    points = np.asarray(points, dtype=float)
+    x, y = [np.linspace(low, high, grid_size) for low, high in
+            zip(points.min(axis=0), points.max(axis=0))]
+    nodes = np.stack(np.meshgrid(x, y, indexing="ij"), axis=-1)
+    z = evaluate(points, nodes.reshape(-1, 2))
+    return x, y, z.reshape(grid_size, grid_size)
+
+
+def evaluate(points, targets, grid_size=GRID_SIZE):
+    """
+    Density of the kernel density estimate of the points (same kernel as
+    gaussian_kde with bw_method="scott") at the targets.
+
+    :param points: Array of n float64 vectors (x, y)
+    :param targets: Array of float64 vectors (x, y) to evaluate at
+    :param grid_size: least number of grid nodes per axis
+    :return: Array of the float64 densities at the targets
+    """
+    n, dims = points.shape
+    factor = n ** (-1 / (dims + 4))
+    covariance = np.cov(points.T) * factor ** 2
+    bandwidth = np.sqrt(np.diag(covariance))
+    if np.any(bandwidth == 0):
+        # all points on a line, the kernel is singular like in gaussian_kde
+        return gaussian_kde(points.T)(targets.T)
+    inverse = np.linalg.inv(covariance)
+    norm = 1 / np.sqrt(np.linalg.det(2 * np.pi * covariance))
+
+    # the grid spans the bulk of the points and the reach of their kernels
+    k = int(TAIL * (n - 1))
+    reach = TRUNCATE * bandwidth
+    low = np.array([np.partition(points[:, i], k)[k]
+                    for i in range(dims)]) - reach
+    high = np.array([np.partition(points[:, i], n - 1 - k)[n - 1 - k]
+                     for i in range(dims)]) + reach
+    shape = np.maximum(np.ceil((high - low) / bandwidth *
+                               STEPS_PER_BANDWIDTH).astype(int) + 1,
+                       grid_size)
+    if np.any(shape > MAX_GRID):
+        logging.warning("the kernel is too narrow for a grid of {0} x {1} "
+                        "nodes, the density of {2} points is evaluated "
+                        "exactly".format(*shape, n))
+        return gaussian_kde(points.T)(targets.T)
+    step = (high - low) / (shape - 1)
+
+    inside = within(points, low, high)
+    grid = bin_linear((points[inside] - low) / step, shape)
+
+    # kernel on the grid offsets up to TRUNCATE standard deviations
+    offsets = np.meshgrid(*[np.arange(-r, r + 1) * s for r, s in zip(
+        np.minimum(np.ceil(reach / step), shape - 1).astype(int), step)],
+        indexing="ij")
+    offsets = np.stack(offsets, axis=-1)
+    kernel = norm * np.exp(-0.5 * np.einsum("...i,ij,...j->...", offsets,
+                                            inverse, offsets))
+    smoothed = fftconvolve(grid, kernel, mode="same")
+
+    # the outliers contribute exactly, targets beyond the grid get the sum
+    # over all points
+    outliers = points[~inside]
+    covered = within(targets, low, high)
+    values = np.empty(len(targets))
+    values[covered] = (interpolate_linear(smoothed,
+                                          (targets[covered] - low) / step) +
+                       kernel_sum(targets[covered], outliers, inverse, norm))
+    values[~covered] = kernel_sum(targets[~covered], points, inverse, norm)
+    return values / n
+
+
+def within(points, low, high):
+    """
+    :return: boolean Array, True for the points inside the box [low, high]
+    """
+    return np.all((points >= low) & (points <= high), axis=1)
+
+
+def kernel_sum(targets, sources, inverse, norm):
+    """
+    Sum of the gaussian kernels centered at the sources, evaluated exactly at
+    every target. Only the pairs closer than CUTOFF standard deviations are
+    summed, they are found with a KD-tree in coordinates in which the kernel
+    is the standard normal distribution.
+
+    :param targets: Array of float64 vectors
+    :param sources: Array of float64 vectors
+    :param inverse: inverse of the covariance of the kernel
+    :param norm: normalization factor of the kernel
+    :return: Array of the summed kernels at the targets
+    """
+    values = np.zeros(len(targets))
+    if len(targets) == 0 or len(sources) == 0:
+        return values
+    whiten = np.linalg.cholesky(inverse)
+    pairs = cKDTree(targets @ whiten).sparse_distance_matrix(
+        cKDTree(sources @ whiten), CUTOFF, output_type="ndarray")
+    values += np.bincount(pairs["i"], weights=norm * np.exp(
+        -0.5 * pairs["v"] ** 2), minlength=len(targets))
+    return values
+
+
+def bin_linear(position, shape):
+    """
+    Distributes every point onto the four surrounding grid nodes, weighted by
+    its distance to them.
+
+    :param position: Array of float64 vectors in grid coordinates
+    :param shape: number of grid nodes per axis
+    :return: Array of the summed weights with the given shape
+    """
+    cell = np.minimum(np.floor(position).astype(int), np.asarray(shape) - 2)
+    fraction = position - cell
+    grid = np.zeros(shape[0] * shape[1])
+    for dx in (0, 1):
+        for dy in (0, 1):
+            weight = ((fraction[:, 0] if dx else 1 - fraction[:, 0]) *
+                      (fraction[:, 1] if dy else 1 - fraction[:, 1]))
+            grid += np.bincount((cell[:, 0] + dx) * shape[1] + cell[:, 1] +
+                                dy, weights=weight,
+                                minlength=shape[0] * shape[1])
+    return grid.reshape(shape)
+
+
+def interpolate_linear(grid, position):
+    """
+    Bilinear interpolation of grid values at the points.
+
+    :param grid: Array of values on the grid nodes
+    :param position: Array of float64 vectors in grid coordinates
+    :return: Array of the interpolated values
+    """
+    cell = np.minimum(np.floor(position).astype(int),
+                      np.asarray(grid.shape) - 2)
+    fraction = position - cell
+    values = np.zeros(len(position))
+    for dx in (0, 1):
+        for dy in (0, 1):
+            weight = ((fraction[:, 0] if dx else 1 - fraction[:, 0]) *
+                      (fraction[:, 1] if dy else 1 - fraction[:, 1]))
+            values += weight * grid[cell[:, 0] + dx, cell[:, 1] + dy]
+    return values
@@ -0,0 +1,134 @@
+"""
+Content-hashed cache of fitted Gaussian Mixture Models.
+
+A fit is identified by a hash of the distribution, the number of
+components, the seed, the model it is warm-started from, the subsampling
+and the parameters and version of sklearn. The fitted parameters are kept in
+results/fit_cache/ (see FittedModel.save), so running an analysis again on
+the same scores, e.g. with other plots or another output path, takes the
+models from the cache instead of fitting them again. Fits without a seed are
+cached as well, a re-run gives the same random fit.
+
+The entries are small .npz files that are written atomically, so the cache
+can be shared by the processes and threads of an analysis. Delete the
+directory to empty it.
+
+
+Use as follows:
+
+    from scripts.fit_cache import FitCache, fit
+
+    cache = FitCache("results/fit_cache")
+    model = cache.fit(distribution, 3, seed=0)
+
+    # same, fits without caching if cache is None
+    model = fit(cache, distribution, 3, seed=0)
+"""
+
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+import sklearn
+from sklearn.mixture import GaussianMixture
+from scripts.fitted_model import FittedModel, REFINE_STEPS
+
+
+class FitCache:
+
+    def __init__(self, directory):
+        """
+        :param directory: path of the cache, created on the first fit
+        """
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+
+    def fit(self, distribution, n_components, seed=None, init=None,
+            sample_size=None, refine_steps=REFINE_STEPS):
+        """
+        Returns the cached model of a fit or fits and caches it, the
+        arguments are the ones of FittedModel.
+
+        :return: FittedModel
+        """
+        distribution = np.asarray(distribution, dtype=float)
+        key = fit_key(distribution, n_components, seed, init, sample_size,
+                      refine_steps)
+        path = os.path.join(self.directory, key[:2], key + ".npz")
+
+        if os.path.isfile(path):
+            try:
+                model = load(path, seed)
+                self.hits += 1
+                return model
+            except (OSError, ValueError, KeyError):
+                # broken entry, e.g. from a full disk, is fitted again
+                pass
+
+        model = FittedModel(distribution, n_components, seed=seed, init=init,
+                            sample_size=sample_size,
+                            refine_steps=refine_steps)
+        self.misses += 1
+        store(path, model)
+        return model
+
+
+def fit(cache, distribution, n_components, **kwargs):
+    """
+    Fits through the cache or, if cache is None, without it.
+
+    :param cache: FitCache or None
+    :param kwargs: arguments of FittedModel
+    :return: FittedModel
+    """
+    if cache is None:
+        return FittedModel(distribution, n_components, **kwargs)
+    return cache.fit(distribution, n_components, **kwargs)
+
+
+def fit_key(distribution, n_components, seed, init, sample_size,
+            refine_steps):
+    """
+    :return: sha256 hex digest identifying a fit
+    """
+    digest = hashlib.sha256()
+    digest.update(np.ascontiguousarray(distribution).tobytes())
+    digest.update(json.dumps([
+        distribution.shape, n_components, seed, sample_size, refine_steps,
+        sklearn.__version__,
+        repr(sorted(GaussianMixture(n_components).get_params().items()))
+    ]).encode())
+    if init is not None:
+        for array in (init.means, init.weights, init.covariances):
+            digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+def store(path, model):
+    """
+    Writes a model with its scores and diagnostics into the cache.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = "{0}.{1}.{2}.tmp.npz".format(path[:-len(".npz")], os.getpid(),
+                                       threading.get_ident())
+    model.save(tmp, bic=model.bic, aic=model.aic, n_iter=model.n_iter,
+               diagnostics=json.dumps(model.diagnostics,
+                                      default=lambda value: value.item()))
+    os.replace(tmp, path)
+
+
+def load(path, seed):
+    """
+    Reads a model written by store.
+
+    :return: FittedModel
+    """
+    model = FittedModel.load(path)
+    model.seed = seed
+    model.bic = model.info.pop("bic")
+    model.aic = model.info.pop("aic")
+    model.gmm.n_iter_ = model.info.pop("n_iter")
+    model.diagnostics = json.loads(model.info.pop("diagnostics"))
+    return model
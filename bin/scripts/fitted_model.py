@@ -0,0 +1,331 @@
+"""
+Gaussian Mixture Model of the scores of one transcription factor.
+
+A FittedModel is fitted once per transcription factor and number of
+components and then handed to everything that needs the components: the
+evaluation of the number of components (components_fit.py), the result
+table (ema.py) and the contour and altitude plots (visualize_data.py), so
+no step fits its own model.
+
+For very large distributions the model can be fitted on a stratified
+subsample of sample_size points (see stratified_sample) and then refined
+with a few EM steps on the full distribution. The diagnostics of such a fit
+compare it with the full data: the mean log-likelihood of the full
+distribution before and after the refinement, how far the means moved and
+whether the refinement converged, i.e. reached the same solution a full fit
+started from the subsample fit would reach.
+
+The parameters of a model can be stored in a .npz file (save) and loaded
+again (load) as a FittedModel that scores points and warm-starts fits like
+a fitted one.
+
+
+Use as follows:
+
+    from scripts.fitted_model import FittedModel
+
+    model = FittedModel(distribution, 3, seed=0)
+    means, covariances, weights = model.means, model.covariances, model.weights
+
+    # more components, warm-started from the solution with 3 components
+    larger = FittedModel(distribution, 4, seed=0, init=model)
+
+    # fitted on 50000 points, refined on all
+    sampled = FittedModel(distribution, 3, seed=0, sample_size=50000)
+    print(sampled.describe())
+
+    # stored and reloaded, e.g. to warm-start a fit of updated data
+    model.save("model.npz", time=time.time())
+    updated = FittedModel(new_distribution, 3, init=FittedModel.load("model.npz"))
+"""
+
+import warnings
+import numpy as np
+from sklearn.mixture import GaussianMixture
+from sklearn.exceptions import ConvergenceWarning
+
+# full data EM steps after a fit on a subsample
+REFINE_STEPS = 5
+# number of intervalls per axis the subsample is stratified by
+STRATA = 10
+
+
+class FittedModel:
+
+    def __init__(self, distribution, n_components, seed=None, init=None,
+                 sample_size=None, refine_steps=REFINE_STEPS):
+        """
+        Fits a Gaussian Mixture Model into a distribution.
+
+        :param distribution: Array of float64 vectors (ATAC, ChIP)
+        :param n_components: number of components
+        :param seed: random state of the fit, not reproducible if None
+        :param init: FittedModel with at most n_components components the fit
+               is started from (see warm_start), started from k-means if None
+        :param sample_size: number of points the model is fitted on before it
+               is refined on the full distribution, all points are used if
+               None or if the distribution is not larger
+        :param refine_steps: maximum number of EM steps on the full
+               distribution after a fit on a subsample
+        """
+        distribution = np.asarray(distribution, dtype=float)
+        self.n_components = n_components
+        self.seed = seed
+        self.diagnostics = None
+        self.info = {}
+
+        if sample_size and len(distribution) > sample_size:
+            sample = stratified_sample(distribution, sample_size, seed)
+            start = warm_start(init, sample, n_components) if init else {}
+            coarse = GaussianMixture(n_components=n_components,
+                                     random_state=seed, **start).fit(sample)
+            self.gmm = GaussianMixture(n_components=n_components,
+                                       random_state=seed,
+                                       max_iter=refine_steps,
+                                       **parameters_of(coarse))
+            # the refinement stops after refine_steps on purpose
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", ConvergenceWarning)
+                self.gmm.fit(distribution)
+
+            log_likelihood = self.gmm.score(distribution)
+            scale = np.mean(np.std(distribution, axis=0)) or 1
+            self.diagnostics = {
+                "points": len(distribution),
+                "sample_size": len(sample),
+                "sample_log_likelihood": coarse.score(distribution),
+                "log_likelihood": log_likelihood,
+                "refine_steps": self.gmm.n_iter_,
+                "converged": self.gmm.converged_,
+                "mean_shift": np.max(np.linalg.norm(
+                    self.gmm.means_ - coarse.means_, axis=1)) / scale}
+        else:
+            start = warm_start(init, distribution, n_components) if init \
+                else {}
+            self.gmm = GaussianMixture(n_components=n_components,
+                                       random_state=seed, **start)
+            self.gmm.fit(distribution)
+            log_likelihood = self.gmm.score(distribution)
+
+        # same as GaussianMixture.bic and aic, which both score all points
+        n_parameters = count_parameters(n_components, distribution.shape[1])
+        self.bic = (-2 * log_likelihood * len(distribution) +
+                    n_parameters * np.log(len(distribution)))
+        self.aic = -2 * log_likelihood * len(distribution) + 2 * n_parameters
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a model stored by save.
+
+        :param path: path to the .npz file
+        :return: FittedModel with the stored parameters, the additional
+                 values given to save are in the dictionary info. bic and aic
+                 are None since the distribution is unknown.
+        """
+        with np.load(path) as stored:
+            values = dict(stored)
+        covariances = values.pop("covariances")
+        model = cls.__new__(cls)
+        model.n_components = len(covariances)
+        model.seed = None
+        model.diagnostics = None
+        model.bic = model.aic = None
+
+        gmm = GaussianMixture(n_components=model.n_components)
+        gmm.weights_ = values.pop("weights")
+        gmm.means_ = values.pop("means")
+        gmm.covariances_ = covariances
+        # the same cholesky factors of the precisions GaussianMixture keeps
+        gmm.precisions_cholesky_ = np.linalg.inv(
+            np.linalg.cholesky(covariances)).transpose(0, 2, 1)
+        gmm.precisions_ = gmm.precisions_cholesky_ @ \
+            gmm.precisions_cholesky_.transpose(0, 2, 1)
+        gmm.converged_ = True
+        gmm.n_iter_ = 0
+        model.gmm = gmm
+        model.info = {key: value.item() if value.ndim == 0 else value
+                      for key, value in values.items()}
+        return model
+
+    def save(self, path, **info):
+        """
+        Stores the parameters of the model, see load.
+
+        :param path: path to the .npz file
+        :param info: additional values stored with the model, e.g. the time
+               of the analysis
+        """
+        np.savez(path, means=self.means, covariances=self.covariances,
+                 weights=self.weights, **info)
+
+    @property
+    def n_iter(self):
+        """
+        :return: number of EM steps of the fit (of the refinement for a fit
+                 on a subsample)
+        """
+        return self.gmm.n_iter_
+
+    @property
+    def means(self):
+        """
+        :return: Array of the means of the components
+        """
+        return self.gmm.means_
+
+    @property
+    def covariances(self):
+        """
+        :return: Array of the covariance matrices of the components
+        """
+        return self.gmm.covariances_
+
+    @property
+    def weights(self):
+        """
+        :return: Array of the weights of the components
+        """
+        return self.gmm.weights_
+
+    def stds(self):
+        """
+        :return: tuple of the Arrays of the standard deviations of the x- and
+                 y-values of the components
+        """
+        return (np.sqrt(self.covariances[:, 0, 0]),
+                np.sqrt(self.covariances[:, 1, 1]))
+
+    def score_samples(self, points, scale=1):
+        """
+        Log density of the model at the given points.
+
+        :param points: Array of float64 vectors
+        :param scale: factor the points were scaled by, the model is
+               evaluated at points / scale
+        :return: Array of the log densities
+        """
+        return self.gmm.score_samples(np.asarray(points) / scale)
+
+    def describe(self):
+        """
+        :return: one line summary of the diagnostics of a fit on a
+                 subsample, None if the model was fitted on all points
+        """
+        if self.diagnostics is None:
+            return None
+        return ("{n} components fitted on {sample_size} of {points} points, "
+                "mean log-likelihood {sample_log_likelihood:.4f} -> "
+                "{log_likelihood:.4f} after {refine_steps} full EM steps "
+                "({state}), means moved by {mean_shift:.3f} standard "
+                "deviations".format(
+                    n=self.n_components,
+                    state="converged" if self.diagnostics["converged"]
+                    else "not converged", **self.diagnostics))
+
+
+def warm_start(model, distribution, n_components):
+    """
+    Initial parameters of a fit with n_components components that starts from
+    the solution of a smaller model. The components of the model are kept and
+    the widest one (largest weight times spread) is split in two for every
+    additional component: the halves are placed one standard deviation apart
+    along its main axis, with half of its weight and a quarter of its
+    variance along that axis.
+
+    :param model: FittedModel with at most n_components components
+    :param distribution: Array of float64 vectors the model was fitted into
+    :param n_components: number of components of the new fit
+    :return: dictionary of the arguments of GaussianMixture (see
+             parameters_of)
+    """
+    extra = n_components - model.n_components
+    if extra < 0:
+        raise ValueError("a model with {0} components can not start a fit "
+                         "with {1}".format(model.n_components, n_components))
+
+    start = parameters_of(model.gmm)
+    if extra > 0:
+        if len(np.unique(distribution, axis=0)) < n_components:
+            raise ValueError("the distribution has less distinct points than "
+                             "components")
+        means = list(model.means)
+        weights = list(model.weights)
+        covariances = list(model.covariances)
+        for _ in range(extra):
+            widest = int(np.argmax([weight * np.sqrt(np.linalg.det(cov))
+                                    for weight, cov in zip(weights,
+                                                           covariances)]))
+            values, vectors = np.linalg.eigh(covariances[widest])
+            axis = vectors[:, -1] * np.sqrt(values[-1])
+            mean = means[widest]
+            covariance = covariances[widest] - 0.75 * np.outer(axis, axis)
+            means[widest:widest + 1] = [mean - axis, mean + axis]
+            weights[widest:widest + 1] = [weights[widest] / 2] * 2
+            covariances[widest:widest + 1] = [covariance] * 2
+        covariances = np.array(covariances) + \
+            np.eye(distribution.shape[1]) * model.gmm.reg_covar
+        weights = np.array(weights)
+        start.update(means_init=np.array(means),
+                     weights_init=weights / weights.sum(),
+                     precisions_init=np.linalg.inv(covariances))
+    return start
+
+
+def count_parameters(n_components, dims):
+    """
+    Number of free parameters of a Gaussian Mixture Model with full
+    covariance matrices: a symmetric covariance matrix and a mean per
+    component and the weights, which sum to 1.
+
+    :param n_components: number of components
+    :param dims: number of dimensions of the points
+    :return: number of parameters
+    """
+    return (n_components * dims * (dims + 1) // 2 + n_components * dims +
+            n_components - 1)
+
+
+def parameters_of(gmm):
+    """
+    :param gmm: fitted GaussianMixture
+    :return: dictionary of the means_init, weights_init and precisions_init
+             arguments of GaussianMixture that start a fit from its solution
+    """
+    # the initialization runs before the given parameters replace it, random
+    # is the cheapest one (k-means would cluster all points)
+    return {"means_init": gmm.means_, "weights_init": gmm.weights_,
+            "precisions_init": gmm.precisions_, "init_params": "random"}
+
+
+def stratified_sample(distribution, sample_size, seed=None):
+    """
+    Draws a subsample that keeps the shape of the distribution. The range of
+    the points is divided into STRATA x STRATA intervalls and every intervall
+    gets a share of the sample proportional to its number of points, at
+    least one point if it is not empty.
+
+    :param distribution: Array of float64 vectors
+    :param sample_size: number of points to draw
+    :param seed: seed of the sample, not reproducible if None
+    :return: Array of about sample_size float64 vectors
+    """
+    rng = np.random.default_rng(seed)
+    low = distribution.min(axis=0)
+    width = (distribution.max(axis=0) - low) / STRATA
+    width[width == 0] = 1
+    cells = np.minimum((distribution - low) // width, STRATA - 1).astype(int)
+    strata = np.ravel_multi_index(cells.T, (STRATA,) * distribution.shape[1])
+
+    order = np.argsort(strata, kind="stable")
+    counts = np.bincount(strata)
+    shares = np.maximum(np.round(counts * sample_size / len(distribution)),
+                        counts > 0).astype(int)
+
+    chosen = []
+    for members, share in zip(np.split(order, np.cumsum(counts)[:-1]),
+                              shares):
+        if share > 0:
+            chosen.append(rng.choice(members, size=min(share, len(members)),
+                                     replace=False))
+    return distribution[np.sort(np.concatenate(chosen))]
@@ -7,22 +7,33 @@ import os
 import pandas as pd
 from collections import defaultdict
 import logging
+from scripts.compression import open_text, strip_suffix
 
 
-def parse(data_path):
+def parse(data_path, catalog=None, refresh=None):
     """
     This function creates dictionaries for the bed and bigwig files of the provided data. The dictionaries are stored in
     pickle files. For the files of ChIP-seq and ATAC-seq a separate pickle file is created for each biosource.
+    :param data_path: The path of the data folder
+    :param catalog: scripts.catalog.Catalog of the sorted files, the linking_table is read if None
+    :param refresh: list of paths to bigwig files whose bed files are read again even if they are already in the
+                    pickle files
     """
     logging.info('starting generation of pickle files')
     print('-----Generate pickle files-----')
-
-    # read linking_table to get all available genomes, biosources and tfs
-    lt = pd.read_csv(os.path.join(data_path, 'linking_table.csv'), sep=';',
-                     usecols=['genome', 'epigenetic_mark', 'biosource'])
-    genomes = set(lt.values[:, 0])
-    lt_tfs = set(lt.values[:, 2][lt.values[:, 2] != ('dnasei' or 'dna accessibility')])
-    lt_biosources = set(x for x in lt.values[:, 1])
+    refresh = set(refresh or [])
+
+    # get all available genomes, biosources and tfs from the catalog or the linking_table
+    if catalog is not None:
+        genomes = catalog.distinct('sorted', 'genome')
+        lt_tfs = catalog.distinct('sorted', 'epigenetic_mark') - {'dnasei', 'dna accessibility'}
+        lt_biosources = catalog.distinct('sorted', 'biosource')
+    else:
+        lt = pd.read_csv(os.path.join(data_path, 'linking_table.csv'), sep=';',
+                         usecols=['genome', 'epigenetic_mark', 'biosource'])
+        genomes = set(lt.values[:, 0])
+        lt_tfs = set(lt.values[:, 2][lt.values[:, 2] != ('dnasei' or 'dna accessibility')])
+        lt_biosources = set(x for x in lt.values[:, 1])
 
     chip_file = False
     atac_file = False
@@ -67,9 +78,9 @@ def parse(data_path):
 
                 # list all files for chip data of one tf
                 files = [x for x in os.listdir(os.path.join(data_path, genome, biosource, 'chip-seq', tf)) if
-                         x.lower().endswith('.bed')]
+                         strip_suffix(x.lower()).endswith('.bed')]
 
-                # test for .bed ending of the file
+                # test for .bed ending of the file, the bed files may be compressed (.bed.gz, .bed.zst)
                 # bed files are read in with the function read_bed and the data is saved in the dictionary tf_bed_dict
                 # the key for tf_bed_dict is the path of the associated bigwig-file
                 count = 1
@@ -77,8 +88,9 @@ def parse(data_path):
                 for bed_f in files:
                     print('Processing file {} of {}'.format(count, len(files)))
                     count += 1
-                    bw = os.path.join(data_path, genome, biosource, 'chip-seq', tf, bed_f).replace('.bed', '.bw')
-                    if os.path.exists(bw) and bw not in tf_bed_dict:
+                    bw = os.path.join(data_path, genome, biosource, 'chip-seq', tf,
+                                      strip_suffix(bed_f)).replace('.bed', '.bw')
+                    if os.path.exists(bw) and (bw not in tf_bed_dict or bw in refresh):
                         tf_bed_dict[bw] = read_bed(os.path.join(data_path, genome, biosource, 'chip-seq', tf, bed_f))
 
                 # the bed data of the tf is stored in the chip dictionary for the biosource with tf as key
@@ -144,13 +156,15 @@ def parse(data_path):
 
 def read_bed(file):
     """
-    This function reads in a bed-file and returns the contained information in a dictionary.
+    This function reads in a bed-file and returns the contained information in a dictionary. Compressed bed-files are
+    decompressed while they are read.
     :param file: The path of the bed-file
     :return: chromosome is a dictionary with the chromosome as key and [start, stop, score, peak] as value
     """
     chromosome = defaultdict(list)
 
-    f = pd.read_csv(file, sep='\t', usecols=lambda c: c in {'seqnames', 'start', 'end', 'PEAK'}, index_col=False)
+    with open_text(file) as bed:
+        f = pd.read_csv(bed, sep='\t', usecols=lambda c: c in {'seqnames', 'start', 'end', 'PEAK'}, index_col=False)
 
     for index, row in f.iterrows():
         start = int(row['start'])
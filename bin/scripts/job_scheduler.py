@@ -0,0 +1,99 @@
+"""
+Methods for running independent jobs of the data preparation phase
+concurrently.
+
+A job is a list of [name, function, arguments]. The jobs are run in a pool of
+threads (for jobs that mostly wait for external tools) or processes (for jobs
+that do their work in Python) with a configurable concurrency limit. The exit
+code and error output of every job is captured and returned together with
+its result, so a failing job does not stop the other jobs.
+
+
+Use as follows:
+
+    from scripts.job_scheduler import run_jobs, run_command
+
+    jobs = [["sort a.bedGraph", run_command, [["sort", "a.bedGraph"]]]]
+    for result in run_jobs(jobs, max_workers=4):
+        if result.returncode != 0:
+            print(result.name, result.stderr)
+"""
+
+import os
+import subprocess
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# name: name of the job, returncode: 0 if the job succeeded, stderr: error
+# output of the job, value: return value of the job function
+JobResult = namedtuple("JobResult", ["name", "returncode", "stderr", "value"])
+
+
+def run_jobs(jobs, max_workers=None, use_processes=False):
+    """
+    Runs jobs concurrently and collects their results.
+
+    :param jobs: List of [name, function, arguments] lists
+    :param max_workers: Maximum number of jobs running at the same time,
+           defaults to the number of cpus
+    :param use_processes: Boolean, if True the jobs are run in a process pool
+           instead of a thread pool. The functions and their arguments must
+           be picklable in this case.
+    :return: List of JobResults in the same order as jobs
+    """
+    if len(jobs) == 0:
+        return []
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_workers = max(1, min(max_workers, len(jobs)))
+
+    pool = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    results = []
+
+    with pool(max_workers=max_workers) as executor:
+        futures = [executor.submit(function, *args) for _, function, args in
+                   jobs]
+
+        for (name, _, _), future in zip(jobs, futures):
+            try:
+                results.append(JobResult(name, 0, "", future.result()))
+            except subprocess.CalledProcessError as err:
+                results.append(JobResult(name, err.returncode,
+                                         err.stderr or "", None))
+            except Exception as err:
+                results.append(JobResult(name, 1, str(err), None))
+
+    return results
+
+
+def run_command(args, stdout_path=None, env=None):
+    """
+    Runs an external command as a managed subprocess and captures its error
+    output.
+
+    :param args: List of Strings with the command and its arguments
+    :param stdout_path: String with path to a file the output of the command
+           is written to, if None the output is discarded
+    :param env: Dictionary with additional environment variables
+    :return: String with the error output of the command
+    :raises subprocess.CalledProcessError: if the exit code is not 0
+    """
+    if env is not None:
+        env = dict(os.environ, **env)
+
+    if stdout_path is None:
+        process = subprocess.run(args, stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.PIPE,
+                                 universal_newlines=True, env=env)
+    else:
+        with open(stdout_path, "w") as stdout:
+            process = subprocess.run(args, stdout=stdout,
+                                     stderr=subprocess.PIPE,
+                                     universal_newlines=True, env=env)
+
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, args,
+                                            stderr=process.stderr)
+
+    return process.stderr
@@ -0,0 +1,295 @@
+"""
+Concurrent, cached generation of the linking table.
+
+Builds the same linking table as generate_linking_table.r:
+1. query ATAC/DNase-seq experiments of the genome and biosources
+2. query ChIP-seq experiments of the remaining biosources and transcription
+   factors (once per biosource, the ChIP biosources are overwritten by their
+   ATAC equivalents)
+3. keep the ATAC/DNase-seq experiments of biosources with ChIP-seq data and
+   add a row for every experiment and chromosome, ChIP-seq rows are only
+   added if DeepBlue has regions for the chromosome
+
+The metadata of the experiments is requested in batches, the experiment
+lists and region counts are requested concurrently through the connection
+pool of scripts.deepblue. Experiment lists, metadata and region counts are
+kept in a local TTL cache (see ttl_cache.py), so running again with more
+chromosomes or biosources only queries what is new. check_deepblue.py
+checks the table against the local stand-in server of deepblue_standin.py.
+
+
+Use as follows:
+
+    from scripts.deepblue import DeepBlueClient
+    from scripts.ttl_cache import TTLCache
+    from scripts.linking_table import build_linking_table
+
+    build_linking_table(DeepBlueClient(), "hg19", ["chr1"], ["k562"],
+                        ["ctcf"], "data/download/linking_table.csv",
+                        TTLCache("data/deepblue_cache.sqlite"))
+"""
+
+import os
+import csv
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+COLUMNS = ["experiment_id", "genome", "biosource", "technique",
+           "epigenetic_mark", "chromosome", "filename", "data_type", "format",
+           "sample_id", "project", "regions"]
+INFO_BATCH_SIZE = 100
+
+
+def build_linking_table(client, genome, chromosomes, biosources, marks,
+                        output_file, cache=None, chip_type="peaks",
+                        atac_type="signal", append=True,
+                        chrom_sizes_dir=None):
+    """
+    Generates the linking table for a genome.
+
+    :param client: scripts.deepblue.DeepBlueClient
+    :param genome: name of the genome
+    :param chromosomes: list of chromosomes
+    :param biosources: list of biosources, all biosources if None
+    :param marks: list of epigenetic marks, all marks if None
+    :param output_file: path to the linking table
+    :param cache: scripts.ttl_cache.TTLCache for the answers of DeepBlue, no
+           cache is used if None
+    :param chip_type: experiment type of the ChIP-seq data
+    :param atac_type: experiment type of the ATAC/DNase-seq data
+    :param append: Boolean, if True rows for experiments and chromosomes
+           already in the linking table are not added again
+    :param chrom_sizes_dir: path to write [genome].chrom.sizes into, not
+           written if None
+    :return: number of rows added
+    :raises Exception: if no experiments could be linked
+    """
+    pool = ThreadPoolExecutor(max_workers=max(1, client.connections.qsize()))
+
+    if chrom_sizes_dir is not None:
+        write_chrom_sizes(client, cache, genome, chrom_sizes_dir)
+
+    # 1st step: ATAC/DNase-seq experiments and their biosources
+    atac_ids = list_experiments(client, cache, genome, atac_type, None,
+                                biosources, ["ATAC-seq", "DNAse-seq"])
+    if len(atac_ids) == 0:
+        raise Exception("{0}: No ATAC/DNAse-seq data available for given "
+                        "arguments".format(genome))
+    print("fetching {0} ATAC/DNAse-seq experiments ...".format(len(atac_ids)))
+    atac_metadata = fetch_info(client, cache, pool, atac_ids)
+    atac_biosources = sorted(set(biosource_name(m) for m in atac_metadata))
+
+    # 2nd step: ChIP-seq experiments, one query per biosource since DeepBlue
+    # also returns misspelled biosources
+    chip_lists = pool.map(lambda bsource: list_experiments(
+        client, cache, genome, chip_type, marks, [bsource], "ChIP-Seq"),
+        atac_biosources)
+    chip_experiments = [(experiment_id, bsource) for bsource, ids in
+                        zip(atac_biosources, chip_lists) for experiment_id in
+                        ids]
+    if len(chip_experiments) == 0:
+        raise Exception("{0}: No ChIP-seq data available for given "
+                        "arguments".format(genome))
+    print("fetching {0} ChIP-seq experiments ...".format(
+        len(chip_experiments)))
+    chip_info = fetch_info(client, cache, pool,
+                           [experiment_id for experiment_id, _ in
+                            chip_experiments])
+    chip_metadata = []
+    for metadata, (_, bsource) in zip(chip_info, chip_experiments):
+        metadata = dict(metadata)
+        metadata["sample_info"] = dict(metadata.get("sample_info") or {},
+                                       biosource_name=bsource)
+        chip_metadata.append(metadata)
+    chip_biosources = set(biosource_name(m) for m in chip_metadata)
+
+    # 3rd step: ATAC/DNase-seq experiments of biosources with ChIP-seq data
+    atac_metadata = [m for m in atac_metadata if biosource_name(m) in
+                     chip_biosources]
+    print("kept {0} ATAC/DNAse-seq experiments".format(len(atac_metadata)))
+    if len(atac_metadata) == 0:
+        raise Exception("{0}: No ATAC/ChIP-seq experiments could be "
+                        "linked".format(genome))
+
+    existing = set()
+    if append and os.path.exists(output_file):
+        with open(output_file, "r", newline="") as csvfile:
+            existing = set((row["experiment_id"], row["chromosome"]) for row
+                           in csv.DictReader(csvfile, delimiter=";"))
+    elif os.path.exists(output_file):
+        os.remove(output_file)
+
+    pairs = [(metadata, chrom) for metadata in chip_metadata + atac_metadata
+             for chrom in chromosomes
+             if (metadata["_id"], chrom) not in existing]
+
+    # ChIP-seq rows need the number of regions on the chromosome,
+    # DNase/ATAC-seq regions are checked chunk-wise during the download
+    counts = count_regions(client, cache, pool, [
+        (metadata["name"], chrom) for metadata, chrom in pairs
+        if metadata["technique"].lower() == "chip-seq"])
+    pool.shutdown()
+
+    rows = []
+    for metadata, chrom in pairs:
+        if metadata["technique"].lower() == "chip-seq":
+            regions = counts[(metadata["name"], chrom)]
+        else:
+            regions = 1
+        if regions > 0:
+            rows.append(new_row(metadata, chrom, regions))
+
+    write_header = not os.path.exists(output_file)
+    if os.path.dirname(output_file):
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    with open(output_file, "a", newline="") as csvfile:
+        csv_writer = csv.writer(csvfile, delimiter=";")
+        if write_header:
+            csv_writer.writerow(COLUMNS)
+        csv_writer.writerows(rows)
+
+    print("{0} lines added to {1}".format(len(rows), output_file))
+    return len(rows)
+
+
+def list_experiments(client, cache, genome, experiment_type, marks,
+                     biosources, technique):
+    """
+    Lists the ids of the experiments matching the arguments.
+
+    :return: list of experiment ids
+    """
+    args = [genome, experiment_type, marks, biosources, None, technique,
+            None]
+    key = json.dumps(args)
+    if cache is not None:
+        ids = cache.get("experiments", key)
+        if ids is not None:
+            return ids
+
+    result = client.call_with_retries("list_experiments", *args)
+    # DeepBlue answers with a message instead of a list if nothing matches
+    ids = [experiment[0] for experiment in result] if isinstance(
+        result, list) else []
+
+    if cache is not None:
+        cache.set("experiments", key, ids)
+    return ids
+
+
+def fetch_info(client, cache, pool, experiment_ids):
+    """
+    Fetches the metadata of experiments in batches.
+
+    :param client: scripts.deepblue.DeepBlueClient
+    :param cache: scripts.ttl_cache.TTLCache or None
+    :param pool: ThreadPoolExecutor the batches are requested in
+    :param experiment_ids: list of experiment ids
+    :return: list of metadata dictionaries in the order of experiment_ids
+    """
+    metadata = {}
+    if cache is not None:
+        metadata = cache.get_many("info", set(experiment_ids))
+
+    missing = sorted(set(experiment_ids) - set(metadata))
+    batches = [missing[i:i + INFO_BATCH_SIZE] for i in
+               range(0, len(missing), INFO_BATCH_SIZE)]
+    for batch, infos in zip(batches, pool.map(
+            lambda batch: client.call_with_retries("info", batch), batches)):
+        new = {}
+        for experiment_id, info in zip(batch, infos):
+            # the same fields are left out as in generate_linking_table.r
+            new[experiment_id] = {key: value for key, value in info.items()
+                                  if key not in ["extra_metadata",
+                                                 "upload_info", "columns"]}
+        metadata.update(new)
+        if cache is not None:
+            cache.set_many("info", new)
+
+    logging.info("fetched metadata of {0} experiments, {1} from the "
+                 "cache".format(len(metadata), len(metadata) - len(missing)))
+    return [metadata[experiment_id] for experiment_id in experiment_ids]
+
+
+def count_regions(client, cache, pool, pairs):
+    """
+    Counts the regions of experiments on chromosomes concurrently.
+
+    :param client: scripts.deepblue.DeepBlueClient
+    :param cache: scripts.ttl_cache.TTLCache or None
+    :param pool: ThreadPoolExecutor the requests are sent in
+    :param pairs: list of (experiment name, chromosome) tuples
+    :return: dictionary {(experiment name, chromosome): number of regions}
+    """
+    keys = {pair: "{0}:{1}".format(*pair) for pair in set(pairs)}
+    cached = {}
+    if cache is not None:
+        cached = cache.get_many("regions", keys.values())
+    counts = {pair: cached[key] for pair, key in keys.items() if key in cached}
+
+    def count(pair):
+        query_id = client.call_with_retries("select_experiments", pair[0],
+                                            pair[1], None, None)
+        return client.count_regions(query_id)
+
+    missing = [pair for pair in keys if pair not in counts]
+    print("counting regions of {0} experiment chromosomes ({1} "
+          "cached)".format(len(keys), len(keys) - len(missing)))
+    new = dict(zip(missing, pool.map(count, missing)))
+    counts.update(new)
+    if cache is not None:
+        cache.set_many("regions", {keys[pair]: value for pair, value in
+                                   new.items()})
+    return counts
+
+
+def write_chrom_sizes(client, cache, genome, directory):
+    """
+    Writes the tab separated [genome].chrom.sizes file if it does not exist.
+    """
+    size_output = os.path.join(directory, genome + ".chrom.sizes")
+    if os.path.exists(size_output):
+        return
+    chroms = cache.get("chromosomes", genome) if cache is not None else None
+    if chroms is None:
+        chroms = client.call_with_retries("chromosomes", genome)
+        if cache is not None:
+            cache.set("chromosomes", genome, chroms)
+    os.makedirs(directory, exist_ok=True)
+    with open(size_output, "w") as file:
+        for chrom, size in chroms:
+            file.write("{0}\t{1}\n".format(chrom, size))
+    print("{0} written to {1}".format(os.path.basename(size_output),
+                                      directory))
+
+
+def biosource_name(metadata):
+    """
+    :param metadata: metadata dictionary of an experiment
+    :return: lower case biosource of the experiment
+    """
+    return metadata["sample_info"]["biosource_name"].lower()
+
+
+def new_row(metadata, chrom, regions):
+    """
+    Makes the linking table row of an experiment and chromosome. The
+    chromosome is inserted into the filename before its ending.
+
+    :param metadata: metadata dictionary of the experiment
+    :param chrom: chromosome
+    :param regions: number of regions
+    :return: list of values in the order of COLUMNS
+    """
+    dots = metadata["name"].split(".")
+    if len(dots) > 1:
+        filename = ".".join(dots[:-1] + [chrom, dots[-1]])
+    else:
+        filename = metadata["name"] + "." + chrom
+
+    return [metadata["_id"], metadata["genome"], biosource_name(metadata),
+            metadata["technique"].lower(),
+            metadata["epigenetic_mark"].lower(), chrom, filename,
+            metadata.get("data_type"), metadata.get("format"),
+            metadata.get("sample_id"), metadata.get("project"), regions]
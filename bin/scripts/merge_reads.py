@@ -8,31 +8,42 @@ Goes through the following workflow:
   forward/reverse reads that need merging
 - Groups them into pairs to be merged
 - Checks if file format is bigWig, if not converts files to bigWig
-- Merges files
+- Merges files, either in-process with pyBigWig directly into a bigWig file
+  or with the merging tool as a fallback
 - Checks if bedGraph is an allowed format since that is the output format of
   merging tool, if not files are converted to bigWig
 - Deletes all files that are no longer needed
 - Adds entries for merged files to linkage_table.csv
 
+Conversions and merges are run as concurrent jobs (see job_scheduler.py), the
+exit code and error output of every job is logged.
+
 
 Use as follows:
 
     import merge_reads
 
     merge_reads.merge_all(linkage_table_path, chrom_sizes_paths,
-    conversion_tool_path, merge_tool_path, allowed_file_formats)
+    allowed_file_formats, conversion_tool_path, merge_tool_path, native,
+    max_workers, catalog)
 
 
 by Kristina Müller (kmlr81)
 """
 
 import os
+import re
+import subprocess
+import numpy as np
 import pandas as pd
+import pyBigWig
 import logging
+from scripts.job_scheduler import run_jobs, run_command
 
 
 def merge_all(linkage_table_path, chrom_sizes_paths, allowed_file_formats,
-              conversion_tool="bedGraphToBigWig", merge_tool="bigWigMerge"):
+              conversion_tool="bedGraphToBigWig", merge_tool="bigWigMerge",
+              native=True, max_workers=None, catalog=None):
     """
     Method merges all forward/reverse ATAC-seq files after converting them to
     bigWig format if necessary, checks if merged files need to be converted
@@ -42,6 +53,11 @@ def merge_all(linkage_table_path, chrom_sizes_paths, allowed_file_formats,
     Default values for conversion_tool and merge_tool are the tools that are 
     installed earlier in the pipe. If different tools are to be used, 
     they have to be installed manually.
+
+    If native is True and bigWig is an allowed format, pairs are merged
+    in-process and written directly as bigWig, skipping the bedGraph round
+    trip. The merging and conversion tools are only used for pairs that
+    could not be merged natively.
     
     :param linkage_table_path: String containing path to linking_table.csv
     :param chrom_sizes_paths: Array of Strings containing paths to all
@@ -49,11 +65,22 @@ def merge_all(linkage_table_path, chrom_sizes_paths, allowed_file_formats,
     :param allowed_file_formats: List of Strings with allowed file formats
     :param conversion_tool: String with path to bedGraphToBigWig tool
     :param merge_tool: String with path to bigWigMerge tool
+    :param native: Boolean, if True pairs are merged with pyBigWig instead of
+           the merging tool where possible
+    :param max_workers: Maximum number of conversion and merge jobs running
+           at the same time, defaults to the number of cpus
+    :param catalog: scripts.catalog.Catalog, if given the forward/reverse
+           files are queried from its temp stage instead of reading the
+           linkage table and the merged files are added to it
     """
     print("------ Merge forward/reverse reads ------")
     print("- Reading in linking table")
 
-    if os.path.exists(linkage_table_path):
+    if catalog is not None:
+        linkage_frame = catalog.select("temp", technique=["atac-seq"],
+                                       filename_like=["%forward%",
+                                                      "%reverse%"])
+    elif os.path.exists(linkage_table_path):
         linkage_frame = read_linkage_table(linkage_table_path)
     else:
         raise FileNotFoundError("The file {0} does not exist or the filepath "
@@ -64,97 +91,101 @@ def merge_all(linkage_table_path, chrom_sizes_paths, allowed_file_formats,
     pairs = find_pairs(linkage_frame)
     print("{} pairs were found".format(len(pairs)))
 
+    # Index rows by file path so the rows of a file can be looked up directly
+    rows_by_path = linkage_frame.drop_duplicates("file_path").set_index(
+        "file_path", drop=False)
+
+    allowed_file_formats = [file_format.lower() for file_format in
+                            allowed_file_formats]
+    native = native and ("bigwig" in allowed_file_formats or "bw" in
+                         allowed_file_formats)
+
     if len(pairs) > 0:
         pairs_merge = []
-        converted_idxs = []
+        source_pairs = []
         merged_files = []
+        merged_pairs = []
         old_files = []
-        rows = []
 
         # If file format of forward/reverse reads is bedGraph, then convert to
         # bigWig for merging tool and make new pairs_merge List with only bigWig
         # file paths for merging
         print("- Converting bedGraph files to bigWig for merging")
 
-        for idx, pair in enumerate(pairs):
-            tmp_pair = []
-            for i in range(0, len(pair)):
-                if os.path.exists(pair[i]):
-                    file_ext = os.path.splitext(pair[i])[1].lower()
-                    if ".bedgraph" == file_ext:
-                        print("Converting file: " + pair[i])
-                        genome = linkage_frame.loc[linkage_frame["file_path"] ==
-                                                   pair[i]]["genome"]
-                        # Find the right chrom.sizes file for genome
-                        chrom_sizes = [el for el in chrom_sizes_paths if
-                                       genome.iloc[0] in el]
-                        bw_file_path = convert_bedgraph_to_bigwig(pair[i],
-                                                                  chrom_sizes[0],
-                                                                  conversion_tool)
-                        if not os.path.exists(bw_file_path):
-                            sort_file(pair[i])
-                            bw_file_path = convert_bedgraph_to_bigwig(pair[i],
-                                                                    chrom_sizes[0],
-                                                                    conversion_tool)
-                        if os.path.exists(bw_file_path):
-                            tmp_pair.append(bw_file_path)
-                            converted_idxs.append([idx, i])
-                        else:
-                            logging.error("The file {} could not be converted to "
-                                          "bigWig.".format(pair[i]))
-                    else:
-                        tmp_pair.append(pair[i])
-                else:
+        conversion_jobs = []
+        for pair in pairs:
+            for file_path in pair:
+                if not os.path.exists(file_path):
                     logging.error("The file {} does not exist or the path is "
-                                  "incorrect.".count(pair[i]))
+                                  "incorrect.".format(file_path))
+                elif is_bedgraph(file_path):
+                    genome = rows_by_path.at[file_path, "genome"]
+                    conversion_jobs.append(
+                        [file_path, convert_for_genome,
+                         [file_path, genome, chrom_sizes_paths,
+                          conversion_tool]])
+
+        converted = collect_results(run_jobs(conversion_jobs, max_workers),
+                                    "could not be converted to bigWig")
+        converted_files = list(converted.values())
+
+        for pair in pairs:
+            tmp_pair = []
+            for file_path in pair:
+                if file_path in converted:
+                    tmp_pair.append(converted[file_path])
+                elif os.path.exists(file_path) and not is_bedgraph(file_path):
+                    tmp_pair.append(file_path)
             if len(tmp_pair) == 2:
                 pairs_merge.append(tmp_pair)
+                source_pairs.append(pair)
 
-        # Merge all file pairs with tool and save paths of merged files
-        print("- Merging pairs")
+        # Merge all file pairs and save paths of merged files
+        print("- Merging {} pairs".format(len(pairs_merge)))
 
-        for idx, pair in enumerate(pairs_merge):
-            print("Merging pair {0} of {1}: {2}, {3}".format(idx + 1,
-                  len(pairs_merge), pair[0], pair[1]))
+        merge_jobs = [[" + ".join(pair), merge_job,
+                       [pair[0], pair[1], merge_tool, native]] for pair in
+                      pairs_merge]
+        merged = collect_results(run_jobs(merge_jobs, max_workers,
+                                          use_processes=native),
+                                 "could not be merged")
 
-            merged_path = merge_pair(pair[0], pair[1], merge_tool)
-            if os.path.exists(merged_path):
-                merged_files.append(merged_path)
-            else:
-                logging.error("The files {0} and {1} could not be "
-                              "merged.".format(pair[0], pair[1]))
+        for pair, source_pair in zip(pairs_merge, source_pairs):
+            name = " + ".join(pair)
+            if name in merged:
+                merged_files.append(merged[name])
+                merged_pairs.append(source_pair)
 
         # Convert merged files to bigWig format if bedGraph is not an allowed format
-        allowed_file_formats = [file_format.lower() for file_format in
-                                allowed_file_formats]
         if "bedgraph" not in allowed_file_formats and ("bigwig" in
            allowed_file_formats or "bw" in allowed_file_formats):
-            print("- Converting merged files to bigWig")
+            # Natively merged files already are in bigWig format
+            conversion_jobs = []
+            for merged_file, merged_pair in zip(merged_files, merged_pairs):
+                if is_bedgraph(merged_file):
+                    genome = rows_by_path.at[merged_pair[0], "genome"]
+                    conversion_jobs.append(
+                        [merged_file, convert_for_genome,
+                         [merged_file, genome, chrom_sizes_paths,
+                          conversion_tool]])
+                    old_files.append(merged_file)
+
+            print("- Converting {} merged files to bigWig".format(
+                len(conversion_jobs)))
+            converted = collect_results(run_jobs(conversion_jobs, max_workers),
+                                        "could not be converted to bigWig")
 
             tmp_paths = []
-            for j in range(0, len(merged_files)):
-                print("Converting file {0} of {1}: {2}".format(j + 1,
-                      len(merged_files), merged_files[j]))
-
-                genome = linkage_frame.loc[linkage_frame["file_path"] ==
-                                           pairs[j][0]]["genome"]
-                chrom_sizes = [el for el in chrom_sizes_paths if
-                               genome.iloc[0] in el]
-                bw_file_path = convert_bedgraph_to_bigwig(merged_files[j],
-                                                          chrom_sizes[0],
-                                                          conversion_tool)
-                if not os.path.exists(bw_file_path):
-                    sort_file(merged_files[j])
-                    bw_file_path = convert_bedgraph_to_bigwig(merged_files[j],
-                                                              chrom_sizes[0],
-                                                              conversion_tool)
-                if os.path.exists(bw_file_path):
-                    tmp_paths.append(bw_file_path)
-                else:
-                    logging.error("The file {} could not be converted to "
-                                  "bigWig.".format(merged_files[j]))
-                old_files.append(merged_files[j])
+            tmp_pairs = []
+            for merged_file, merged_pair in zip(merged_files, merged_pairs):
+                if merged_file in converted:
+                    tmp_paths.append(converted[merged_file])
+                    tmp_pairs.append(merged_pair)
+                elif not is_bedgraph(merged_file):
+                    tmp_paths.append(merged_file)
+                    tmp_pairs.append(merged_pair)
             merged_files = tmp_paths
+            merged_pairs = tmp_pairs
 
         # Check if there are any bedGraph merged files that were converted to
         # bigWig and delete them since they are no longer needed
@@ -165,43 +196,38 @@ def merge_all(linkage_table_path, chrom_sizes_paths, allowed_file_formats,
                 print("Deleting file {0} of {1}".format(idx + 1, len(old_files)))
                 delete_file(file)
 
-        # Delete all forward/reverse files in bedGraph format now that they have
-        # been converted to bigWig
+        # Delete the forward/reverse files of all pairs that have been merged,
+        # files of failed jobs are kept so they can be merged in a later run
         cnt = 1
-        for pair in pairs:
+        for pair in merged_pairs:
             for k in range(0, len(pair)):
-                print("Deleting file {0} of {1}".format(cnt, len(pairs)*2))
+                print("Deleting file {0} of {1}".format(cnt,
+                      len(merged_pairs)*2))
                 delete_file(pair[k])
                 cnt += 1
 
         # Delete all forward/reverse files in bigWig format now that they have
         # been merged
         cnt = 1
-        for idx_pair in converted_idxs:
-            print("Deleting file {0} of {1}".format(cnt, len(converted_idxs)))
-            delete_file(pairs_merge[idx_pair[0]][idx_pair[1]])
+        for converted_file in converted_files:
+            print("Deleting file {0} of {1}".format(cnt, len(converted_files)))
+            delete_file(converted_file)
             cnt += 1
 
         print("- Appending entries for merged files to linking table")
 
-        # Make rows to append to linkage table .csv file for merged files
-        for m in range(0, len(merged_files)):
-            row = pd.DataFrame(linkage_frame.loc[linkage_frame['file_path'] ==
-                                                 pairs[m][0]])
-            row['file_path'] = merged_files[m]
-            row['filename'] = os.path.basename(merged_files[m])
-            rows.append(row)
-
-        # Concat rows to a tmp data frame and then append that to the linkage
-        # table .csv
-        if len(rows) > 0:
-            tmp_frame = rows[0]
-
-            for n in range(1, len(rows)):
-                tmp_frame = pd.concat([tmp_frame, rows[n]])
-
-            tmp_frame.to_csv(linkage_table_path, sep=';', index=False,
-                             header=False, mode='a')
+        # Make the rows for all merged files at once and append them to the
+        # linkage table .csv in a single write
+        if len(merged_files) > 0:
+            new_rows = rows_by_path.loc[[merged_pair[0] for merged_pair in
+                                         merged_pairs]].copy()
+            new_rows['file_path'] = merged_files
+            new_rows['filename'] = [os.path.basename(merged_file) for
+                                    merged_file in merged_files]
+            new_rows.to_csv(linkage_table_path, sep=';', index=False,
+                            header=False, mode='a')
+            if catalog is not None:
+                catalog.add_rows(new_rows.to_dict("records"), "temp")
 
 
 def read_linkage_table(linkage_table_path):
@@ -224,35 +250,62 @@ def find_pairs(linkage_frame):
     """
     Method pairs files that need to be merged.
 
+    Files are grouped by genome, biosource, chromosome and the experiment id
+    parsed from their filename, so pairing is done in a single pass over the
+    linkage frame instead of comparing every file with every other file.
+
     :param linkage_frame: Data frame containing all important info for files
                           to be merged
     :return: paris: A list of two dimensional lists containing the file paths to
                     the two files that need to be merged with each other
     """
 
+    groups = {}
+    has_chromosome = 'chromosome' in linkage_frame.columns
+
+    # The linking table contains one row for the .bw and one for the .bed
+    # entry of a file, both with the same file path. Only the first row of
+    # each path is taken into account.
+    for row in linkage_frame.drop_duplicates("file_path").itertuples(
+            index=False):
+        key = (row.genome, row.biosource,
+               row.chromosome if has_chromosome else None,
+               parse_experiment_id(row.file_path))
+        groups.setdefault(key, []).append(row.file_path)
+
     pairs = []
 
-    for i in range(0, len(linkage_frame["file_path"]) - 1):
-        filename = os.path.basename(linkage_frame["file_path"][i])
-        file_id = filename.split(".")[0]
-
-        for j in range(i + 1, len(linkage_frame["file_path"])):
-            if linkage_frame["genome"][i] == linkage_frame["genome"][j] and \
-                    linkage_frame["biosource"][i] == \
-                    linkage_frame["biosource"][j] and file_id in \
-                    linkage_frame["file_path"][j]:
-                if 'chromosome' in linkage_frame.columns:
-                    if linkage_frame["chromosome"][i] == \
-                            linkage_frame["chromosome"][j]:
-                        pairs.append([linkage_frame["file_path"][i],
-                                      linkage_frame["file_path"][j]])
-                else:
-                    pairs.append([linkage_frame["file_path"][i],
-                                  linkage_frame["file_path"][j]])
+    for file_paths in groups.values():
+        forward = [path for path in file_paths if
+                   "forward" in os.path.basename(path).lower()]
+        reverse = [path for path in file_paths if
+                   "reverse" in os.path.basename(path).lower()]
+
+        if len(forward) == len(reverse) and len(forward) > 0:
+            pairs.extend([list(pair) for pair in zip(forward, reverse)])
+        elif len(file_paths) == 2:
+            pairs.append(file_paths)
+        elif len(file_paths) > 1:
+            logging.warning("The files {} could not be paired for "
+                            "merging.".format(", ".join(file_paths)))
 
     return pairs
 
 
+def parse_experiment_id(file_path):
+    """
+    Method parses the experiment id out of the filename of a forward/reverse
+    read file by taking the first part of the filename and removing the
+    forward/reverse suffix.
+
+    :param file_path: String containing path to file
+    :return: experiment_id: String with id shared by forward and reverse file
+    """
+    file_id = os.path.basename(file_path).split(".")[0]
+    return re.sub(r"[_\-]?(forward|reverse)$", "", file_id,
+                  flags=re.IGNORECASE)
+
+
 def convert_bedgraph_to_bigwig(bg_file_path, chrom_sizes_path,
                                conversion_tool_path="bedGraphToBigWig"):
     """
@@ -267,15 +320,77 @@ def convert_bedgraph_to_bigwig(bg_file_path, chrom_sizes_path,
     bw_file_path = bg_file_path.rsplit(".", maxsplit=1)[0] + ".bw"
 
     if os.path.exists(bg_file_path):
-        command = conversion_tool_path + " \"" + bg_file_path + "\" \"" + \
-                  chrom_sizes_path + "\" \"" + bw_file_path + "\""
-
-        os.system(command)
-    # else for logging
+        run_command([conversion_tool_path, bg_file_path, chrom_sizes_path,
+                     bw_file_path])
+    else:
+        raise FileNotFoundError(
+            "The file {} does not exist or the file path is incorrect.".format(
+                bg_file_path))
 
     return bw_file_path
 
 
+def convert_and_sort(bg_file_path, chrom_sizes_path,
+                     conversion_tool_path="bedGraphToBigWig"):
+    """
+    Method converts a bedGraph file into a bigWig file. If the conversion tool
+    fails, the file is sorted and the conversion is tried again.
+
+    :param bg_file_path: String containing path to bedGraph file
+    :param chrom_sizes_path: String containing path to chrom.sizes file
+    :param conversion_tool_path: String containing path to conversion tool
+    :return: Path to new bigWig file
+    """
+    try:
+        return convert_bedgraph_to_bigwig(bg_file_path, chrom_sizes_path,
+                                          conversion_tool_path)
+    except subprocess.CalledProcessError:
+        sort_file(bg_file_path)
+        return convert_bedgraph_to_bigwig(bg_file_path, chrom_sizes_path,
+                                          conversion_tool_path)
+
+
+def convert_for_genome(bg_file_path, genome, chrom_sizes_paths,
+                       conversion_tool_path="bedGraphToBigWig"):
+    """
+    Method finds the chrom.sizes file of the genome and converts a bedGraph
+    file into a bigWig file (see convert_and_sort). The chrom.sizes file is
+    looked up in the job, so a genome without one only fails the jobs of its
+    own files.
+
+    :param bg_file_path: String containing path to bedGraph file
+    :param genome: String with name of genome
+    :param chrom_sizes_paths: List of Strings containing paths to all
+           chrom.sizes files
+    :param conversion_tool_path: String containing path to conversion tool
+    :return: Path to new bigWig file
+    """
+    return convert_and_sort(bg_file_path,
+                            find_chrom_sizes(genome, chrom_sizes_paths),
+                            conversion_tool_path)
+
+
+def merged_path(file_path, ending):
+    """
+    Method makes the path of the merged file of a pair in the folder of its
+    first file. The forward/reverse part of the filename is replaced by
+    "merged" and the rest of the name (e.g. the chromosome) is kept, so the
+    pairs that are merged at the same time never write into the same file.
+    Filenames without forward/reverse are cut at their first "_".
+
+    :param file_path: String containing path to the first file of the pair
+    :param ending: String with the file ending of the merged file
+    :return: Path to the merged file
+    """
+    directory, filename = os.path.split(file_path)
+    name = filename.rsplit(".", maxsplit=1)[0]
+    merged_name = re.sub(r"forward|reverse", "merged", name, count=1,
+                         flags=re.IGNORECASE)
+    if merged_name == name:
+        merged_name = filename.split("_")[0] + "_merged"
+    return os.path.join(directory, merged_name + ending)
+
+
 def merge_pair(bw_file_path_1, bw_file_path_2, merge_tool_path="bigWigMerge"):
     """
     Method merges two bigWig forward/reverse read files into one bedGraph file
@@ -286,18 +401,216 @@ def merge_pair(bw_file_path_1, bw_file_path_2, merge_tool_path="bigWigMerge"):
     :return: Path to new merged file
     """
 
-    merged_file_path = bw_file_path_1.split("_")[0] + "_merged.bedGraph"
+    merged_file_path = merged_path(bw_file_path_1, ".bedGraph")
 
     if os.path.exists(bw_file_path_1) and os.path.exists(bw_file_path_2):
-        command = merge_tool_path + " \"" + bw_file_path_1 + "\" \"" + \
-                  bw_file_path_2 + "\" \"" + merged_file_path + "\""
+        run_command([merge_tool_path, bw_file_path_1, bw_file_path_2,
+                     merged_file_path])
+    else:
+        raise FileNotFoundError("The files {0} and {1} do not exist or the "
+                                "file paths are incorrect.".format(
+                                    bw_file_path_1, bw_file_path_2))
+
+    return merged_file_path
+
+
+def merge_job(bw_file_path_1, bw_file_path_2, merge_tool_path="bigWigMerge",
+              native=True):
+    """
+    Method merges a pair natively if requested and falls back to the merging
+    tool if the native merge fails.
+
+    :param bw_file_path_1: String containing path to first file
+    :param bw_file_path_2: String containing path to second file
+    :param merge_tool_path: String containing path to merging tool
+    :param native: Boolean, if True the pair is merged with pyBigWig first
+    :return: Path to new merged file
+    """
+    if native:
+        try:
+            return merge_pair_native(bw_file_path_1, bw_file_path_2)
+        except RuntimeError as err:
+            logging.warning("The files {0} and {1} could not be merged "
+                            "natively, falling back to {2}: {3}".format(
+                                bw_file_path_1, bw_file_path_2,
+                                merge_tool_path, err))
+
+    return merge_pair(bw_file_path_1, bw_file_path_2, merge_tool_path)
+
+
+def merge_pair_native(bw_file_path_1, bw_file_path_2, threshold=0):
+    """
+    Method merges two bigWig forward/reverse read files into one bigWig file
+    without calling external tools. Both files are read chromosome by
+    chromosome, the values of overlapping intervals are summed up and the
+    result is written directly as bigWig. Like bigWigMerge, regions with a
+    summed value at or below the threshold are left out.
+
+    :param bw_file_path_1: String containing path to first file
+    :param bw_file_path_2: String containing path to second file
+    :param threshold: Float, values at or below it are not written
+    :return: Path to new merged file
+    """
 
-        os.system(command)
-    # else für logging
+    merged_file_path = merged_path(bw_file_path_1, ".bw")
+    tmp_file_path = merged_file_path + ".tmp"
+
+    bw_1 = bw_2 = bw_merged = None
+
+    try:
+        bw_1 = pyBigWig.open(bw_file_path_1)
+        bw_2 = pyBigWig.open(bw_file_path_2)
+        chroms = dict(bw_1.chroms())
+        for chrom, length in bw_2.chroms().items():
+            chroms[chrom] = max(length, chroms.get(chrom, 0))
+        header = list(chroms.items())
+
+        bw_merged = pyBigWig.open(tmp_file_path, 'w')
+        bw_merged.addHeader(header)
+
+        for chrom, _ in header:
+            starts, ends, values = sum_intervals(
+                [read_intervals(bw_1, chrom), read_intervals(bw_2, chrom)],
+                threshold)
+            if len(starts) > 0:
+                bw_merged.addEntries([chrom] * len(starts), starts.tolist(),
+                                     ends=ends.tolist(),
+                                     values=values.tolist())
+    except BaseException:
+        # a partly written file must not be taken for a merged one
+        if bw_merged is not None:
+            bw_merged.close()
+            bw_merged = None
+        delete_file(tmp_file_path)
+        raise
+    finally:
+        for bw in (bw_1, bw_2, bw_merged):
+            if bw is not None:
+                bw.close()
+
+    os.rename(tmp_file_path, merged_file_path)
 
     return merged_file_path
 
 
+def read_intervals(bw, chrom):
+    """
+    Method reads all intervals of one chromosome from an open bigWig file.
+
+    :param bw: Open pyBigWig file
+    :param chrom: String with name of chromosome
+    :return: starts, ends, values: Numpy arrays with the interval starts, ends
+             and values, empty if there is no data for the chromosome
+    """
+    intervals = None
+    if chrom in bw.chroms():
+        intervals = bw.intervals(chrom)
+
+    if not intervals:
+        return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64),
+                np.empty(0))
+
+    intervals = np.array(intervals)
+    return (intervals[:, 0].astype(np.int64), intervals[:, 1].astype(np.int64),
+            intervals[:, 2])
+
+
+def sum_intervals(tracks, threshold=0):
+    """
+    Method sums up the values of several tracks of non overlapping, sorted
+    intervals. The tracks are cut at every interval boundary, the values of
+    all tracks covering a segment are added up and neighbouring segments with
+    the same value are joined again.
+
+    :param tracks: List of (starts, ends, values) tuples of numpy arrays
+    :param threshold: Float, segments with a sum at or below it are dropped
+    :return: starts, ends, values: Numpy arrays of the summed intervals
+    """
+    breakpoints = np.unique(np.concatenate(
+        [np.concatenate([starts, ends]) for starts, ends, _ in tracks]))
+
+    if len(breakpoints) < 2:
+        return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64),
+                np.empty(0))
+
+    seg_starts = breakpoints[:-1]
+    seg_ends = breakpoints[1:]
+    seg_values = np.zeros(len(seg_starts))
+
+    for starts, ends, values in tracks:
+        if len(starts) == 0:
+            continue
+        # index of the last interval starting at or before each segment
+        idx = np.searchsorted(starts, seg_starts, side='right') - 1
+        covered = idx >= 0
+        idx[~covered] = 0
+        covered &= ends[idx] > seg_starts
+        seg_values += np.where(covered, values[idx], 0)
+
+    keep = seg_values > threshold
+    seg_starts = seg_starts[keep]
+    seg_ends = seg_ends[keep]
+    seg_values = seg_values[keep]
+
+    if len(seg_starts) == 0:
+        return seg_starts, seg_ends, seg_values
+
+    # join adjacent segments with equal values
+    new_run = np.ones(len(seg_starts), dtype=bool)
+    new_run[1:] = (seg_starts[1:] != seg_ends[:-1]) | \
+                  (seg_values[1:] != seg_values[:-1])
+    run_starts = np.flatnonzero(new_run)
+    run_ends = np.append(run_starts[1:] - 1, len(seg_starts) - 1)
+
+    return seg_starts[run_starts], seg_ends[run_ends], seg_values[run_starts]
+
+
+def is_bedgraph(file_path):
+    """
+    Method checks by file extension if a file is in bedGraph format.
+
+    :param file_path: String containing path to file
+    :return: True if file has bedGraph extension, False if not
+    """
+    return os.path.splitext(file_path)[1].lower() == ".bedgraph"
+
+
+def find_chrom_sizes(genome, chrom_sizes_paths):
+    """
+    Method finds the chrom.sizes file for a genome.
+
+    :param genome: String with name of genome
+    :param chrom_sizes_paths: List of Strings containing paths to all
+           chrom.sizes files
+    :return: String with path to chrom.sizes file of genome
+    """
+    chrom_sizes = [el for el in chrom_sizes_paths if genome in el]
+    if len(chrom_sizes) == 0:
+        raise FileNotFoundError("No chrom.sizes file was found for genome "
+                                "{}.".format(genome))
+    return chrom_sizes[0]
+
+
+def collect_results(results, error_message):
+    """
+    Method collects the values of all successful jobs and logs the failed
+    ones.
+
+    :param results: List of JobResults returned by run_jobs
+    :param error_message: String describing what went wrong for failed jobs
+    :return: Dictionary with job name as key and job value as value
+    """
+    values = {}
+    for result in results:
+        if result.returncode == 0 and result.value is not None and \
+                os.path.exists(result.value):
+            values[result.name] = result.value
+        else:
+            logging.error("{0} {1}: {2}".format(result.name, error_message,
+                                                result.stderr.strip()))
+    return values
+
+
 def delete_file(file_path):
     """
     Method deletes a file.
@@ -318,10 +631,9 @@ def sort_file(file_path):
     :param file_path: String containing path to file that needs to be sorted
     """
     if os.path.exists(file_path):
-        sort = 'LC_COLLATE=C sort -k1,1 -k2,2n '
         tmp_file_path = file_path + '.tmp'
-        command = sort + '\"' + file_path + '\" > \"' + tmp_file_path + '\"'
-        os.system(command)
+        run_command(['sort', '-k1,1', '-k2,2n', file_path],
+                    stdout_path=tmp_file_path, env={'LC_COLLATE': 'C'})
         os.rename(tmp_file_path, file_path)
 
     else:
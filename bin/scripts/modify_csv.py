@@ -40,9 +40,23 @@ class modifyCSV:
         None.
 
         """
-        df = pd.DataFrame( columns=['genome','width','mode','chr','biosource','tf'])
-        df_length = len(df)
-        df.loc[df_length] = parameters
+        self.compareAll([parameters])
+    
+    def compareAll(self, parameters_list):
+        """
+        Same as compare for the arguments of several analyses at once, so
+        result.csv is only read and written once.
+
+        Parameters
+        ----------
+        parameters_list : List of Lists of given Arguments
+
+        Returns
+        -------
+        None.
+
+        """
+        df = pd.DataFrame(parameters_list, columns=['genome','width','mode','chr','biosource','tf'])
         
         try:
             
@@ -57,6 +71,8 @@ class modifyCSV:
             data.pop('path')
             data.pop('time')
             data.pop('vis_filename')
+            #columns of the component search and warm start, missing in older result.csv files
+            data = data.drop(columns=['n_components', 'n_fits', 'criterion', 'warm_start'], errors='ignore')
             
             
             count = 0
@@ -66,7 +82,7 @@ class modifyCSV:
             
             for row in range(len(data)):
                 
-                if((data.iloc[row].values == df.values).all()):
+                if((data.iloc[row].values == df.values).all(axis=1).any()):
                     
                     print("replacing old item in result.csv")
                     tochange.append(count)
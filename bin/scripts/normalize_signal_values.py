@@ -8,6 +8,9 @@ log-scaled
 - min-max-scale all files (to a range of 0-1) with global min and max values
 derived from the log-scaled values of all files in current analysis run
 
+Compressed bed and bedGraph files (.gz, .zst) are decompressed and compressed
+again while they are streamed, see compression.py.
+
 
 Use as follows:
 
@@ -26,26 +29,30 @@ import numpy
 import pyBigWig
 import logging
 import sys
+from scripts.compression import open_text, compression_of
 
 
-def normalize_all(linkage_table_path):
+def normalize_all(linkage_table_path, linkage_table=None):
     """
     Method normalizes all files through log scaling first and then
     min-max scaling to a uniform range between 0 and 1.
 
     :param linkage_table_path: String with path to linkage table .csv
            file containing the files that are part of the current analysis run.
+    :param linkage_table: Data frame with the rows of the linkage table, e.g.
+           queried from the catalog. If given, the .csv file is not read.
     """
     print("------ Normalize signal values ------")
     print("- Reading in normalization.csv")
 
-    if os.path.exists(linkage_table_path):
-        linkage_table = pd.read_csv(linkage_table_path, sep=';',
-                                    index_col=False)
-    else:
-        raise FileNotFoundError(
-            "The file {} does not exist or the file path is incorrect.".format(
-                linkage_table_path))
+    if linkage_table is None:
+        if os.path.exists(linkage_table_path):
+            linkage_table = pd.read_csv(linkage_table_path, sep=';',
+                                        index_col=False)
+        else:
+            raise FileNotFoundError(
+                "The file {} does not exist or the file path is "
+                "incorrect.".format(linkage_table_path))
 
     file_paths = list(linkage_table["file_path"])
     column_names = list(linkage_table["format"])
@@ -220,12 +227,13 @@ def log_scale_file(file_path, column_names=None):
 
             # check if file has a header that would interfere with using
             # numpy.loadtxt() and skip first row in file if so
-            with open(file_path, 'r') as file:
+            with open_text(file_path) as file:
                 first_line = file.readline()
             skip_rows = 0 if is_float(first_line.split('\t')[idx]) else 1
 
-            signal_values = numpy.loadtxt(file_path, usecols=[idx],
-                                          skiprows=skip_rows)
+            with open_text(file_path) as file:
+                signal_values = numpy.loadtxt(file, usecols=[idx],
+                                              skiprows=skip_rows)
             # Make sure there are no 0s in array before attempting log-scaling
             # if there are, replace them with '1' so the value after scaling
             # will be 0
@@ -332,12 +340,14 @@ def min_max_scale_file(file_path, log_file_path, min_val,
         cnt = 0
 
         # Check if file has head and if so copy first line from current file
-        # to tmp file and then start printing files with values
-        with open(file_path, 'r') as file:
+        # to tmp file and then start printing files with values. The tmp
+        # file gets the compression of the file.
+        with open_text(file_path) as file:
             first_line = file.readline()
         skip_rows = False if is_float(first_line.split('\t')[idx]) else True
 
-        with open(file_path, 'r') as file, open(tmp_file_path, 'w') as tmp_file:
+        with open_text(file_path) as file, open_text(
+                tmp_file_path, 'w', compression_of(file_path)) as tmp_file:
             if skip_rows:
                 row = file.readline().strip() + '\n'
                 tmp_file.write(row)
@@ -0,0 +1,136 @@
+"""
+Incremental executor for the stages of the data preparation phase.
+
+Every stage declares the items it works on (usually files) together with
+their inputs. The executor computes a fingerprint of the inputs of every
+item and compares it with the fingerprint recorded in the catalog after the
+last successful run of the stage. Only the items whose fingerprints changed,
+whose outputs are missing or that are new are passed on to the stage, and a
+stage without such items is skipped completely.
+
+Inputs are paths or plain values. Existing files are fingerprinted by their
+name, size and modification time, so renaming a file inside its folder does
+not change the fingerprint as long as the name without its .txt ending stays
+the same (the ending of a compression, see compression.py, is kept). All
+other inputs (e.g. a row of the linking table or a parameter) are
+fingerprinted by their value.
+
+
+Use as follows:
+
+    from scripts.pipeline import Stage, Executor
+
+    stage = Stage("convert", items, run, outputs)
+    Executor(catalog, force=False).run(stage)
+"""
+
+import os
+import hashlib
+import logging
+from scripts.compression import strip_suffix
+
+
+class Stage:
+    """A stage of the data preparation phase."""
+
+    def __init__(self, name, items, run, outputs=None):
+        """
+        :param name: name of the stage, used to record the fingerprints
+        :param items: function returning a dictionary {item: list of inputs}
+        :param run: function called with the list of changed items. Returns
+               the list of items that were processed successfully or None if
+               all of them were.
+        :param outputs: function returning the list of output paths of an
+               item, items with missing outputs are run again
+        """
+        self.name = name
+        self.items = items
+        self.run = run
+        self.outputs = outputs
+
+
+class Executor:
+    """Runs stages for the items whose inputs changed."""
+
+    def __init__(self, catalog, force=False):
+        """
+        :param catalog: scripts.catalog.Catalog the fingerprints are kept in
+        :param force: Boolean, if True all items of every stage are run
+        """
+        self.catalog = catalog
+        self.force = force
+
+    def changed(self, stage, force=False):
+        """
+        Finds the items of a stage that would be run, without running it.
+
+        :param stage: Stage to check
+        :param force: Boolean, if True all items of the stage are changed
+        :return: tuple of the dictionary of all items and the list of the
+                 changed items
+        """
+        items = stage.items()
+        recorded = self.catalog.fingerprints(stage.name)
+        changed = []
+        for item, inputs in items.items():
+            if (self.force or force or
+                    recorded.get(item) != fingerprint(inputs) or
+                    (stage.outputs is not None and not all(
+                        os.path.exists(path) for path in
+                        stage.outputs(item)))):
+                changed.append(item)
+        return items, changed
+
+    def run(self, stage, force=False):
+        """
+        Runs a stage for all changed items and records the fingerprints of
+        the successfully processed items.
+
+        :param stage: Stage to run
+        :param force: Boolean, if True all items of the stage are run
+        :return: list of the items that were run
+        """
+        items, changed = self.changed(stage, force)
+
+        if not changed:
+            print("{0}: nothing changed, skipping".format(stage.name))
+            logging.info("skipped stage {0}, {1} items unchanged".format(
+                stage.name, len(items)))
+            return []
+
+        logging.info("running stage {0} for {1} of {2} items".format(
+            stage.name, len(changed), len(items)))
+        done = stage.run(changed)
+        if done is None:
+            done = changed
+
+        # record the fingerprints after the run, the stage may have created
+        # some of the inputs (e.g. log-scaled files) or renamed them
+        items = stage.items()
+        self.catalog.set_fingerprints(stage.name, {
+            item: fingerprint(items[item]) for item in done if item in items})
+
+        return changed
+
+
+def fingerprint(inputs):
+    """
+    Computes the fingerprint of the inputs of an item.
+
+    :param inputs: list of paths or values
+    :return: String with the sha1 hash of the inputs
+    """
+    digest = hashlib.sha1()
+    for value in inputs:
+        value = str(value)
+        if os.path.isfile(value):
+            stat = os.stat(value)
+            name = os.path.basename(value)
+            base = strip_suffix(name)
+            if base.endswith(".txt") and not base.endswith(".meta.txt"):
+                name = base[:-len(".txt")] + name[len(base):]
+            value = "{0}:{1}:{2}".format(name, stat.st_size,
+                                         stat.st_mtime_ns)
+        digest.update(value.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
@@ -0,0 +1,371 @@
+"""
+Dry run planner for tf_analyzer.py --plan.
+
+Finds the stages a run would execute with the same checks as
+scripts.pipeline, without running anything, and estimates for every stage:
+- the number of files it touches (and how many of them are linked from the
+  artifact cache instead)
+- the number of bytes it reads
+- its wall time and peak memory
+
+The estimates are based on the region counts of the linking table, the sizes
+of the files on disk, the state of the artifact cache and the number of
+peaks in the pickle files of the ChIP-seq data (the peak store). Files that
+are not downloaded yet are estimated from their region counts, ATAC/DNase-seq
+downloads from the downloads already on disk. The throughputs below are rough
+values of a single worker and depend on the host and the storage.
+
+Online, the linking table is generated again before the download, so the
+plan is based on the linking table of the last run.
+
+
+Use as follows:
+
+    from scripts.planner import plan_run, print_plan
+
+    print_plan(plan_run(data_config))
+"""
+
+import os
+import pickle
+from tabulate import tabulate
+from scripts.pipeline import Executor
+from scripts.compression import strip_suffix
+
+DOWNLOAD_BYTES_PER_SECOND = 5 * 1024 ** 2
+CONVERT_BYTES_PER_SECOND = 20 * 1024 ** 2
+MERGE_BYTES_PER_SECOND = 50 * 1024 ** 2
+NORMALIZE_BYTES_PER_SECOND = 30 * 1024 ** 2
+SORT_FILES_PER_SECOND = 50
+PICKLE_PEAKS_PER_SECOND = 20000
+SCORE_PEAKS_PER_SECOND = 2000
+FIT_PEAKS_PER_SECOND = 500
+
+# size of a region in a DeepBlue export, of an ATAC/DNase-seq download if no
+# download is on disk yet and of a bigWig compared to its text file
+BYTES_PER_REGION = 90
+ATAC_BYTES = 200 * 1024 ** 2
+BIGWIG_RATIO = 0.4
+
+# memory of a python process with pandas and numpy, of a batch of lines in
+# convert_files.py, of a downloaded chunk and of a peak while it is pickled,
+# scored and fitted
+BASE_MEMORY = 150 * 1024 ** 2
+CONVERT_BATCH_MEMORY = 500000 * 200
+DOWNLOAD_CHUNK_MEMORY = 64 * 1024 ** 2
+PEAK_MEMORY = 200
+FIT_MEMORY_PER_PEAK = 2048
+
+
+def plan_run(config):
+    """
+    Plans the data preparation and analysis of a run.
+
+    :param config: generate_data.DataConfig of the run
+    :return: list of dictionaries with the keys stage, runs, files, total,
+             cached, bytes, seconds, memory and note
+    """
+    threads = config.threads or os.cpu_count() or 1
+    executor = Executor(config.catalog)
+    stages = {stage.name: (stage, force) for stage, force in config.stages()}
+    download = os.path.join(config.outpath, "data", "download")
+    names = os.listdir(download) if os.path.isdir(download) else []
+
+    rows = config.select_files("download")
+    atac_bytes = measured_atac_bytes(config, rows, download, names)
+
+    def text_bytes(row):
+        files = [name for name in config.download_files(row.filename, names)
+                 if not name.endswith(".meta.txt")]
+        if files:
+            return sum(os.path.getsize(os.path.join(download, name)) for name
+                       in files)
+        if row.technique.lower() == "chip-seq":
+            return int(row.regions) * BYTES_PER_REGION
+        return atac_bytes
+
+    plans = []
+
+    # download
+    downloaded = []
+    if "download" in stages:
+        stage, force = stages["download"]
+        items, changed = executor.changed(stage, force)
+        changed_rows = rows[rows.filename.isin(changed)]
+        cached = [row.filename for row in changed_rows.itertuples(
+            index=False) if cached_size(config, "download", row) is not None]
+        sizes = [text_bytes(row) for row in changed_rows.itertuples(
+            index=False) if row.filename not in cached]
+        connections = (config.threads or 4) if \
+            config.downloader == "python" else 1
+        plans.append(stage_plan(
+            "download", changed, items, cached, sum(sizes),
+            sum(sizes) / (DOWNLOAD_BYTES_PER_SECOND * connections),
+            BASE_MEMORY + connections * 3 * min(
+                max(sizes, default=0), DOWNLOAD_CHUNK_MEMORY),
+            note(config, stage.name, items, changed, force,
+                 "linking table of the last run")))
+        downloaded = list(changed)
+
+    # validation and conversion, new downloads become new items
+    stage, force = stages["convert"]
+    items, changed = executor.changed(stage, force)
+    converted = sorted(set(changed) | set(downloaded))
+    converted_rows = rows[rows.filename.isin(converted)]
+    cached = [row.filename for row in converted_rows.itertuples(index=False)
+              if cached_size(config, "converted", row) is not None]
+    sizes = {row.filename: text_bytes(row) for row in
+             converted_rows.itertuples(index=False)}
+    workers = max(1, min(threads, len(converted) - len(cached)))
+    convert_bytes = sum(size for filename, size in sizes.items() if
+                        filename not in cached)
+    plans.append(stage_plan(
+        "convert", converted, set(items) | set(downloaded), cached,
+        convert_bytes, convert_bytes / (CONVERT_BYTES_PER_SECOND * workers),
+        BASE_MEMORY + workers * (BASE_MEMORY + CONVERT_BATCH_MEMORY),
+        note(config, stage.name, items, changed, force)))
+
+    # merging of forward/reverse reads of the converted files
+    merge_rows = converted_rows[
+        (converted_rows.technique.str.lower() == "atac-seq") &
+        converted_rows.filename.str.contains("forward|reverse")]
+    merge_bytes = sum(sizes[filename] for filename in merge_rows.filename) \
+        * BIGWIG_RATIO
+    workers = max(1, min(threads, len(merge_rows) // 2))
+    plans.append(stage_plan(
+        "merge", list(merge_rows.filename), merge_rows.filename, [],
+        merge_bytes, merge_bytes / (MERGE_BYTES_PER_SECOND * workers),
+        BASE_MEMORY + workers * 4 * max(
+            [sizes[filename] * BIGWIG_RATIO * 2 for filename in
+             merge_rows.filename], default=0)))
+
+    # sorting, the .bw and .bed file of every converted ChIP-seq file
+    chip_rows = converted_rows[
+        converted_rows.technique.str.lower() == "chip-seq"]
+    sorted_files = len(converted_rows) + len(chip_rows)
+    plans.append(stage_plan(
+        "sort", range(sorted_files), range(sorted_files), [], 0,
+        sorted_files / SORT_FILES_PER_SECOND, BASE_MEMORY))
+
+    # peaks of the peak store and of the converted ChIP-seq files
+    store = peak_store(config)
+    new_peaks = {base_name(filename): int(regions) for filename, regions in
+                 zip(chip_rows.filename, chip_rows.regions)}
+    peaks = dict(store)
+    peaks.update(new_peaks)
+
+    stage, force = stages["pickle"]
+    items, changed = executor.changed(stage, force)
+    pickled = set(base_name(item) for item in changed) | set(new_peaks)
+    pickle_peaks = sum(peaks.get(name, 0) for name in pickled)
+    plans.append(stage_plan(
+        "pickle", pickled, set(base_name(item) for item in items) |
+        set(new_peaks), [],
+        pickle_peaks * BYTES_PER_REGION,
+        pickle_peaks / PICKLE_PEAKS_PER_SECOND,
+        BASE_MEMORY + sum(peaks.values()) * PEAK_MEMORY,
+        note(config, stage.name, items, changed, force)))
+
+    # normalization of all selected bigWig files
+    stage, force = stages["normalize"]
+    items, changed = executor.changed(stage, force)
+    bigwigs = config.select_files("sorted", ["%.bw"]).file_path
+    normalize_bytes = sum(os.path.getsize(path) for path in bigwigs if
+                          os.path.exists(path)) + BIGWIG_RATIO * sum(
+        sizes[filename] for filename in converted_rows.filename if
+        base_name(filename) not in set(base_name(path) for path in bigwigs))
+    runs = bool(changed) or len(converted) > 0
+    normalized = set(base_name(path) for path in bigwigs) | set(
+        base_name(filename) for filename in converted_rows.filename)
+    plans.append(stage_plan(
+        "normalize", normalized if runs else [], normalized, [],
+        normalize_bytes if runs else 0,
+        3 * normalize_bytes / NORMALIZE_BYTES_PER_SECOND if runs else 0,
+        BASE_MEMORY + DOWNLOAD_CHUNK_MEMORY if runs else 0))
+
+    # scores and analysis of the peaks
+    total_peaks = sum(peaks.values())
+    plans.append(stage_plan(
+        "score", peaks, peaks, [], total_peaks * BYTES_PER_REGION,
+        total_peaks / SCORE_PEAKS_PER_SECOND,
+        BASE_MEMORY + total_peaks * PEAK_MEMORY * 2,
+        "{0} peaks, {1} not in the peak store yet".format(
+            total_peaks, sum(count for name, count in new_peaks.items() if
+                             name not in store))))
+    tf_peaks = peaks_per_tf(config, store, chip_rows)
+    plans.append(stage_plan(
+        "analysis", tf_peaks, tf_peaks, [], 0,
+        total_peaks / FIT_PEAKS_PER_SECOND,
+        BASE_MEMORY + max(tf_peaks.values(), default=0) * FIT_MEMORY_PER_PEAK,
+        "{0} transcription factors".format(len(tf_peaks))))
+
+    return plans
+
+
+def stage_plan(name, changed, items, cached, nbytes, seconds, memory,
+               note=""):
+    """
+    :return: dictionary with the plan of a stage
+    """
+    changed = list(changed)
+    return {"stage": name, "runs": len(changed) > 0, "files": len(changed),
+            "total": len(list(items)), "cached": len(cached),
+            "bytes": int(nbytes) if changed else 0,
+            "seconds": seconds if changed else 0,
+            "memory": int(memory) if changed else 0, "note": note}
+
+
+def note(config, name, items, changed, force, extra=None):
+    """
+    Explains why a stage runs for all of its items, e.g. to spot an
+    accidental full re-run.
+
+    :return: String
+    """
+    notes = [extra] if extra else []
+    if force and changed:
+        notes.append("forced by --redo_file_validation")
+    elif changed and len(changed) == len(items) and \
+            config.catalog.fingerprints(name):
+        notes.append("full re-run, all inputs changed")
+    return ", ".join(notes)
+
+
+def cached_size(config, stage, row):
+    """
+    :return: size of the artifact of a row in the artifact cache or None
+    """
+    if config.cache is None:
+        return None
+    return config.cache.size_of(config.cache_key(stage, row))
+
+
+def measured_atac_bytes(config, rows, download, names):
+    """
+    :return: mean size of the ATAC/DNase-seq downloads on disk or ATAC_BYTES
+    """
+    sizes = []
+    for row in rows[rows.technique.str.lower() != "chip-seq"].itertuples(
+            index=False):
+        files = [name for name in config.download_files(row.filename, names)
+                 if not name.endswith(".meta.txt")]
+        if files:
+            sizes.append(sum(os.path.getsize(os.path.join(download, name))
+                             for name in files))
+    return sum(sizes) / len(sizes) if sizes else ATAC_BYTES
+
+
+def load_peak_store(config):
+    """
+    Loads the ChIP-seq pickle files of the selected biosources.
+
+    :return: generator of (tf, bigwig path, {chromosome: peaks}) tuples of
+             the selected tfs
+    """
+    biosources = set(x.lower().replace("\\'", "'") for x in config.biosource)
+    tfs = set(x.lower() for x in config.epigenetic_mark)
+    for genome in config.genome:
+        path = os.path.join(config.outpath, "data", "pickledata", genome,
+                            "chip-seq")
+        if not os.path.isdir(path):
+            continue
+        for file in os.listdir(path):
+            name, ending = os.path.splitext(file)
+            if ending != ".pickle" or name.lower() not in biosources:
+                continue
+            with open(os.path.join(path, file), "rb") as handle:
+                bs_bed_dict = pickle.load(handle)
+            for tf, files in bs_bed_dict.items():
+                if tf.lower() in tfs:
+                    for bw, chromosomes in files.items():
+                        yield tf.lower(), bw, chromosomes
+
+
+def peak_store(config):
+    """
+    Counts the peaks of the selected chromosomes in the peak store.
+
+    :return: dictionary {name of the file without ending: number of peaks}
+    """
+    peaks = {}
+    for _, bw, chromosomes in load_peak_store(config):
+        peaks[base_name(bw)] = sum(len(chromosomes.get(chrom, [])) for chrom in
+                          config.chromosome)
+    return peaks
+
+
+def peaks_per_tf(config, store, chip_rows):
+    """
+    Counts the peaks of every transcription factor in the peak store and of
+    the converted ChIP-seq files.
+
+    :return: dictionary {tf: number of peaks}
+    """
+    tfs = {}
+    known = set()
+    for tf, bw, _ in load_peak_store(config):
+        name = base_name(bw)
+        known.add(name)
+        tfs[tf] = tfs.get(tf, 0) + store.get(name, 0)
+    for row in chip_rows.itertuples(index=False):
+        if base_name(row.filename) not in known:
+            tf = row.epigenetic_mark.lower()
+            tfs[tf] = tfs.get(tf, 0) + int(row.regions)
+    return tfs
+
+
+def base_name(path):
+    """
+    Name of a file without folder, compression and the ending of its
+    filetype, which is the same for the downloaded, .bed and .bw file.
+
+    :param path: path to the file
+    :return: String
+    """
+    name, ending = os.path.splitext(os.path.basename(strip_suffix(path)))
+    if ending.lower() in [".bed", ".bedgraph", ".bw", ".bigwig"]:
+        return name
+    return name + ending
+
+
+def format_bytes(nbytes):
+    """
+    :return: String with the size in B, KB, MB, GB or TB
+    """
+    for unit in ["B", "KB", "MB", "GB"]:
+        if nbytes < 1024:
+            return "{0:.0f} {1}".format(nbytes, unit)
+        nbytes /= 1024
+    return "{0:.1f} TB".format(nbytes)
+
+
+def format_seconds(seconds):
+    """
+    :return: String with the duration in h, min and s
+    """
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return "{0}h {1:02d}min".format(seconds // 3600, seconds % 3600 // 60)
+    if seconds >= 60:
+        return "{0}min {1:02d}s".format(seconds // 60, seconds % 60)
+    return "{0}s".format(seconds)
+
+
+def print_plan(plans):
+    """
+    Prints the plan of a run as a table with the total wall time and the
+    peak memory.
+
+    :param plans: list of stage plans returned by plan_run
+    """
+    table = [[plan["stage"], "yes" if plan["runs"] else "skipped",
+              "{0} of {1}".format(plan["files"], plan["total"]),
+              plan["cached"], format_bytes(plan["bytes"]),
+              format_seconds(plan["seconds"]), format_bytes(plan["memory"]),
+              plan["note"]] for plan in plans]
+    print(tabulate(table, headers=["stage", "runs", "files", "cached",
+                                   "reads", "est. time", "est. memory",
+                                   "note"], tablefmt="fancy_grid"))
+    print("estimated wall time: {0}, estimated peak memory: {1}".format(
+        format_seconds(sum(plan["seconds"] for plan in plans)),
+        format_bytes(max([plan["memory"] for plan in plans], default=0))))
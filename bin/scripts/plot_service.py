@@ -0,0 +1,133 @@
+"""
+Renders the plots of the analysed transcription factors in a pool of worker
+processes.
+
+The analysis submits one job per transcription factor with everything the
+plots need (scores, densities and the fitted model) and goes on with the
+next one while the plots are rendered. The jobs are queued to the workers,
+which use the non-interactive Agg backend and draw on figures that are
+cleared after saving (see visualize_data.figure), so memory does not grow
+with the number of transcription factors. Every worker runs BLAS/OpenMP
+with a single thread, so the plots take one cpu per worker from the
+analysis. close waits for all plots and raises the first error of a job.
+
+
+Use as follows:
+
+    from scripts.plot_service import PlotService
+
+    with PlotService(workers=2) as plots:
+        plots.submit(plot_job(path_results, tf, genome, biosource, chromosome,
+                              distribution, z, model, vis_filename))
+"""
+
+import os
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+
+class PlotService:
+
+    def __init__(self, workers=1):
+        """
+        :param workers: number of rendering processes
+        """
+        self.pool = ProcessPoolExecutor(max_workers=max(1, workers),
+                                        initializer=use_agg)
+        self.futures = []
+
+    def submit(self, job):
+        """
+        Queues the plots of a transcription factor, returns right away.
+
+        :param job: dictionary made by plot_job
+        """
+        self.futures.append((job["tf"], self.pool.submit(render, job)))
+
+    def close(self):
+        """
+        Waits until all plots are rendered and stops the workers.
+
+        :raises Exception: the first error of a job, after all jobs finished
+        """
+        error = None
+        for tf, future in self.futures:
+            try:
+                future.result()
+            except Exception as err:
+                logging.error("could not plot {0}: {1}".format(tf, err))
+                error = error or err
+        self.futures = []
+        self.pool.shutdown()
+        if error is not None:
+            raise error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # the analysis failed, its error is more important than the
+            # plots, the queued ones are dropped
+            for _, future in self.futures:
+                future.cancel()
+            self.pool.shutdown()
+        return False
+
+
+def plot_job(path_results, tf, genome, biosource, chromosome, distribution,
+             z, model, vis_filename):
+    """
+    :param path_results: results directory of the plots
+    :param tf: transcription factor
+    :param genome: genome
+    :param biosource: biosource
+    :param chromosome: list of chromosomes
+    :param distribution: Array of the (ATAC, ChIP) scores
+    :param z: Array of the density at every point
+    :param model: FittedModel of the distribution
+    :param vis_filename: filename of the contour plot in the assets of the
+           visualization
+    :return: dictionary describing the plots of a transcription factor
+    """
+    return {"path_results": path_results, "tf": tf, "genome": genome,
+            "biosource": biosource, "chromosome": chromosome,
+            "distribution": distribution, "z": z, "model": model,
+            "vis_filename": vis_filename}
+
+
+def render(job):
+    """
+    Renders the density scatter, altitude and contour plot of a job.
+
+    :param job: dictionary made by plot_job
+    """
+    from scripts.visualize_data import VisualizeData
+
+    tf = job["tf"]
+    v = VisualizeData(job["path_results"], tf, job["genome"],
+                      job["biosource"], job["chromosome"])
+    v.displayDensityScatter(job["distribution"], tf, z=job["z"])
+    v.altitudePlot(job["distribution"], job["model"], tf)
+    v.contourPlot(job["distribution"], tf, z=job["z"],
+                  filename=job["vis_filename"])
+
+
+def use_agg():
+    """
+    Initializer of the workers, selects the non-interactive backend and
+    limits BLAS/OpenMP to one thread.
+    """
+    # libraries loaded later read the variables, loaded ones are limited by
+    # threadpoolctl
+    for variable in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS",
+                     "MKL_NUM_THREADS"):
+        os.environ[variable] = "1"
+    from threadpoolctl import threadpool_limits
+    global _thread_limits
+    _thread_limits = threadpool_limits(limits=1)
+
+    import matplotlib
+    matplotlib.use("Agg")
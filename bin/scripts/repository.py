@@ -81,6 +81,9 @@ class Repository:
     def save_csv(self, resultframe):
         """
         Save Dataframe to result.csv. If directory does not exist it will be created.
+        If result.csv was written with other columns (e.g. by an older version
+        without n_components, n_fits and criterion) it is rewritten with the
+        columns of both, missing values are left empty.
 
         Parameters
         ----------
@@ -96,7 +99,13 @@ class Repository:
         #Save resultframe
         try:
             if os.path.isfile(path):
-                resultframe.to_csv(path, mode= 'a', header=False, index=False)
+                columns = list(pd.read_csv(path, nrows=0).columns)
+                if columns == list(resultframe.columns):
+                    resultframe.to_csv(path, mode= 'a', header=False, index=False)
+                else:
+                    #keep the stored values as they are written
+                    old = pd.read_csv(path, dtype=str, keep_default_na=False)
+                    pd.concat([old, resultframe.astype(object)]).to_csv(path, index=False)
             else:
                 resultframe.to_csv(path, mode= 'a',index=False)
         except:
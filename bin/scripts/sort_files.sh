@@ -12,7 +12,9 @@
 #				adds the new filepath and cleans up the .csv. Files that do not
 # 				exist anymore are deleted out of the .csv, this should only
 #				affect the merging of forward/reverse reads, since those files
-#				are only needed in the merged form.
+#				are only needed in the merged form. Double entries are removed
+#				when the linking table is imported into the catalog
+#				(see catalog.py).
 #
 #  $1 = path to the directory where the data is
 #  $2 = path to the directory where the files are sorted into
@@ -64,9 +66,5 @@ do
 	mv "$sourcefile" "$file_path"
 	line="$experiment_id;$genome;$biosource;$technique;$epigenetic_mark;\
 $chromosome;$filename;$data_type;$file_path;$remaining"
-
-	# ensure that there are no double entries in the linking table
-	if ! grep -Fxq "$line" "$new_link"; then
-		echo "$line" >> "$new_link"
-	fi
+	echo "$line" >> "$new_link"
 done < <(tail -n +2 "$csv_path")
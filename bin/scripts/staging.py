@@ -0,0 +1,99 @@
+"""
+Methods for staging files between the folders of the data preparation phase
+without copying their bytes.
+
+A file is staged by the cheapest method the filesystem supports:
+- hardlink: the new path shares the data of the source file
+- reflink: copy-on-write clone of the source file (e.g. btrfs, xfs), used if
+  the filesystem does not allow the hardlink
+- copy: plain copy if the files are on different filesystems
+
+Staged files must never be modified in place, since a hardlinked file
+shares its data with the source. The pipeline only writes new files and
+replaces old ones (temporary file + rename), which keeps the source intact.
+
+
+Use as follows:
+
+    from scripts.staging import stage_file
+
+    stage_file("data/download/a.bed", "data/temp/a.bed")
+"""
+
+import os
+import shutil
+import logging
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, reflinks are not supported
+    fcntl = None
+
+# ioctl request to clone a file on linux, see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+
+def stage_file(source, destination, move=False):
+    """
+    Makes a file available at a new path without copying its data if
+    possible. An existing file at the destination is replaced.
+
+    :param source: String with path to the file
+    :param destination: String with the new path of the file
+    :param move: Boolean, if True the source file is removed afterwards
+    :return: String with the method used: "rename", "hardlink", "reflink" or
+             "copy"
+    """
+    tmp_file = destination + ".stage.tmp"
+    if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+
+    if move:
+        try:
+            os.replace(source, destination)
+            return "rename"
+        except OSError:
+            pass
+
+    method = "hardlink"
+    try:
+        os.link(source, tmp_file)
+    except OSError:
+        if reflink(source, tmp_file):
+            method = "reflink"
+        else:
+            method = "copy"
+            shutil.copyfile(source, tmp_file)
+
+    os.replace(tmp_file, destination)
+    if move:
+        os.remove(source)
+
+    logging.debug("staged {0} to {1} ({2})".format(source, destination,
+                                                   method))
+    return method
+
+
+def reflink(source, destination):
+    """
+    Creates a copy-on-write clone of a file.
+
+    :param source: String with path to the file
+    :param destination: String with path to the clone, must not exist
+    :return: Boolean, True if the clone was created
+    """
+    if fcntl is None:
+        return False
+
+    with open(source, "rb") as src:
+        dst = open(destination, "wb")
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            os.remove(destination)
+            return False
+        dst.close()
+
+    return True
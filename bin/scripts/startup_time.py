@@ -0,0 +1,100 @@
+"""
+Measures the startup time of tf_analyzer.py and checks that the heavy
+dependencies of the data preparation and analysis phase are not imported by
+commands that do not need them.
+
+Every command is run several times in a fresh interpreter. The median wall
+time is reported together with the heavy modules that were loaded. The exit
+code is 1 if a heavy module was loaded or the median time of a command is
+above --max_seconds, so the script can be used to catch regressions.
+
+By default "--help" and "--list_downloaded_data" are measured, other
+commands can be given after "--", e.g.
+
+    python bin/scripts/startup_time.py --repeat 5 -- --list_downloaded_data -o /path/to/output
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+HEAVY_MODULES = ["sklearn", "matplotlib", "scipy", "kneed", "pyBigWig"]
+
+# runs tf_analyzer.main() with the given arguments and writes the imported
+# top level modules into a file, the output of tf_analyzer is discarded
+RUNNER = """
+import sys, json
+bin_path, modules_file, argv = sys.argv[1], sys.argv[2], sys.argv[3:]
+sys.path.insert(0, bin_path)
+sys.argv = ["tf_analyzer.py"] + argv
+import tf_analyzer
+try:
+    tf_analyzer.main()
+except SystemExit:
+    pass
+with open(modules_file, "w") as file:
+    json.dump(sorted(set(name.split(".")[0] for name in sys.modules)), file)
+"""
+
+
+def measure(command, repeat=3):
+    """
+    Runs tf_analyzer.py with the given arguments in fresh interpreters.
+
+    :param command: list of arguments passed to tf_analyzer.py
+    :param repeat: number of runs
+    :return: tuple of the median wall time in seconds and the list of heavy
+             modules that were imported
+    """
+    bin_path = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+    times = []
+    loaded = set()
+    with tempfile.TemporaryDirectory() as tmp:
+        modules_file = os.path.join(tmp, "modules.json")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", RUNNER, bin_path,
+                            modules_file] + command,
+                           stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+            times.append(time.perf_counter() - start)
+            with open(modules_file) as file:
+                loaded.update(set(json.load(file)) & set(HEAVY_MODULES))
+    return statistics.median(times), sorted(loaded)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measures the startup time of tf_analyzer.py")
+    parser.add_argument("--repeat", default=3, type=int,
+                        help="number of runs per command (default: 3)")
+    parser.add_argument("--max_seconds", default=2.0, type=float,
+                        help="maximum median time of a command "
+                             "(default: 2.0)")
+    parser.add_argument("command", nargs=argparse.REMAINDER,
+                        help="arguments of tf_analyzer.py after \"--\"")
+    args = parser.parse_args()
+
+    if args.command and args.command[0] == "--":
+        args.command = args.command[1:]
+    failed = False
+    with tempfile.TemporaryDirectory() as output:
+        commands = [args.command] if args.command else [
+            ["--help"], ["--list_downloaded_data", "-o", output]]
+        for command in commands:
+            seconds, loaded = measure(command, args.repeat)
+            print("{0:<40} {1:6.2f}s  heavy modules: {2}".format(
+                " ".join(command)[:40], seconds, ", ".join(loaded) or "none"))
+            if loaded or seconds > args.max_seconds:
+                failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Persistent key-value cache with a time to live, used to keep answers of the
+DeepBlue server between runs.
+
+The values are stored as JSON in a SQLite database and grouped into
+namespaces (e.g. "info" for experiment metadata or "regions" for region
+counts). A value older than the time to live of the cache is treated as
+missing. The cache can be shared by several threads.
+
+
+Use as follows:
+
+    from scripts.ttl_cache import TTLCache
+
+    cache = TTLCache("data/deepblue_cache.sqlite", ttl=7 * 24 * 3600)
+    info = cache.get("info", experiment_id)
+    if info is None:
+        info = ...
+        cache.set("info", experiment_id, info)
+
+A cache opened with read_only=True works on a copy in memory.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import threading
+from scripts.catalog import copy_to_memory
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (namespace, key)
+);
+"""
+
+
+class TTLCache:
+    """SQLite backed cache of JSON values with a time to live."""
+
+    def __init__(self, path, ttl=7 * 24 * 3600, read_only=False):
+        """
+        :param path: path to the SQLite database file
+        :param ttl: time to live of the values in seconds
+        :param read_only: Boolean, if True the cache is copied into memory and
+               nothing is written to path
+        """
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        if read_only:
+            self.connection = copy_to_memory(path, check_same_thread=False)
+        else:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.connection = sqlite3.connect(path, timeout=60,
+                                              check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def get(self, namespace, key, ttl=None):
+        """
+        :param namespace: namespace of the value
+        :param key: key of the value
+        :param ttl: time to live in seconds, defaults to the ttl of the cache
+        :return: the value or None if it is missing or expired
+        """
+        return self.get_many(namespace, [key], ttl).get(key)
+
+    def get_many(self, namespace, keys, ttl=None):
+        """
+        :param namespace: namespace of the values
+        :param keys: list of keys
+        :param ttl: time to live in seconds, defaults to the ttl of the cache
+        :return: dictionary {key: value} of the values that are not expired
+        """
+        oldest = time.time() - (self.ttl if ttl is None else ttl)
+        keys = [str(key) for key in keys]
+        values = {}
+        with self.lock:
+            # stay below the maximum number of SQLite parameters
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                cursor = self.connection.execute(
+                    "SELECT key, value FROM cache WHERE namespace = ? AND "
+                    "created >= ? AND key IN ({0})".format(
+                        ", ".join("?" * len(batch))),
+                    [namespace, oldest] + batch)
+                values.update((key, json.loads(value)) for key, value in
+                              cursor)
+        return values
+
+    def set(self, namespace, key, value):
+        """
+        :param namespace: namespace of the value
+        :param key: key of the value
+        :param value: JSON serializable value
+        """
+        self.set_many(namespace, {key: value})
+
+    def set_many(self, namespace, values):
+        """
+        :param namespace: namespace of the values
+        :param values: dictionary {key: JSON serializable value}
+        """
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                [[namespace, str(key), json.dumps(value), now] for key, value
+                 in values.items()])
+
+    def age(self, namespace, key):
+        """
+        :param namespace: namespace of the value
+        :param key: key of the value
+        :return: age of the value in seconds or None if it is missing
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT created FROM cache WHERE namespace = ? AND key = ?",
+                [namespace, str(key)]).fetchone()
+        return None if row is None else time.time() - row[0]
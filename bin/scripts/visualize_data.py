@@ -6,17 +6,49 @@ Created on Sat Jan 16 18:15:37 2021
 @author: jan
 """
 
-import matplotlib.pyplot as plt
-from scipy.stats import gaussian_kde
+from matplotlib.figure import Figure
+from matplotlib import cm
+# registers the 3d projection
+from mpl_toolkits.mplot3d import Axes3D
+from contextlib import contextmanager
+from scripts.fast_kde import density, density_grid
 import numpy as np
-from sklearn.mixture import GaussianMixture
 import os
 import uuid
 
+#above this number of points the plots are drawn with less detail: the point
+#layers are rasterized inside the svg and the surface of the contour plot is
+#drawn from a fixed grid of densities instead of a triangle per point
+LOD_THRESHOLD = 20000
+#resolution of the rasterized layers
+RASTER_DPI = 150
+#number of grid nodes per axis of the surface of the contour plot
+SURFACE_GRID = 60
+
+
+@contextmanager
+def figure():
+    """
+    Figure that is not registered by pyplot, so it does not depend on the
+    backend and is not kept alive by it. It is cleared when the block is
+    left, even after an error.
+
+    Yields
+    ------
+    fig: TYPE: matplotlib Figure
+
+    """
+    fig = Figure()
+    try:
+        yield fig
+    finally:
+        fig.clear()
+
+
 class VisualizeData:
     
         
-        def __init__(self,path,tf_id, genome, biosource, chromosome):
+        def __init__(self,path,tf_id, genome, biosource, chromosome, lod_threshold=LOD_THRESHOLD):
             """
             Initialize variables and set up directory if necessary
 
@@ -26,6 +58,9 @@ class VisualizeData:
                 Path to results
             tf_id : TYPE: str
                 ID of the transcription factor
+            lod_threshold : TYPE: int
+                number of points above which the plots are drawn with less
+                detail, never if None
 
             Returns
             -------
@@ -33,6 +68,7 @@ class VisualizeData:
 
             """
             self.chromosome = chromosome
+            self.lod_threshold = lod_threshold
             #genome_path = (os.path.join(path, genome))
             self.path_plots = (os.path.join(path,'plots',genome ,biosource ,tf_id))
             path_scripts = os.path.dirname(__file__)
@@ -85,13 +121,15 @@ class VisualizeData:
         
         
         #Make Density Scatter Heatmap
-        def displayDensityScatter(self,scores_array, tf_id):
+        def displayDensityScatter(self,scores_array, tf_id, z=None):
             """
             Method to illustrate distribution via Density Scatter(Heat-Map)
 
             Parameters
             ----------
             scores_array: TYPE: list of float64 vectors
+            z: TYPE: Array of float64
+                density at every point (fast_kde.density), calculated if None
 
             Returns
             -------
@@ -102,24 +140,58 @@ class VisualizeData:
             x,y = VisualizeData.makeArray(self, scores_array)
             
             # Calculate the point density
-            xy = np.vstack([x,y])
-            z = gaussian_kde(xy)(xy)
+            if z is None:
+                z = density(np.column_stack([x,y]))
             
-            fig, ax = plt.subplots()
-            ax.scatter(x, y, c=z, s=50, edgecolors='face')
-            
-            # ax.set(xlim=(0,100), ylim=(0,100))
-            plt.xlabel("ATAC")
-            plt.ylabel("Chip")
-            # plt.colorbar()
-            figure_path = self.path_plots + "/DensityScatter_" + tf_id + ".svg"
-            plt.savefig(figure_path, format="svg")
-            # plt.show()
+            with figure() as fig:
+                ax = fig.add_subplot()
+                ax.scatter(x, y, c=z, s=50, edgecolors='face', rasterized=VisualizeData.useLod(self, x))
+                
+                # ax.set(xlim=(0,100), ylim=(0,100))
+                ax.set_xlabel("ATAC")
+                ax.set_ylabel("Chip")
+                # fig.colorbar()
+                figure_path = self.path_plots + "/DensityScatter_" + tf_id + ".svg"
+                fig.savefig(figure_path, format="svg", dpi=RASTER_DPI)
             
             return self.path_plots
         
         #Make contourPlot
-        def contourPlot(self, scores_array, n_cgauss, tf_id):
+        def useLod(self, scores_array):
+            """
+            Decides if a distribution is plotted with less detail.
+
+            Parameters
+            ----------
+            scores_array: TYPE: list of float64 vectors
+                distribution to plot
+
+            Returns
+            -------
+            lod: TYPE: bool
+                True if the distribution has more than lod_threshold points
+
+            """
+            return self.lod_threshold is not None and len(scores_array) > self.lod_threshold
+        
+        def visFilename(self, tf_id):
+            """
+            Unique filename of the contour plot in the assets of the
+            visualization
+
+            Parameters
+            ----------
+            tf_id : TYPE: str
+                ID of the transcription factor
+
+            Returns
+            -------
+            filename: TYPE: str
+
+            """
+            return "Contour_" + tf_id + "_" + str(uuid.uuid4().hex) +".svg"
+        
+        def contourPlot(self, scores_array, tf_id, z=None, filename=None):
             """
             Method to display distribution via contour-plot
 
@@ -127,42 +199,53 @@ class VisualizeData:
             ----------
             scores_array: TYPE: list of float64 vectors
                 distribution to plot
-            n_cgauss: TYPE: int
-                number of componets for a Gasussian Mixture Model
+            z: TYPE: Array of float64
+                density at every point (fast_kde.density), calculated if None
+            filename: TYPE: str
+                filename in the assets of the visualization, a new one
+                (visFilename) if None
             Returns
             -------
-            None.
+            z: TYPE: Array of float64
+                density at every point
+            filename: TYPE: str
+                filename in the assets of the visualization
 
             """
             
-            gmm = GaussianMixture(n_components=n_cgauss)
-            gmm.fit(scores_array)
-            
             x,y = VisualizeData.makeArray(self, scores_array)
             # Calculate the point density
-            xy = np.vstack([x,y])
-            z = gaussian_kde(xy)(xy)
-            
-            # Make the plot
-            fig = plt.figure()
-            ax = fig.gca(projection='3d')
-            ax.set_ylabel('CHIP')
-            ax.set_xlabel('ATAC')
-            ax.plot_trisurf(x, y, z, cmap=plt.cm.coolwarm, linewidth=1, antialiased=False)
-            # ax.plot_surface(x, y, z, color='b')
+            if z is None:
+                z = density(np.column_stack([x,y]))
             
-            filename = "Contour_" + tf_id + "_" + str(uuid.uuid4().hex) +".svg"
+            if filename is None:
+                filename = VisualizeData.visFilename(self, tf_id)
             
-            figure_path = os.path.join(self.path_plots, "Contour_" + tf_id + ".svg")
-            plt.savefig(figure_path, format="svg")
-            vil_fig_path = os.path.join(self.path_visualization, filename)
-            plt.savefig(vil_fig_path, format="svg")
-            # plt.show()
+            # Make the plot
+            with figure() as fig:
+                ax = fig.add_subplot(projection='3d')
+                ax.set_ylabel('CHIP')
+                ax.set_xlabel('ATAC')
+                if VisualizeData.useLod(self, x):
+                    #surface of a fixed grid of densities instead of a
+                    #triangle per point
+                    grid_x, grid_y, grid_z = density_grid(np.column_stack([x,y]), SURFACE_GRID)
+                    X, Y = np.meshgrid(grid_x, grid_y, indexing='ij')
+                    ax.plot_surface(X, Y, grid_z, cmap=cm.coolwarm, linewidth=0, antialiased=False,
+                                    rasterized=True)
+                else:
+                    ax.plot_trisurf(x, y, z, cmap=cm.coolwarm, linewidth=1, antialiased=False)
+                # ax.plot_surface(x, y, z, color='b')
+                
+                figure_path = os.path.join(self.path_plots, "Contour_" + tf_id + ".svg")
+                fig.savefig(figure_path, format="svg", dpi=RASTER_DPI)
+                vil_fig_path = os.path.join(self.path_visualization, filename)
+                fig.savefig(vil_fig_path, format="svg", dpi=RASTER_DPI)
             
             return z,filename
             
         #Make altitude Plot
-        def altitudePlot(self, data, n_cgauss, tf_id):
+        def altitudePlot(self, data, model, tf_id):
             """
             Method to display a distribution via altitude-plot. Lines for altitude 
             measurments.
@@ -171,8 +254,9 @@ class VisualizeData:
             ----------
             data: TYPE: list of float64 vectors 
                 distribution to plot
-            n_cgauss: TYPE: int
-                number of components 
+            model: TYPE: FittedModel
+                model fitted into the unscaled distribution, evaluated on the
+                scaled grid
 
             Returns
             -------
@@ -181,23 +265,19 @@ class VisualizeData:
             """
             dist = data *100
             
-            gmm = GaussianMixture(n_components=n_cgauss)
-            gmm.fit(dist)
-            
             X, Y = np.meshgrid(np.linspace(start = -1, stop = 100, num = 100), np.linspace(start = -1, stop = 100, num = 100))
             XY = np.array([X.ravel(), Y.ravel()]).T
-            Z = gmm.score_samples(XY)
+            Z = model.score_samples(XY, scale=100)
             Z = Z.reshape(100,100)
     
-            plt.contour(X,Y,Z)
-            plt.scatter(dist[:,0], dist[:,1])
-            
-            
-            figure_path = self.path_plots + "/Altitude_" + tf_id + ".svg"
-            plt.savefig(figure_path, format= "svg")
-            #plt.savefig(/visualization/assests/img/, kwargs)
-            
-            # plt.show()
+            with figure() as fig:
+                ax = fig.add_subplot()
+                ax.contour(X,Y,Z)
+                ax.scatter(dist[:,0], dist[:,1], rasterized=VisualizeData.useLod(self, dist))
+                
+                figure_path = self.path_plots + "/Altitude_" + tf_id + ".svg"
+                fig.savefig(figure_path, format= "svg", dpi=RASTER_DPI)
+                #fig.savefig(/visualization/assests/img/, kwargs)
             
 #FOR TESTING // EXAMPLE SEE BELOW
 # if __name__ == '__main__':
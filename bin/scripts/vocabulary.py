@@ -0,0 +1,152 @@
+"""
+Cached vocabularies of the DeepBlue server (genomes, biosources,
+transcription factors and the chromosomes of every genome) used to validate
+the arguments of tf_analyzer.py.
+
+The vocabularies are kept in the TTL cache of the output path (see
+ttl_cache.py). A cached copy is used right away, also after its time to live
+has passed; an expired copy is refreshed in a background thread while the
+program goes on, so the next run uses the new vocabularies. Short commands
+would end before the refresh, so the program waits up to EXIT_WAIT seconds
+for it at exit. If there is no cached copy or it is older than MAX_AGE, the
+vocabularies are fetched before returning (the old copy is still used if
+that fails). All lists are requested concurrently.
+
+
+Use as follows:
+
+    from scripts.vocabulary import load_vocabularies
+
+    vocabularies = load_vocabularies(cache)
+    genomes = vocabularies["genomes"]
+"""
+
+import atexit
+import logging
+import threading
+
+TTL = 7 * 24 * 3600
+# cached vocabularies older than this are refreshed before they are used
+MAX_AGE = 4 * TTL
+# seconds the program waits at exit for a background refresh
+EXIT_WAIT = 10
+NAMESPACE = "vocabulary"
+KEY = "all"
+
+
+def load_vocabularies(cache, client=None, offline=False, ttl=TTL,
+                      max_age=MAX_AGE):
+    """
+    Loads the vocabularies from the cache or from DeepBlue.
+
+    :param cache: scripts.ttl_cache.TTLCache
+    :param client: scripts.deepblue.DeepBlueClient, created if None
+    :param offline: Boolean, if True DeepBlue is not contacted
+    :param ttl: seconds after which the vocabularies are refreshed
+    :param max_age: seconds after which the vocabularies are refreshed
+           before they are used
+    :return: dictionary with the lists "genomes", "biosources", "tfs" and the
+             dictionary "chromosomes" {genome: list of chromosomes}, or None
+             if offline and nothing is cached
+    """
+    vocabularies = cache.get(NAMESPACE, KEY, ttl=float("inf"))
+    if offline:
+        return vocabularies
+
+    if client is None:
+        from scripts.deepblue import DeepBlueClient
+        client = DeepBlueClient(max_in_flight=8, retries=2)
+
+    if vocabularies is None:
+        return refresh(cache, client)
+
+    age = cache.age(NAMESPACE, KEY)
+    if age is not None and age > max_age:
+        logging.info("refreshing the outdated DeepBlue vocabularies")
+        return refresh_quietly(cache, client) or vocabularies
+    if age is not None and age > ttl:
+        logging.info("refreshing the cached DeepBlue vocabularies in the "
+                     "background")
+        thread = threading.Thread(target=refresh_quietly,
+                                  args=(cache, client), daemon=True)
+        thread.start()
+        # daemon threads are stopped at exit, give the refresh some time
+        atexit.register(thread.join, EXIT_WAIT)
+    return vocabularies
+
+
+def refresh(cache, client):
+    """
+    Fetches the vocabularies from DeepBlue concurrently and caches them.
+
+    :param cache: scripts.ttl_cache.TTLCache
+    :param client: scripts.deepblue.DeepBlueClient
+    :return: dictionary of the vocabularies
+    """
+    genomes, biosources, tfs = run_concurrently([
+        lambda: client.call("list_genomes"),
+        lambda: client.call("list_biosources", None),
+        lambda: client.call("list_epigenetic_marks",
+                            {"category": "Transcription Factor Binding "
+                                         "Sites"})])
+
+    genome_names = [genome[1].lower() for genome in genomes]
+    chromosomes = run_concurrently([
+        (lambda genome=genome:
+         [x[0] for x in client.call("chromosomes", genome)])
+        for genome in genome_names])
+
+    vocabularies = {
+        "genomes": genome_names,
+        "biosources": [x[1].lower() for x in biosources],
+        "tfs": [x[1].lower() for x in tfs],
+        "chromosomes": dict(zip(genome_names, chromosomes))}
+
+    cache.set(NAMESPACE, KEY, vocabularies)
+    return vocabularies
+
+
+def run_concurrently(functions):
+    """
+    Calls every function in its own thread. Plain threads are used instead of
+    a ThreadPoolExecutor since executors take no work at interpreter exit,
+    when a background refresh may still be running.
+
+    :param functions: list of functions without arguments
+    :return: list of the return values in the order of the functions
+    :raises Exception: the first error of a function
+    """
+    results = [None] * len(functions)
+    errors = []
+
+    def run(i):
+        try:
+            results[i] = functions[i]()
+        except Exception as err:
+            errors.append(err)
+
+    threads = [threading.Thread(target=run, args=(i,))
+               for i in range(len(functions))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+def refresh_quietly(cache, client):
+    """
+    Refreshes the vocabularies, errors are only logged.
+
+    :return: dictionary of the vocabularies, None if the refresh failed
+    """
+    try:
+        vocabularies = refresh(cache, client)
+        logging.info("refreshed the cached DeepBlue vocabularies")
+        return vocabularies
+    except Exception as err:
+        logging.warning("could not refresh the DeepBlue vocabularies: "
+                        "{0}".format(err))
+        return None
@@ -1,11 +1,9 @@
 """
 @author: Jasmin
 """
-import pandas as pd
 import argparse
 import os
 from argparse import RawTextHelpFormatter
-import xmlrpc.client as xc
 import subprocess
 from natsort import natsorted
 from tabulate import tabulate
@@ -29,26 +27,39 @@ def main():
                               the end position is determined by adding the width to the summit.
     parameter -o / --output_path: the path were the data and results should be stored
     parameter -cs / --component_size: single integer determining the component size for the analysis
+    parameter --seed: seed of the gaussian mixture model fits, makes the results reproducible
+    parameter --criterion: criterion of the automatic evaluation of the component size (knee, bic or aic)
+    parameter --sample_size: number of points the gaussian mixture models of large transcription factors are fitted on
+    parameter --incremental: transcription factors analysed before are refitted starting from their stored models
+    parameter --no_fit_cache: fit all gaussian mixture models again instead of taking them from results/fit_cache
     parameter --visualize= : calls visualization for all existing results
-    parameter --list_chromosomes: prints a list of all genomes with their associated chromosomes
+    parameter --list_chromosomes: prints a list of all genomes with their associated chromosomes, also works offline
+                                  once the chromosomes are cached
     parameter --list_downloaded_data: prints a table containing all downloaded genomes, biosources, tfs and chromosomes
     parameter --offline: runs the program in offline mode
     parameter --redo_file_validation: downloaded files will be validated and sorted again
     parameter --check_local_files: This parameter takes the path of an external directory containing Deepblue data.
                                   The files matching query will be copied from here instead of downloaded.
+    parameter --threads: maximum number of files that are converted or merged and of transcription factors that are
+                         analysed at the same time
+    parameter --downloader: generate the linking table and download the data with the R scripts (r) or the python
+                            modules (python)
+    parameter --compress: store the files downloaded by the python downloader compressed with gzip or zstd
+    parameter --cache_dir: path to a global artifact cache shared by several output paths
+    parameter --cache_size: maximum size of the artifact cache in GB
+    parameter --plan: prints which stages would run with estimates of the files, bytes, wall time and memory they need
+                      and exits without running them
     """
 
     # import logging, author: Jonathan
     import scripts.setup_logging
 
-    # import score, author: Noah
-    import scripts.score
+    # import the cache of the deepblue vocabularies
+    import scripts.ttl_cache
+    import scripts.vocabulary
 
-    # import analyse_main, author: Jan
-    import scripts.analyse_main
-
-    # import generate_data, author: Jonathan
-    import generate_data
+    # generate_data, score and analyse_main are imported right before they are used, they load pyBigWig, sklearn,
+    # scipy, matplotlib and kneed which are not needed to list data or start the visualization
 
     # links to deepbluer for possible genomes, biosources and tfs
     # given to the user if script is called with -h / --help
@@ -82,10 +93,52 @@ def main():
                         type=str, nargs='?', help='The path were the downloaded data and the results will be stored.')
     parser.add_argument('-cs', '--component_size', type=int, nargs='?',
                         help='single integer determining the component size for the analysis')
+    parser.add_argument('--seed', type=int, nargs='?',
+                        help='seed of the gaussian mixture model fits and the generated reference distributions, '
+                             'runs with the same seed give the same results (default: random)')
+    parser.add_argument('--criterion', default='knee', type=str, choices=['knee', 'bic', 'aic'],
+                        help='criterion of the automatic evaluation of the component size if --component_size is not '
+                             'given: the knee of the differences to distributions generated from the fits (knee), the '
+                             'lowest BIC (bic) or the lowest AIC (aic). The candidates are fitted concurrently and the '
+                             'search stops once the fits do not improve anymore. (default: knee)')
+    parser.add_argument('--sample_size', type=int, nargs='?',
+                        help='transcription factors with more scored regions are fitted on a stratified subsample of '
+                             'this size and then refined with a few EM steps on all regions. The diagnostics of the '
+                             'fit (log-likelihood before and after the refinement) are printed. (default: all '
+                             'regions)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='transcription factors that were analysed before keep their number of components and '
+                             'the fit starts from the model stored by the last analysis of the same width and '
+                             'chromosomes, e.g. after a new replicate was added. The time of the analysis the fit started from is stored in the column '
+                             'warm_start of result.csv.')
+    parser.add_argument('--no_fit_cache', action='store_true',
+                        help='fit all gaussian mixture models again. By default fits of the same scores, number of '
+                             'components, seed and fit parameters are taken from the cache in results/fit_cache.')
     parser.add_argument('--offline', action='store_true',
                         help='runs the program in offline mode')
     parser.add_argument('--redo_file_validation', action='store_true',
                         help='downloaded files will be validated and sorted again')
+    parser.add_argument('--threads', type=int, nargs='?',
+                        help='maximum number of files that are converted or merged at the same time and of '
+                             'transcription factors that are analysed at the same time (default: number of cpus)')
+    parser.add_argument('--downloader', default='r', type=str, choices=['r', 'python'],
+                        help='generate the linking table and download the data with the R scripts (r) or with '
+                             'concurrent, cached requests and resumable chunks in python (python) (default: r)')
+    parser.add_argument('--compress', type=str, choices=['gzip', 'zstd'],
+                        help='store the text files downloaded by the python downloader compressed with gzip or zstd '
+                             '(zstd needs the zstandard package). They are decompressed on the fly during validation '
+                             'and conversion. (default: uncompressed)')
+    parser.add_argument('--cache_dir', type=str, nargs='?',
+                        help='path to a global cache of downloaded and converted files that can be shared by several '
+                             'output paths. Cached files are linked into the output path instead of downloaded and '
+                             'converted again.')
+    parser.add_argument('--cache_size', default=50, type=float, nargs='?',
+                        help='maximum size of the cache in GB, the least recently used files are removed if the cache '
+                             'grows bigger (default: 50)')
+    parser.add_argument('--plan', action='store_true',
+                        help='prints which stages of the run would be executed, how many files and bytes each of them '
+                             'touches and estimates of the wall time and peak memory, then exits without running them or '
+                             'writing to the output path')
     parser.add_argument('--check_local_files', type=str, nargs='?',
                         help='This parameter takes the path of an external directory containing Deepblue data. The '
                              'files matching query will be copied from here instead of downloaded.')
@@ -100,14 +153,6 @@ def main():
 
     args = parser.parse_args()
 
-    try:
-        lt = pd.read_csv(
-            os.path.join(args.output_path, 'data', 'download', 'linking_table.csv'),
-            sep=';', usecols=['genome', 'epigenetic_mark', 'biosource', 'chromosome'])
-        lt.drop(lt[lt['epigenetic_mark'] == ('dnasei' or 'dna accessibility')].index, inplace=True)
-    except FileNotFoundError:
-        lt = None
-
     # test if img folder for visualization exists
     if not os.path.exists(
             os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'visualization', 'src', 'assets', 'img'))):
@@ -116,6 +161,7 @@ def main():
 
     # print a table containing the downloaded genomes, biosources, tfs and chromosomes from the linking_table
     if args.list_downloaded_data:
+        lt = read_linking_table(args.output_path)
         try:
             tab = lt.groupby(["genome", "biosource", "epigenetic_mark"]).chromosome.unique().apply(
                 lambda x: '\n'.join(x)).reset_index().to_dict(orient='list')
@@ -132,66 +178,70 @@ def main():
                         cwd=os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'visualization')))
 
     else:
-        # logging
-        logfile = scripts.setup_logging.setup(args.output_path)
+        # logging, --plan is a dry run and writes nothing to the output path
+        if args.plan:
+            logfile = None
+        else:
+            logfile = scripts.setup_logging.setup(args.output_path)
+
+            print('-------------------------\n')
+            print('The Logfile can be found at ' + logfile + '\n')
+            print('-------------------------\n')
 
-        print('-------------------------\n')
-        print('The Logfile can be found at ' + logfile + '\n')
-        print('-------------------------\n')
+        # the genomes, biosources, tfs and chromosomes of deepblue are cached in the output path and refreshed in
+        # the background once they are older than a week
+        vocabulary_cache = scripts.ttl_cache.TTLCache(
+            os.path.join(args.output_path, 'data', 'deepblue_cache.sqlite'), read_only=args.plan)
+        try:
+            vocabularies = scripts.vocabulary.load_vocabularies(vocabulary_cache, offline=args.offline)
+        except Exception as e:
+            logging.error(
+                'No connection could be established to deepblue. If you want to run an analysis with already '
+                'downloaded data, please call the program with the parameter \'--offline\'.')
+            sys.exit(
+                str(e) + ': No connection could be established to deepblue. If you want to run an analysis with '
+                         'already downloaded data, please call the program with the parameter \'--offline\'.')
 
         if args.offline:
             logging.info('Running in offline mode')
+            lt = read_linking_table(args.output_path)
             if lt is not None:
                 genome_choices = list(set(lt['genome']))
                 biosource_choices = list(set(lt['biosource']))
                 tf_choices = list(set(lt['epigenetic_mark']))
                 chromosomes = lt.groupby(["genome"]).chromosome.unique().to_dict()
-            else:
+            elif not args.list_chromosomes:
                 logging.error('There is currently no downloaded data in your specified path.')
                 sys.exit('There is currently no downloaded data in your specified path.')
         else:
-            # call deepblue to get all available genomes, biosources and tfs
-            url = "https://deepblue.mpi-inf.mpg.de/xmlrpc"
-            server = xc.Server(url, encoding='UTF-8', allow_none=True)
-            user_key = "anonymous_key"
-
-            try:
-                genome_choices = [genome[1].lower() for genome in server.list_genomes(user_key)[1]]
-                genome_choices.sort()
-
-                biosource_choices = [biosource[1].lower().replace("'", "\\'") for biosource in
-                                     server.list_biosources(None, user_key)[1]]
-                biosource_choices.append('all')
-                biosource_choices.sort()
-
-                tf_choices = [tf[1].lower() for tf in
-                              server.list_epigenetic_marks({"category": "Transcription Factor Binding Sites"},
-                                                           user_key)[1]]
-                tf_choices.append('all')
-                tf_choices.sort()
-
-                chromosomes = {}
-                for genome in genome_choices:
-                    chrom = [x[0] for x in server.chromosomes(genome, user_key)[1]]
-                    chromosomes[genome] = natsorted(chrom)
-            except Exception as e:
-                logging.error(
-                    'No connection could be established to deepblue. If you want to run an analysis with already '
-                    'downloaded data, please call the program with the parameter \'--offline\'.')
-                sys.exit(
-                    str(e) + ': No connection could be established to deepblue. If you want to run an analysis with '
-                             'already downloaded data, please call the program with the parameter \'--offline\'.')
+            genome_choices = sorted(vocabularies['genomes'])
+
+            biosource_choices = [biosource.replace("'", "\\'") for biosource in vocabularies['biosources']]
+            biosource_choices.append('all')
+            biosource_choices.sort()
+
+            tf_choices = list(vocabularies['tfs'])
+            tf_choices.append('all')
+            tf_choices.sort()
+
+            chromosomes = {}
+            for genome in genome_choices:
+                chromosomes[genome] = natsorted(vocabularies['chromosomes'][genome])
 
         # print a list of all genomes and their associated chromosomes
         if args.list_chromosomes:
-            if not args.offline:
-                for genome in genome_choices:
+            if vocabularies is not None:
+                all_chromosomes = {genome: natsorted(chrom) for genome, chrom in
+                                   vocabularies['chromosomes'].items()}
+                width = len(max(all_chromosomes.get(args.genome, ['']), key=len))
+                for genome in sorted(all_chromosomes):
                     print(genome + ':\n')
-                    print('\n'.join([' '.join(x.ljust(len(max(chromosomes[args.genome], key=len))) for x in g) for g in
-                                     np.split(chromosomes[genome], range(5, len(chromosomes[genome]), 5))]))
+                    print('\n'.join([' '.join(x.ljust(width) for x in g) for g in
+                                     np.split(all_chromosomes[genome], range(5, len(all_chromosomes[genome]), 5))]))
                     print('-' * 125)
             else:
-                sys.exit('You need a connection to Deepblue to list all possible chromosomes.')
+                sys.exit('You need a connection to Deepblue to list all possible chromosomes, they are cached for '
+                         'offline use after the first online run.')
 
         # compute analysis
         else:
@@ -241,13 +291,29 @@ def main():
                     all_chroms = True
                 args.chromosome = chromosomes[args.genome]
 
+            # import generate_data, author: Jonathan
+            import generate_data
+
             # download data from download_dict
             requested_data = generate_data.DataConfig([args.genome], args.chromosome, args.biosource, args.tf,
                                                       args.output_path, 'linking_table.csv', 'bigwig',
                                                       args.check_local_files, args.redo_file_validation, args.offline,
-                                                      logfile)
+                                                      logfile, threads=args.threads, cache_dir=args.cache_dir,
+                                                      cache_size=int(args.cache_size * 1024 ** 3),
+                                                      downloader=args.downloader, compression=args.compress,
+                                                      dry_run=args.plan)
+
+            # print the plan of the run and exit without running it
+            if args.plan:
+                import scripts.planner
+                scripts.planner.print_plan(scripts.planner.plan_run(requested_data))
+                return
+
             requested_data.pull_data()
 
+            # import score, author: Noah
+            import scripts.score
+
             # run the script score.py and store the calculated scores in the dictionary 'scores'
             scores = scripts.score.findarea(args.width, args.genome.lower(), [x.lower() for x in args.biosource],
                                             [x.lower() for x in args.tf], args.chromosome, args.output_path)
@@ -258,10 +324,17 @@ def main():
             # if yes and exist is False, notify that there is no data for the submitted combination of genome, biosource
             # and transcription factor and exit the program
             if scores:
+                # import analyse_main, author: Jan
+                import scripts.analyse_main
+
                 logging.info('starting analysis')
                 scripts.analyse_main.TF_analyser(n_comps=args.component_size, genome=args.genome, width=args.width,
                                                  path=args.output_path,
-                                                 chromosome='all' if all_chroms else args.chromosome).mainloop(
+                                                 chromosome='all' if all_chroms else args.chromosome,
+                                                 seed=args.seed, criterion=args.criterion,
+                                                 n_jobs=args.threads, sample_size=args.sample_size,
+                                                 incremental=args.incremental,
+                                                 fit_cache=not args.no_fit_cache).mainloop(
                     data=scores)
                 logging.info('finished analysis')
 
@@ -278,5 +351,24 @@ def main():
                     'There is no data for your entered combination of genome, biosource and transcription factor')
 
 
+def read_linking_table(output_path):
+    """
+    Reads the genomes, biosources, tfs and chromosomes of the downloaded data from the linking table.
+    pandas is only imported here, it is not needed to start the visualization.
+    :param output_path: the path were the data and results are stored
+    :return: pandas DataFrame without the DNase/ATAC-seq rows or None if no data was downloaded
+    """
+    import pandas as pd
+
+    try:
+        lt = pd.read_csv(
+            os.path.join(output_path, 'data', 'download', 'linking_table.csv'),
+            sep=';', usecols=['genome', 'epigenetic_mark', 'biosource', 'chromosome'])
+        lt.drop(lt[lt['epigenetic_mark'] == ('dnasei' or 'dna accessibility')].index, inplace=True)
+    except FileNotFoundError:
+        lt = None
+    return lt
+
+
 if __name__ == '__main__':
     main()